@@ -0,0 +1,93 @@
+# asgi_server.py
+"""
+ASGI entry point for the local server.
+
+Status routes polled by the popup (/, /health, /memory_status, /queue_status,
+/metrics, /samples) are async handlers on the event loop, so they answer in
+well under a millisecond even while a generation is running; the ones that
+touch files (/memory_status, /metrics, /samples) do that part in a thread. Every other
+route is the unchanged Flask app behind a WSGI adapter with its own thread
+pool; model calls still run on the inference scheduler's single worker thread,
+and SQLite reads behind async routes go to a small dedicated pool.
+
+    python asgi_server.py        (or: python local-server.py --asgi)
+"""
+import asyncio, importlib.util, os, sys
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+
+from metrics import CONTENT_TYPE
+
+BASE = Path(__file__).resolve().parent
+HOST = "127.0.0.1"
+PORT = 8081
+WSGI_WORKERS = int(os.environ.get("GMAIL_AI_WSGI_WORKERS", 8))  # Flask routes, including /generate calls waiting on the queue
+DB_WORKERS = 2  # SQLite reads behind async routes
+
+def create_app(server):
+    """Starlette app for an already imported local-server module"""
+    db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="asgi-db")
+
+    async def root(request):
+        return JSONResponse(server.root_payload())
+
+    async def health(request):
+        return JSONResponse(server.health_payload())
+
+    async def memory_status(request):
+        # Page-cache residency (mmap + mincore over GGUF files) and the model registry do file I/O
+        return JSONResponse(await run_in_threadpool(server.memory_status_payload))
+
+    async def queue_status(request):
+        return JSONResponse(server.queue_status_payload())
+
+    async def metrics(request):
+        # The page-cache gauge runs mincore over the model file
+        return Response(await run_in_threadpool(server.REGISTRY.render), media_type=CONTENT_TYPE)
+
+    async def samples(request):
+        limit = int(request.query_params.get("limit", 50))
+        loop = asyncio.get_running_loop()
+        payload, status = await loop.run_in_executor(db_executor, server.samples_payload, limit)
+        return JSONResponse(payload, status_code=status)
+
+    routes = [
+        Route("/", root, methods=["GET"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/memory_status", memory_status, methods=["GET"]),
+        Route("/queue_status", queue_status, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route("/samples", samples, methods=["GET"]),
+        # Everything else (generation, learning, storage, profile) keeps its Flask handler
+        Mount("/", app=WSGIMiddleware(server.app, workers=WSGI_WORKERS)),
+    ]
+    # Same open CORS policy as CORS(app) in local-server.py
+    middleware = [Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])]
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        db_executor.shutdown(wait=False)
+
+    return Starlette(routes=routes, middleware=middleware, lifespan=lifespan)
+
+def serve(server):
+    print(f"⚡ ASGI runtime: async status routes, {WSGI_WORKERS} threads for Flask routes")
+    uvicorn.run(create_app(server), host=HOST, port=PORT, log_level="warning")
+
+if __name__ == "__main__":
+    sys.path.insert(0, str(BASE))
+    spec = importlib.util.spec_from_file_location("local_server", BASE / "local-server.py")
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    server.start_server(lambda: serve(server))
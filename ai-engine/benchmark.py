@@ -0,0 +1,348 @@
+# benchmark.py
+"""
+Latency and throughput benchmark for the generation path.
+
+Replays a corpus of sample emails through the real /generate pipeline
+(queue, prompt building, model call, cleanup and fallback) and reports
+cold-load time, time-to-first-token, tokens/sec, latency percentiles and
+peak RSS. Use --stub to run without a GGUF file.
+
+    python benchmark.py --stub --requests 30 --concurrency 2
+    python benchmark.py --profile throughput --json results.json
+    python benchmark.py --speculative   # prompt-lookup drafting, reports acceptance rate
+"""
+import argparse, contextlib, importlib.util, json, os, sys, tempfile, threading, time, types
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import psutil
+
+BASE = Path(__file__).resolve().parent
+
+SAMPLE_EMAILS = [
+    "Hi, can we reschedule our meeting on Thursday to sometime next week? My calendar is packed.",
+    "Thank you so much for your help with the quarterly report, I really appreciate the extra effort.",
+    "This is urgent - the production server is down and we need your approval asap to roll back.",
+    "Quick question: could you clarify which budget line the new laptops should be charged to?",
+    "Just checking in on the status of the contract review. Any progress since last week?",
+    "Sorry for the mix-up with the invoice yesterday, that was my mistake. Can you resend it?",
+    "Hey! Are you free for lunch on Friday? There's a new place downtown I want to try.",
+    "Dear team, please find attached the agenda for Monday's planning session. Kindly review before then.",
+    "Can you confirm that the shipment left the warehouse? The customer is asking for verification.",
+    "I wanted to follow up on my application for the analyst role and see if there are any updates.",
+]
+
+class StubLlama:
+    """Stand-in for llama_cpp.Llama with configurable load, prompt-eval and per-token costs"""
+    reply = "Thanks for reaching out. I will look into this and get back to you with an update by tomorrow afternoon."
+    load_ms = 1500
+    prompt_ms_per_token = 2.0
+    token_ms = 40.0
+    
+    def __init__(self, model_path=None, n_ctx=256, draft_model=None, **kwargs):
+        time.sleep(self.load_ms / 1000)
+        self._n_ctx = n_ctx
+        self._input_ids = []
+        self.draft_model = draft_model
+    
+    def n_ctx(self):
+        return self._n_ctx
+    
+    def tokenize(self, text, add_bos=True, special=False):
+        if isinstance(text, bytes):
+            text = text.decode("utf-8", "ignore")
+        return [hash(w) & 0xFFFF for w in text.split()]
+    
+    def detokenize(self, tokens):
+        return b" ".join(b"tok" for _ in tokens)
+    
+    def reset(self):
+        self._input_ids = []
+    
+    def eval(self, tokens):
+        time.sleep(len(tokens) * self.prompt_ms_per_token / 1000)
+        self._input_ids = list(self._input_ids) + list(tokens)
+    
+    def save_state(self):
+        return types.SimpleNamespace(ids=list(self._input_ids), llama_state_size=len(self._input_ids) * 1024)
+    
+    def load_state(self, state):
+        self._input_ids = list(state.ids)
+    
+    def _evaluate_prompt(self, prompt):
+        tokens = self.tokenize(prompt)
+        shared = 0
+        for a, b in zip(self._input_ids, tokens):
+            if a != b:
+                break
+            shared += 1
+        time.sleep((len(tokens) - shared) * self.prompt_ms_per_token / 1000)
+        self._input_ids = tokens
+    
+    def __call__(self, prompt, max_tokens=50, stream=False, **kwargs):
+        self._evaluate_prompt(prompt)
+        words = self.reply.split(" ")[:max_tokens]
+        if stream:
+            return self._stream(words) if self.draft_model is None else self._stream_speculative(prompt, words)
+        time.sleep(len(words) * self.token_ms / 1000)
+        return {"choices": [{"text": " " + " ".join(words), "finish_reason": "stop"}]}
+    
+    def _stream(self, words):
+        for w in words:
+            time.sleep(self.token_ms / 1000)
+            yield {"choices": [{"text": " " + w, "finish_reason": None}]}
+    
+    def _stream_speculative(self, prompt, words):
+        """One forward pass per step: it verifies the drafted tokens and samples one more"""
+        produced = self.tokenize(prompt)
+        i = 0
+        while i < len(words):
+            draft = list(self.draft_model(produced))
+            time.sleep(self.token_ms / 1000)
+            accepted = 0
+            while accepted < len(draft) and i + accepted < len(words) and draft[accepted] == self.tokenize(words[i + accepted])[0]:
+                accepted += 1
+            for w in words[i:i + accepted + 1]:
+                produced += self.tokenize(w)
+                yield {"choices": [{"text": " " + w, "finish_reason": None}]}
+            i += accepted + 1
+
+class StubPromptLookup:
+    """Stand-in for llama_cpp's LlamaPromptLookupDecoding: propose the tokens that followed the latest n-gram earlier in the input"""
+    def __init__(self, max_ngram_size=2, num_pred_tokens=10):
+        self.max_ngram_size = max_ngram_size
+        self.num_pred_tokens = num_pred_tokens
+    
+    def __call__(self, input_ids, **kwargs):
+        ids = list(input_ids)
+        for n in range(min(self.max_ngram_size, len(ids) - 1), 0, -1):
+            tail = ids[-n:]
+            for start in range(len(ids) - n - 1, -1, -1):
+                if ids[start:start + n] == tail:
+                    return ids[start + n:start + n + self.num_pred_tokens]
+        return []
+
+def load_server(stub):
+    """Import local-server.py (not importable by name) with an isolated personalization DB"""
+    if not os.environ.get("GMAIL_AI_DB_PATH"):
+        os.environ["GMAIL_AI_DB_PATH"] = str(Path(tempfile.mkdtemp(prefix="svarx-bench-")) / "personalization.db")
+    sys.path.insert(0, str(BASE))
+    if stub:
+        sys.modules["llama_cpp"] = types.SimpleNamespace(Llama=StubLlama)
+        sys.modules["llama_cpp.llama_speculative"] = types.SimpleNamespace(LlamaPromptLookupDecoding=StubPromptLookup)
+    spec = importlib.util.spec_from_file_location("local_server", BASE / "local-server.py")
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    if stub:
+        server.model_exists = lambda path=None: True
+    return server
+
+def load_corpus(path):
+    """A JSON list of strings, or one email per line"""
+    if not path:
+        return SAMPLE_EMAILS
+    text = Path(path).read_text(encoding="utf8")
+    try:
+        emails = json.loads(text)
+    except ValueError:
+        emails = [line.strip() for line in text.splitlines()]
+    return [e for e in emails if isinstance(e, str) and e.strip()]
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return round(ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo), 4)
+
+class RSSSampler:
+    """Track peak resident memory of this process in a background thread"""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    
+    def _run(self):
+        process = psutil.Process()
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process.memory_info().rss)
+            time.sleep(self.interval)
+    
+    def __enter__(self):
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def parse_sse(body):
+    """Split an SSE body into (event, payload) pairs"""
+    events = []
+    for frame in body.split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in frame.splitlines() if ": " in line)
+        if "event" in lines:
+            events.append((lines["event"], json.loads(lines.get("data", "{}"))))
+    return events
+
+def run_one(server, email, endpoint, use_cache):
+    """Send one request through the Flask app; return a result record"""
+    client = server.app.test_client()
+    body = {"email_text": email, "tone": "professional", "length": "medium", "regenerate": not use_cache}
+    t0 = time.perf_counter()
+    result = {"status": None, "latency": None, "ttft": None, "tokens": 0, "from_model": False}
+    
+    if endpoint == "stream":
+        resp = client.post("/generate_stream", json=body, buffered=False)
+        result["status"] = resp.status_code
+        payload = {}
+        for chunk in resp.response:
+            text = chunk.decode("utf8") if isinstance(chunk, bytes) else chunk
+            for event, data in parse_sse(text):
+                if event == "token":
+                    if result["ttft"] is None:
+                        result["ttft"] = time.perf_counter() - t0
+                    result["tokens"] += 1
+                elif event == "done":
+                    payload = data
+        resp.close()
+    else:
+        path = "/generate_batch" if endpoint == "batch" else "/generate"
+        resp = client.post(path, json=body)
+        result["status"] = resp.status_code
+        payload = resp.get_json() or {}
+        replies = payload.get("replies") or [payload.get("reply") or ""]
+        result["tokens"] = sum(len(r.split()) for r in replies)  # Word count approximates tokens
+    
+    result["latency"] = time.perf_counter() - t0
+    result["from_model"] = bool(payload.get("from_model"))
+    result["queue_wait"] = (payload.get("meta") or {}).get("queue_wait")
+    return result
+
+def run_benchmark(args):
+    if args.stub:
+        StubLlama.load_ms = args.stub_load_ms
+        StubLlama.token_ms = args.stub_token_ms
+    if args.profile:
+        os.environ["GMAIL_AI_PROFILE"] = args.profile
+    if args.speculative is not None:
+        os.environ["GMAIL_AI_SPECULATIVE"] = "prompt_lookup" if args.speculative else "off"
+    server = load_server(args.stub)
+    server.app.logger.disabled = True
+    corpus = load_corpus(args.corpus)
+    emails = [corpus[i % len(corpus)] for i in range(args.requests)]
+    
+    with RSSSampler() as rss:
+        # Cold load, timed directly
+        server.SCHEDULER.run(lambda job: server.unload_model())
+        t0 = time.perf_counter()
+        loaded = server.SCHEDULER.run(lambda job: server.load_model(), timeout=600)
+        cold_load = time.perf_counter() - t0
+        if not loaded:
+            print("❌ Model failed to load (use --stub to benchmark without a GGUF file)")
+        
+        # Warm-up request so first-request effects don't skew percentiles
+        for _ in range(args.warmup):
+            run_one(server, corpus[0], args.endpoint, args.use_cache)
+        
+        spec_before = server.SPECULATION.status()
+        t_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda e: run_one(server, e, args.endpoint, args.use_cache), emails))
+        wall = time.perf_counter() - t_start
+        spec_after = server.SPECULATION.status()
+    
+    latencies = [r["latency"] for r in results if r["status"] == 200]
+    ttfts = [r["ttft"] for r in results if r["ttft"] is not None]
+    waits = [r["queue_wait"] for r in results if r["queue_wait"] is not None]
+    total_tokens = sum(r["tokens"] for r in results)
+    gen_time = sum(r["latency"] - (r["ttft"] or 0) for r in results if r["tokens"])
+    drafted = spec_after["drafted"] - spec_before["drafted"]
+    accepted = spec_after["accepted"] - spec_before["accepted"]
+    
+    return {
+        "config": {
+            "stub": args.stub,
+            "profile": server.ACTIVE_PROFILE,
+            "settings": server.get_profile(),
+            "speculative": server.SPECULATIVE_MODE,
+            "endpoint": args.endpoint,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "use_cache": args.use_cache,
+            "corpus_size": len(corpus),
+        },
+        "cold_load_s": round(cold_load, 4),
+        "model_loaded": bool(loaded),
+        "wall_time_s": round(wall, 4),
+        "requests_per_s": round(len(results) / wall, 3) if wall else None,
+        "tokens_per_s": round(total_tokens / gen_time, 2) if gen_time else None,
+        "latency_s": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "p99": percentile(latencies, 99), "max": round(max(latencies), 4) if latencies else None},
+        "ttft_s": {"p50": percentile(ttfts, 50), "p95": percentile(ttfts, 95), "p99": percentile(ttfts, 99)},
+        "queue_wait_s": {"p50": percentile(waits, 50), "p95": percentile(waits, 95)},
+        "from_model": sum(1 for r in results if r["from_model"]),
+        "fallbacks": sum(1 for r in results if r["status"] == 200 and not r["from_model"]),
+        "rejected": sum(1 for r in results if r["status"] == 503),
+        "peak_rss_mb": round(rss.peak / 1024 / 1024, 1),
+        "speculative": {
+            "drafted": drafted,
+            "accepted": accepted,
+            "acceptance_rate": round(accepted / drafted, 3) if drafted else None,
+        },
+    }
+
+def print_report(report):
+    print("=" * 60)
+    print(f"📊 svarx.ai generation benchmark ({report['config']['profile']} profile{', stub model' if report['config']['stub'] else ''})")
+    print("=" * 60)
+    print(f"   Cold load:        {report['cold_load_s']:.2f}s")
+    print(f"   Requests:         {report['config']['requests']} @ concurrency {report['config']['concurrency']} ({report['config']['endpoint']})")
+    print(f"   Throughput:       {report['requests_per_s']} req/s, {report['tokens_per_s']} tokens/s")
+    lat, ttft = report["latency_s"], report["ttft_s"]
+    print(f"   Latency:          p50 {lat['p50']}s  p95 {lat['p95']}s  p99 {lat['p99']}s")
+    print(f"   First token:      p50 {ttft['p50']}s  p95 {ttft['p95']}s  p99 {ttft['p99']}s")
+    print(f"   Model / fallback: {report['from_model']} / {report['fallbacks']} (rejected {report['rejected']})")
+    print(f"   Peak RSS:         {report['peak_rss_mb']}MB")
+    if report["config"]["speculative"] != "off":
+        spec = report["speculative"]
+        rate = f"{spec['acceptance_rate']:.1%}" if spec["acceptance_rate"] is not None else "n/a"
+        print(f"   Speculative:      {rate} of {spec['drafted']} drafted tokens accepted")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the svarx.ai generation path")
+    parser.add_argument("--requests", type=int, default=20, help="number of requests to replay")
+    parser.add_argument("--concurrency", type=int, default=1, help="parallel clients")
+    parser.add_argument("--endpoint", choices=["stream", "generate", "batch"], default="stream")
+    parser.add_argument("--corpus", help="JSON list or one-email-per-line file (default: built-in samples)")
+    parser.add_argument("--profile", help="inference profile to benchmark")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed warm-up requests")
+    parser.add_argument("--use-cache", action="store_true", help="allow response cache hits")
+    parser.add_argument("--speculative", action=argparse.BooleanOptionalAction, default=None,
+                        help="force prompt-lookup speculative decoding on or off (default: server setting)")
+    parser.add_argument("--stub", action="store_true", help="use a stub model instead of the GGUF file")
+    parser.add_argument("--stub-load-ms", type=float, default=StubLlama.load_ms)
+    parser.add_argument("--stub-token-ms", type=float, default=StubLlama.token_ms)
+    parser.add_argument("--json", metavar="PATH", help="write the machine-readable report ('-' for stdout)")
+    args = parser.parse_args(argv)
+    
+    if args.json == "-":
+        # Keep stdout for the JSON document: server and database diagnostics go to stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            report = run_benchmark(args)
+    else:
+        report = run_benchmark(args)
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+        if args.json:
+            with open(args.json, "w", encoding="utf8") as f:
+                json.dump(report, f, indent=2)
+            print(f"💾 Report written to {args.json}")
+    return report
+
+if __name__ == "__main__":
+    main()
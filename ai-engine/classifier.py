@@ -0,0 +1,71 @@
+# classifier.py
+"""
+Keyword email classifier shared by prompt building, template replies and
+passive learning.
+
+Every keyword is compiled into one alternation regex, so a single scan of the
+lowered text finds all categories that fire; fixed precedence rules then pick
+the email type, urgency and formality.
+"""
+import re
+
+# Email types in precedence order (first match wins); stems match at the start of a word
+EMAIL_TYPE_KEYWORDS = [
+    ("scheduling", ["meeting", "schedule", "resched", "calendar", "appointment"]),
+    ("gratitude", ["thank", "appreciate", "grateful"]),
+    ("urgent", ["urgent", "asap", "immediate", "priority"]),
+    ("inquiry", ["question", "clarif", "explain", "help"]),
+    ("confirmation", ["confirm", "verif"]),
+    ("update_request", ["update", "status", "progress", "report"]),
+    ("apology", ["sorry", "apolog", "mistake"]),
+]
+EMAIL_TYPES = [email_type for email_type, _ in EMAIL_TYPE_KEYWORDS] + ["general"]
+
+# Formality markers are whole words ("hi" must not fire on "this")
+FORMAL_WORDS = ["dear", "sincerely", "regards", "please", "kindly", "would you"]
+CASUAL_WORDS = ["hey", "hi", "thanks", "sure", "ok", "cool"]
+
+def _compile():
+    labels = {}  # keyword -> set of labels
+    whole_words = set(FORMAL_WORDS + CASUAL_WORDS)
+    for email_type, stems in EMAIL_TYPE_KEYWORDS:
+        for stem in stems:
+            labels.setdefault(stem, set()).add(email_type)
+    for word in FORMAL_WORDS:
+        labels.setdefault(word, set()).add("formal")
+    for word in CASUAL_WORDS:
+        labels.setdefault(word, set()).add("casual")
+    # "thanks" is both a gratitude stem hit and a casual word
+    for word in whole_words:
+        for stem, stem_labels in list(labels.items()):
+            if stem not in whole_words and word.startswith(stem):
+                labels[word] |= stem_labels
+
+    # Longest first, so "thanks" wins over "thank" at the same position
+    keywords = sorted(labels, key=len, reverse=True)
+    groups = {}
+    parts = []
+    for i, keyword in enumerate(keywords):
+        name = f"k{i}"
+        groups[name] = frozenset(labels[keyword])
+        suffix = r"\b" if keyword in whole_words else ""
+        parts.append(f"(?P<{name}>{re.escape(keyword)}{suffix})")
+    return re.compile(r"\b(?:" + "|".join(parts) + ")"), groups
+
+_PATTERN, _GROUP_LABELS = _compile()
+
+def classify(text):
+    """{"email_type", "urgency", "formality", "matched"} for one email"""
+    hits = {}
+    for match in _PATTERN.finditer((text or "").lower()):
+        for label in _GROUP_LABELS[match.lastgroup]:
+            hits.setdefault(label, set()).add(match.group())
+
+    email_type = next((t for t in EMAIL_TYPES[:-1] if t in hits), "general")
+    formal, casual = len(hits.get("formal", ())), len(hits.get("casual", ()))
+    return {
+        "email_type": email_type,
+        "urgency": "high" if "urgent" in hits else "normal",
+        "formality": "high" if formal > casual else "low" if casual > formal else "medium",
+        "matched": sorted(label for label in hits if label in EMAIL_TYPES),
+    }
@@ -1,18 +1,171 @@
 # local-server.py
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
-import time, threading, os, gc, psutil
-from model_manager import model_exists, model_path_str, get_model_path
-from personalization import add_sample, list_samples, build_style_summary, clear_samples
-from threading import Lock
+import time, threading, os, sys, gc, psutil, json, queue, itertools, re, select, socket, uuid
+from model_manager import model_exists, model_path_str, discover_models, resolve_model_path, page_cache_status, page_cache_residency, DEFAULT_MODEL, PREFETCHER
+from metrics import REGISTRY, CONTENT_TYPE
+from classifier import classify
+from personalization import list_samples, build_style_summary, clear_samples, sanitize_text, get_personalization_version, WRITER, MAINTENANCE, EXAMPLES
 import traceback
+import hashlib
+from collections import OrderedDict, deque
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
-LLAMA = None
-LOCK = Lock()
-DEFAULT_TEMPERATURE = float(os.environ.get("GMAIL_AI_TEMPERATURE", 0.25))
-N_THREADS = int(os.environ.get("GMAIL_AI_THREADS", 4))
+LLAMA = None          # Model the inference worker is currently generating with
+ACTIVE_MODEL = None   # Registry name (GGUF file stem) of LLAMA
+RESIDENT = OrderedDict()  # name -> loaded Llama, least recently used first
+
+# Metrics exported on /metrics
+STAGE_SECONDS = REGISTRY.histogram(
+    "svarx_stage_seconds", "Time spent in each generation stage", ["stage"])
+FALLBACKS = REGISTRY.counter(
+    "svarx_fallbacks_total", "Template replies served instead of model output, by reason", ["reason"])
+REQUESTS = REGISTRY.counter(
+    "svarx_requests_total", "Generation requests received, by endpoint", ["endpoint"])
+INSTANT_REPLIES = REGISTRY.counter(
+    "svarx_instant_replies_total", "First-phase replies of two-phase requests, by source", ["source"])
+
+DEFAULT_TEMPERATURE = float(os.environ.get("GMAIL_AI_TEMPERATURE", 0.5))
+N_THREADS = int(os.environ["GMAIL_AI_THREADS"]) if os.environ.get("GMAIL_AI_THREADS") else None  # Overrides the profile
+
+# Inference profiles: llama settings plus process priority/affinity
+CPU_COUNT = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+INFERENCE_PROFILES = {
+    # Ultra power-saving: 5% CPU, <500MB RAM when idle, single-core processing
+    "battery": {"n_ctx": 256, "n_threads": 1, "n_batch": 32, "cores": 1, "priority": "idle"},
+    # Half the physical cores at slightly reduced priority
+    "balanced": {"n_ctx": 512, "n_threads": max(1, CPU_COUNT // 2), "n_batch": 128, "cores": max(1, CPU_COUNT // 2), "priority": "below_normal"},
+    # All cores at normal priority for the fastest replies
+    "throughput": {"n_ctx": 1024, "n_threads": CPU_COUNT, "n_batch": 512, "cores": None, "priority": "normal"},
+}
+DEFAULT_PROFILE = "battery"
+CONFIG_PATH = os.path.join(os.path.expanduser("~"), ".svarx-ai-config.json")  # Shared with the launcher
+
+def read_config():
+    """The whole config file, or {} when it is missing or unreadable"""
+    try:
+        with open(CONFIG_PATH, "r") as f:
+            config = json.load(f)
+        return config if isinstance(config, dict) else {}
+    except Exception:
+        return {}
+
+def load_config_value(key, default=None):
+    """One setting from the config file"""
+    value = read_config().get(key)
+    return default if value is None else value
+
+def save_config_value(key, value):
+    """Persist one setting in the config file, keeping the launcher's keys"""
+    config = read_config()
+    config[key] = value
+    try:
+        with open(CONFIG_PATH, "w") as f:
+            json.dump(config, f, indent=2)
+    except Exception as e:
+        app.logger.warning(f"Could not save {key}: {e}")
+
+def load_profile_name():
+    """Profile from GMAIL_AI_PROFILE, then the config file, then the default"""
+    name = os.environ.get("GMAIL_AI_PROFILE") or load_config_value("inference_profile")
+    return name if name in INFERENCE_PROFILES else DEFAULT_PROFILE
+
+def save_profile_name(name):
+    """Persist the profile choice in the config file"""
+    save_config_value("inference_profile", name)
+
+ACTIVE_PROFILE = load_profile_name()
+
+# Model selection: requests may name a model; otherwise each reply length can map to its own
+# (e.g. a tiny model for short replies). Unmapped lengths use the default model.
+MAX_RESIDENT_MODELS = max(1, int(os.environ.get("GMAIL_AI_MAX_MODELS", 2)))  # Loaded models kept before evicting the LRU one
+REPLY_LENGTHS = ("short", "medium", "long")
+
+def load_length_models():
+    """Length -> model name from GMAIL_AI_MODEL_<LENGTH>, then the config file"""
+    configured = load_config_value("length_models", {})
+    return {
+        length: os.environ.get(f"GMAIL_AI_MODEL_{length.upper()}") or configured.get(length)
+        for length in REPLY_LENGTHS
+    }
+
+LENGTH_MODELS = load_length_models()
+
+# Speculative decoding: prompt-lookup drafting proposes the tokens that followed the latest
+# n-gram earlier in the prompt (replies often echo the email) and the model verifies them in one batch
+SPECULATIVE_MODES = ("off", "prompt_lookup")
+DRAFT_TOKENS = int(os.environ.get("GMAIL_AI_DRAFT_TOKENS", 4))  # Tokens proposed per verification batch
+
+def load_speculative_mode():
+    """Mode from GMAIL_AI_SPECULATIVE, then the config file, then off"""
+    mode = os.environ.get("GMAIL_AI_SPECULATIVE") or load_config_value("speculative_decoding")
+    return mode if mode in SPECULATIVE_MODES else "off"
+
+SPECULATIVE_MODE = load_speculative_mode()
+
+class SpeculationStats:
+    """Draft acceptance accounting for speculative decoding.
+    
+    llama-cpp does not report accepted drafts, so they are estimated: every verification
+    batch yields one sampled token plus the drafts it accepted.
+    """
+    def __init__(self):
+        self.steps = 0      # Drafter calls, one per verification batch
+        self.drafted = 0    # Tokens proposed
+        self.generated = 0  # Tokens produced while drafting
+        self.accepted = 0
+    
+    def drafter(self, draft_model):
+        """Wrap a llama-cpp draft model so its proposals are counted"""
+        def propose(input_ids, **kwargs):
+            tokens = draft_model(input_ids, **kwargs)
+            self.steps += 1
+            self.drafted += len(tokens)
+            return tokens
+        return propose
+    
+    def mark(self):
+        return self.steps, self.drafted
+    
+    def record(self, mark, generated):
+        """Account one completion (started at mark()) that produced `generated` tokens"""
+        steps, drafted = self.steps - mark[0], self.drafted - mark[1]
+        if steps:
+            self.generated += generated
+            self.accepted += min(drafted, max(0, generated - steps))
+    
+    def status(self):
+        return {
+            "mode": SPECULATIVE_MODE,
+            "draft_tokens": DRAFT_TOKENS,
+            "steps": self.steps,
+            "drafted": self.drafted,
+            "accepted": self.accepted,
+            "acceptance_rate": round(self.accepted / self.drafted, 3) if self.drafted else None,
+            "tokens_per_step": round(self.generated / self.steps, 2) if self.steps else None,
+        }
+
+SPECULATION = SpeculationStats()
+
+def make_drafter():
+    """Drafter for Llama(draft_model=...), or None when speculation is off or unsupported"""
+    if SPECULATIVE_MODE != "prompt_lookup":
+        return None
+    try:
+        from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+    except ImportError:
+        app.logger.warning("llama-cpp-python has no prompt-lookup decoding, generating without it")
+        return None
+    return SPECULATION.drafter(LlamaPromptLookupDecoding(num_pred_tokens=DRAFT_TOKENS))
+
+def get_profile(name=None):
+    """Settings of the active (or named) profile; GMAIL_AI_THREADS overrides the thread count"""
+    name = name or ACTIVE_PROFILE
+    profile = dict(INFERENCE_PROFILES[name], name=name)
+    if N_THREADS:
+        profile["n_threads"] = N_THREADS
+    return profile
 
 # Memory management variables
 LAST_USED = 0
@@ -21,97 +174,685 @@ MODEL_LOADED = False
 MAX_IDLE_MEMORY_MB = 500  # Maximum memory when idle (500MB limit)
 MAX_IDLE_CPU_PERCENT = 5  # Maximum CPU usage when idle (5% limit)
 
-# Power management
-def set_low_power_mode():
-    """Set process to ultra-low power mode - 5% CPU, <500MB RAM"""
-    try:
-        process = psutil.Process()
+# Adaptive residency: keep the model loaded while another request is likely soon
+MAX_RESIDENT_SECONDS = int(os.environ.get("GMAIL_AI_MAX_RESIDENT", 600))  # Hard cap on idle residency
+RESIDENCY_HORIZON = 60        # Look-ahead window (seconds) for the next-request prediction
+RESIDENCY_THRESHOLD = 0.3     # Keep resident while P(request within horizon) is at least this
+MEMORY_PRESSURE_PERCENT = 85  # System RAM usage at which we fall back to the hard idle timeout
+PREWARM_JOB = None  # Latest /prewarm load job; a new one is queued once it is done in any state
+
+class ResidencyPolicy:
+    """Learns inter-request gaps and decides when an idle model should be unloaded"""
+    def __init__(self, max_gaps=200):
+        self.gaps = deque(maxlen=max_gaps)
+        self.last_request = 0
+        self.prewarm_until = 0
+    
+    def record_request(self):
+        now = time.time()
+        if self.last_request:
+            self.gaps.append(now - self.last_request)
+        self.last_request = now
+    
+    def hint(self):
+        """A compose box opened - a request is very likely shortly"""
+        self.prewarm_until = time.time() + 2 * RESIDENCY_HORIZON
+    
+    def next_request_probability(self, idle_time):
+        """Empirical P(next request within the horizon | already idle for idle_time)"""
+        if time.time() < self.prewarm_until:
+            return 1.0
+        survivors = [g for g in self.gaps if g > idle_time]
+        if len(self.gaps) < 5 or not survivors:
+            return 0.0
+        soon = sum(1 for g in survivors if g <= idle_time + RESIDENCY_HORIZON)
+        return soon / len(survivors)
+    
+    @staticmethod
+    def memory_pressure():
+        try:
+            return psutil.virtual_memory().percent >= MEMORY_PRESSURE_PERCENT
+        except Exception:
+            return False
+    
+    def should_unload(self, idle_time):
+        if idle_time <= IDLE_TIMEOUT:
+            return False
+        # Under memory pressure the original 60s / <500MB idle target applies
+        if self.memory_pressure() or idle_time > MAX_RESIDENT_SECONDS:
+            return True
+        return self.next_request_probability(idle_time) < RESIDENCY_THRESHOLD
+    
+    def status(self, idle_time):
+        return {
+            "observed_gaps": len(self.gaps),
+            "median_gap": round(sorted(self.gaps)[len(self.gaps) // 2], 1) if self.gaps else None,
+            "next_request_probability": round(self.next_request_probability(idle_time), 3),
+            "memory_pressure": self.memory_pressure(),
+            "prewarm_active": time.time() < self.prewarm_until,
+        }
+
+RESIDENCY = ResidencyPolicy()
+
+# Page-cache prefetch: read a model that is about to load from disk on a low-priority thread,
+# so llama.cpp's mmap finds the weights cached instead of faulting them in one by one
+PREFETCH_ENABLED = os.environ.get("GMAIL_AI_PREFETCH", "1") != "0"
+
+def prefetch_for_load(name=None):
+    """Start prefetching a model a request is about to load; no-op if it is resident or RAM is short"""
+    name = name or DEFAULT_MODEL
+    if not PREFETCH_ENABLED or name in RESIDENT or RESIDENCY.memory_pressure():
+        return False
+    path = resolve_model_path(name)
+    if path is None or not model_exists(path):
+        return False
+    if PREFETCHER.prefetch(path):
+        app.logger.info(f"📀 Prefetching {name} into the page cache")
+        return True
+    return False
+
+def page_cache_payload():
+    """Page-cache share of the default and resident models, plus prefetch activity"""
+    models = {}
+    for name in dict.fromkeys([DEFAULT_MODEL] + list(RESIDENT)):
+        path = resolve_model_path(name)
+        if path is not None and model_exists(path):
+            models[name] = page_cache_status(path)
+    return {"enabled": PREFETCH_ENABLED, "models": models, "prefetch": PREFETCHER.status()}
+
+# Optional warm-up on server start: load the default model and page in its weights before the first request
+WARMUP_TOKENS = 8          # Tokens generated by the throwaway warm-up prompt
+DEFAULT_LOAD_SECONDS = 15  # Load time estimate until a load has been timed
+WARMUP_EMAIL = "Hi, could you send me a quick update on the project when you get a chance? Thanks!"
+
+def load_warmup_enabled():
+    """Warm-up from --warmup, then GMAIL_AI_WARMUP, then the config file, then off.
+    
+    Read at import, so the flag works with either entry point (local-server.py or asgi_server.py).
+    """
+    if "--warmup" in sys.argv:
+        return True
+    value = os.environ.get("GMAIL_AI_WARMUP")
+    if value is None:
+        return bool(load_config_value("warmup_on_start", False))
+    return value.lower() in ("1", "true", "yes", "on")
+
+WARMUP_ON_START = load_warmup_enabled()
+
+class ModelReadiness:
+    """State of the active model: absent -> loading -> warming -> ready -> unloading -> absent.
+    
+    llama-cpp reports no load progress, so loading progress is estimated from the
+    duration of the previous load; warming progress counts warm-up tokens.
+    """
+    STATES = ("absent", "loading", "warming", "ready", "unloading")
+    LOAD_SHARE = 0.8  # Share of overall progress taken by loading
+    
+    def __init__(self):
+        self.state = "absent"
+        self.model = None
+        self.since = time.time()
+        self.load_seconds = None
+        self.warm_tokens = 0
+        self._lock = threading.Lock()
+    
+    def set(self, state, model=None):
+        with self._lock:
+            if state == "loading" and self.state == "loading" and model == self.model:
+                return
+            if state == "ready" and self.state == "loading":
+                self.load_seconds = time.time() - self.since
+            self.state = state
+            self.model = model if model is not None or state == "absent" else self.model
+            self.since = time.time()
+            self.warm_tokens = 0
+    
+    def token(self):
+        self.warm_tokens += 1
+    
+    def progress(self):
+        """(fraction done, estimated seconds left) of getting to ready"""
+        elapsed = time.time() - self.since
+        expected = self.load_seconds or DEFAULT_LOAD_SECONDS
+        if self.state == "loading":
+            return min(0.95, elapsed / expected) * self.LOAD_SHARE, max(0.0, expected - elapsed)
+        if self.state == "warming":
+            done = min(1.0, self.warm_tokens / WARMUP_TOKENS)
+            return self.LOAD_SHARE + done * (1 - self.LOAD_SHARE), None
+        return (1.0, 0.0) if self.state == "ready" else (0.0, None)
+    
+    def status(self):
+        progress, eta = self.progress()
+        return {
+            "state": self.state,
+            "model": self.model,
+            "progress": round(progress, 3),
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "seconds_in_state": round(time.time() - self.since, 1),
+            "last_load_seconds": round(self.load_seconds, 2) if self.load_seconds else None,
+            "warmup_on_start": WARMUP_ON_START,
+        }
+
+READINESS = ModelReadiness()
+
+# Template prefix KV states kept per loaded model (see PrefixStateCache)
+PREFIX_CACHE_MAX_MB = float(os.environ.get("GMAIL_AI_PREFIX_CACHE_MB", 64))
+
+# Response cache for repeated requests on the same thread
+RESPONSE_CACHE_SIZE = int(os.environ.get("GMAIL_AI_RESPONSE_CACHE_SIZE", 128))
+RESPONSE_CACHE_TTL = float(os.environ.get("GMAIL_AI_RESPONSE_CACHE_TTL", 1800))  # 30 minutes
+
+# Two-phase requests: instant reply now, model reply collected later from /result/<request_id>
+PENDING_MAX = 32           # Model replies kept for collection
+PENDING_TTL = 300          # Seconds a model reply stays collectable
+RESULT_MAX_WAIT = 10       # Longest /result long-poll, in seconds
+INSTANT_REUSE_SCORE = 0.6  # Similarity at which a past reply is reused as the instant reply
+
+# Inference scheduling
+QUEUE_MAX_SIZE = int(os.environ.get("GMAIL_AI_QUEUE_SIZE", 4))  # Pending /generate requests before we shed load
+REQUEST_DEADLINE = float(os.environ.get("GMAIL_AI_REQUEST_DEADLINE", 30))  # Matches the extension's TIMEOUT_MS
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+CANCEL_POLL_INTERVAL = 0.25  # Seconds between client-disconnect checks while a request waits
+STOP_GRACE = 1.0  # Seconds a request waits for a stopped job to hand back partial results
+
+class QueueFullError(Exception):
+    """Raised when the inference queue cannot accept another request"""
+
+class InferenceJob:
+    """A unit of work executed by the inference worker"""
+    def __init__(self, fn, deadline, priority, request_id=None):
+        self.fn = fn
+        self.deadline = deadline
+        self.priority = priority
+        self.request_id = request_id
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.result = None
+        self.error = None
+        self.expired = False
+        self.abandoned = False
+        self.cancelled = False  # The client gave up (/cancel or disconnect)
+        self.timed_out = False  # The server gave up (deadline, uncollected result)
+        self.done = threading.Event()
+        self.events = queue.Queue()  # Streaming jobs push SSE frames here, None marks the end
+    
+    @property
+    def wait_time(self):
+        return round((self.started_at or time.time()) - self.enqueued_at, 3)
+    
+    def cancel(self, reason="cancelled"):
+        """Nobody wants the result: skip the job if queued, stop generating if running.
         
-        # Set to lowest possible CPU priority for background processing
-        if hasattr(psutil, 'IDLE_PRIORITY_CLASS'):
-            process.nice(psutil.IDLE_PRIORITY_CLASS)  # Lowest priority on Windows
-        elif hasattr(psutil, 'BELOW_NORMAL_PRIORITY_CLASS'):
-            process.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
+        reason is "cancelled" when the client gave up and "timed_out" when the server
+        did; they are counted as cancelled and expired respectively.
+        """
+        if reason == "timed_out":
+            self.timed_out = True
         else:
-            process.nice(19)  # Lowest priority on Unix
-        
-        # Limit to single CPU core for minimal power consumption
-        if hasattr(process, 'cpu_affinity'):
-            available_cpus = process.cpu_affinity()
-            if available_cpus:
-                process.cpu_affinity([available_cpus[0]])  # Use only first CPU core
-        
-        # Force garbage collection to minimize memory
-        import gc
-        gc.collect()
+            self.cancelled = True
+        self.abandoned = True
+    
+    @property
+    def stopped(self):
+        return self.cancelled or self.timed_out
+    
+    def should_stop(self, input_ids=None, logits=None):
+        """llama-cpp stopping criterion, checked at every token boundary"""
+        return self.stopped
+    
+    def wait(self, disconnected=None):
+        """Block until the job finishes or its deadline passes; returns True if it finished.
         
-        app.logger.info("🔋 Ultra-low power mode: Max 5% CPU, <500MB RAM")
+        A job past its deadline is stopped as timed out. disconnected, if given, is polled
+        while waiting and cancels the job as soon as it reports the client has gone away.
+        """
+        while True:
+            remaining = self.deadline - time.time()
+            step = remaining if disconnected is None else min(remaining, CANCEL_POLL_INTERVAL)
+            if self.done.wait(max(0, step)):
+                return True
+            if time.time() >= self.deadline:
+                self.cancel(reason="timed_out")
+                return False
+            if disconnected is not None and disconnected():
+                self.cancel()
+                return False
+
+class InferenceScheduler:
+    """Bounded priority queue drained by a single worker thread that owns LLAMA"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._jobs = {}  # request_id -> job, for /cancel
+        self.active = None
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "rejected": 0,
+            "expired": 0,
+            "cancelled": 0,
+            "total_wait": 0.0,
+            "max_wait": 0.0,
+            "total_service": 0.0,
+        }
+    
+    def depth(self):
+        return self._queue.qsize()
+    
+    def submit(self, fn, timeout=REQUEST_DEADLINE, priority=PRIORITY_INTERACTIVE, bounded=True, request_id=None):
+        """Queue fn(job) for the worker; raises QueueFullError when a bounded submit would overflow"""
+        with self._lock:
+            self._ensure_worker()
+            if bounded and self._queue.qsize() >= self.max_size:
+                self.stats["rejected"] += 1
+                raise QueueFullError(f"{self._queue.qsize()} requests already queued")
+            job = InferenceJob(fn, time.time() + timeout, priority, request_id)
+            if request_id:
+                self._jobs[request_id] = job
+            self._queue.put((priority, next(self._seq), job))
+            self.stats["submitted"] += 1
+        return job
+    
+    def cancel(self, request_id):
+        """Cancel a queued or running job by request id; returns False if it is unknown or already done"""
+        with self._lock:
+            job = self._jobs.pop(request_id, None)
+        if job is None or job.done.is_set():
+            return False
+        job.cancel()
+        return True
+    
+    def run(self, fn, timeout=REQUEST_DEADLINE, priority=PRIORITY_BACKGROUND):
+        """Run a control task (load/unload) on the worker and wait for its result"""
+        job = self.submit(fn, timeout=timeout, priority=priority, bounded=False)
+        if not job.wait():
+            raise TimeoutError("Inference worker busy")
+        if job.error:
+            raise job.error
+        return job.result
+    
+    def retry_after(self):
+        """Rough seconds until the queue drains, for the Retry-After header"""
+        completed = self.stats["completed"]
+        avg_service = self.stats["total_service"] / completed if completed else 5.0
+        return max(1, int(avg_service * (self.depth() + 1)))
+    
+    def status(self):
+        completed = self.stats["completed"]
+        return {
+            "depth": self.depth(),
+            "max_size": self.max_size,
+            "busy": self.active is not None,
+            "submitted": self.stats["submitted"],
+            "completed": completed,
+            "rejected": self.stats["rejected"],
+            "expired": self.stats["expired"],
+            "cancelled": self.stats["cancelled"],
+            "avg_wait": round(self.stats["total_wait"] / completed, 3) if completed else 0,
+            "max_wait": round(self.stats["max_wait"], 3),
+            "avg_service": round(self.stats["total_service"] / completed, 3) if completed else 0,
+        }
+    
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run_worker, name="inference-worker", daemon=True)
+            self._worker.start()
+    
+    def _run_worker(self):
+        while True:
+            _, _, job = self._queue.get()
+            
+            # Skip work nobody is waiting for anymore
+            if job.abandoned or time.time() > job.deadline:
+                job.expired = True
+                self.stats["cancelled" if job.cancelled else "expired"] += 1
+                self._finish(job)
+                continue
+            
+            job.started_at = time.time()
+            STAGE_SECONDS.observe(job.started_at - job.enqueued_at, stage="queue_wait")
+            self.active = job
+            try:
+                job.result = job.fn(job)
+            except Exception as e:
+                job.error = e
+            finally:
+                service = time.time() - job.started_at
+                wait = job.started_at - job.enqueued_at
+                self.stats["completed"] += 1
+                self.stats["total_wait"] += wait
+                self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+                self.stats["total_service"] += service
+                if job.cancelled:
+                    self.stats["cancelled"] += 1
+                elif job.timed_out:
+                    self.stats["expired"] += 1
+                self.active = None
+                self._finish(job)
+    
+    def _finish(self, job):
+        if job.request_id:
+            with self._lock:
+                if self._jobs.get(job.request_id) is job:
+                    del self._jobs[job.request_id]
+        job.events.put(None)
+        job.done.set()
+
+SCHEDULER = InferenceScheduler(QUEUE_MAX_SIZE)
+
+class ResponseCache:
+    """LRU + TTL cache of model replies keyed on normalized email, tone, length, model and personalization version"""
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (stored_at, payload)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def key(email_text, tone, length, model=None):
+        normalized = sanitize_text(email_text or "").lower()
+        raw = f"{get_personalization_version()}|{model or DEFAULT_MODEL}|{tone}|{length}|{normalized}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            payload = dict(entry[1])
+        payload["meta"] = dict(payload.get("meta") or {}, cached=True)
+        return payload
+    
+    def put(self, key, payload):
+        # Only model replies are worth keeping; fallbacks are instant anyway
+        if self.max_entries <= 0 or not payload.get("from_model"):
+            return
+        # Own copy of meta: callers go on to add per-request fields to theirs
+        entry = dict(payload, meta=dict(payload.get("meta") or {}))
+        with self._lock:
+            self._entries[key] = (time.time(), entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def status(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0,
+        }
+
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+class PendingReplies:
+    """Model jobs of two-phase requests, by request id, until the client collects them"""
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # request_id -> entry dict
+        self._lock = threading.Lock()
+    
+    def add(self, request_id, job, email_text, tone, length):
+        entry = {"job": job, "email_text": email_text, "tone": tone, "length": length, "created": time.time(), "payload": None, "streamed": False}
+        with self._lock:
+            self._entries[request_id] = entry
+            self._entries.move_to_end(request_id)
+            dropped = self._expire()
+            while len(self._entries) > self.max_entries:
+                dropped.append(self._entries.popitem(last=False)[1])
+        # Nobody can collect these anymore
+        for old in dropped:
+            old["job"].cancel(reason="timed_out")
+    
+    def get(self, request_id):
+        with self._lock:
+            dropped = self._expire()
+            entry = self._entries.get(request_id)
+        for old in dropped:
+            old["job"].cancel(reason="timed_out")
+        return entry
+    
+    def claim_stream(self, entry):
+        """True for the first stream consumer only: the job's token frames can be relayed once"""
+        with self._lock:
+            first = not entry["streamed"]
+            entry["streamed"] = True
+            return first
+    
+    def _expire(self):
+        now = time.time()
+        expired = [rid for rid, e in self._entries.items() if now - e["created"] > self.ttl]
+        return [self._entries.pop(rid) for rid in expired]
+    
+    def status(self):
+        with self._lock:
+            waiting = sum(1 for e in self._entries.values() if not e["job"].done.is_set())
+            return {"entries": len(self._entries), "waiting": waiting, "max_entries": self.max_entries, "ttl_seconds": self.ttl}
+
+PENDING = PendingReplies(PENDING_MAX, PENDING_TTL)
+
+REGISTRY.gauge("svarx_queue_depth", "Requests waiting for the inference worker", lambda: SCHEDULER.depth())
+REGISTRY.gauge("svarx_queue_rejected_total", "Requests shed because the queue was full", lambda: SCHEDULER.stats["rejected"], kind="counter")
+REGISTRY.gauge("svarx_queue_expired_total", "Requests dropped or stopped after their deadline", lambda: SCHEDULER.stats["expired"], kind="counter")
+REGISTRY.gauge("svarx_queue_cancelled_total", "Requests cancelled by the client before finishing", lambda: SCHEDULER.stats["cancelled"], kind="counter")
+REGISTRY.gauge("svarx_learning_queue_depth", "Learning writes waiting to be committed", lambda: WRITER.depth())
+REGISTRY.gauge("svarx_model_loaded", "1 while the model is resident", lambda: int(MODEL_LOADED))
+REGISTRY.gauge("svarx_models_resident", "Models currently loaded", lambda: len(RESIDENT))
+REGISTRY.gauge("svarx_model_page_cache_bytes", "Bytes of the default model file in the OS page cache", lambda: (page_cache_residency(resolve_model_path()) or (0, 0))[0])
+REGISTRY.gauge("svarx_speculative_drafted_total", "Tokens proposed by the speculative drafter", lambda: SPECULATION.drafted, kind="counter")
+REGISTRY.gauge("svarx_speculative_accepted_total", "Drafted tokens accepted by the model (estimated)", lambda: SPECULATION.accepted, kind="counter")
+REGISTRY.gauge("svarx_response_cache_hits_total", "Response cache hits", lambda: RESPONSE_CACHE.hits, kind="counter")
+REGISTRY.gauge("svarx_response_cache_misses_total", "Response cache misses", lambda: RESPONSE_CACHE.misses, kind="counter")
+REGISTRY.gauge("svarx_response_cache_hit_ratio", "Response cache hit ratio", lambda: RESPONSE_CACHE.status()["hit_ratio"])
+REGISTRY.gauge("svarx_prefix_cache_hits_total", "Prompt prefix KV state hits", lambda: PREFIX_CACHE.hits, kind="counter")
+REGISTRY.gauge("svarx_prefix_cache_misses_total", "Prompt prefix KV state misses", lambda: PREFIX_CACHE.misses, kind="counter")
+REGISTRY.gauge("svarx_prefix_cache_hit_ratio", "Prompt prefix KV state hit ratio", lambda: PREFIX_CACHE.status()["hit_ratio"])
+REGISTRY.gauge("svarx_process_resident_bytes", "Resident memory of the server process", lambda: psutil.Process().memory_info().rss)
+
+# Power management
+POWER_MODE_ERRORS = {}  # "priority" / "affinity" -> why the last attempt to apply it failed
+APPLIED_POWER_MODE = None  # (profile, priority, cores) last applied, or "normal"
+
+def allowed_cpus():
+    """CPUs this process may run on (e.g. under taskset or a container limit)"""
+    try:
+        return psutil.Process().cpu_affinity()
+    except Exception:
+        return list(range(psutil.cpu_count() or 1))
+
+# Captured before any profile narrows the affinity, so it can be widened again
+CPU_POOL = allowed_cpus()
+
+def set_priority(process, level):
+    """Set the process CPU priority ("idle", "below_normal" or "normal"); False if the OS refused.
+    
+    On Unix an unprivileged process cannot raise its priority again, so going back
+    to "normal" after the battery profile fails there.
+    """
+    try:
+        if level == "idle":
+            # Lowest possible CPU priority for background processing
+            if hasattr(psutil, 'IDLE_PRIORITY_CLASS'):
+                process.nice(psutil.IDLE_PRIORITY_CLASS)  # Lowest priority on Windows
+            elif hasattr(psutil, 'BELOW_NORMAL_PRIORITY_CLASS'):
+                process.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
+            else:
+                process.nice(19)  # Lowest priority on Unix
+        elif level == "below_normal":
+            if hasattr(psutil, 'BELOW_NORMAL_PRIORITY_CLASS'):
+                process.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
+            else:
+                process.nice(10)
+        else:
+            if hasattr(psutil, 'NORMAL_PRIORITY_CLASS'):
+                process.nice(psutil.NORMAL_PRIORITY_CLASS)
+            else:
+                process.nice(0)
+        POWER_MODE_ERRORS.pop("priority", None)
+        return True
     except Exception as e:
-        app.logger.warning(f"Could not set low power mode: {e}")
+        # An unprivileged process stays refused for good; say so once
+        denied_before = "AccessDenied" in POWER_MODE_ERRORS.get("priority", "")
+        if not (isinstance(e, psutil.AccessDenied) and denied_before):
+            app.logger.warning(f"Could not set {level} CPU priority: {e!r}")
+        POWER_MODE_ERRORS["priority"] = f"could not set {level} priority: {e!r}"
+        return False
+
+def set_affinity(process, cores=None):
+    """Pin the process to the first `cores` CPUs (None: all of them); False if the OS refused"""
+    if not hasattr(process, 'cpu_affinity'):
+        return True
+    try:
+        process.cpu_affinity(CPU_POOL[:cores] if cores else CPU_POOL)
+        POWER_MODE_ERRORS.pop("affinity", None)
+        return True
+    except Exception as e:
+        POWER_MODE_ERRORS["affinity"] = f"could not set CPU affinity: {e!r}"
+        app.logger.warning(f"Could not set CPU affinity: {e!r}")
+        return False
+
+def set_profile_power_mode():
+    """Apply the active profile's CPU priority and core affinity (battery: 5% CPU, <500MB RAM).
+    
+    Runs before every generation but only acts when the profile changed since the last call.
+    """
+    global APPLIED_POWER_MODE
+    profile = get_profile()
+    mode = (profile["name"], profile["priority"], profile["cores"])
+    if mode == APPLIED_POWER_MODE:
+        return
+    APPLIED_POWER_MODE = mode
+    process = psutil.Process()
+    # Separate steps: a refused priority change must not keep the old core pinning
+    set_priority(process, profile["priority"])
+    set_affinity(process, profile["cores"])
+    
+    # Force garbage collection to minimize memory
+    gc.collect()
+    
+    if profile["name"] == "battery":
+        app.logger.info("🔋 Ultra-low power mode: Max 5% CPU, <500MB RAM")
+    else:
+        app.logger.info(f"⚙️ {profile['name']} profile: {profile['n_threads']} threads, {profile['cores'] or 'all'} cores")
 
 def set_normal_power_mode():
     """Restore normal power mode"""
-    try:
-        process = psutil.Process()
-        # Restore normal priority
-        if hasattr(psutil, 'NORMAL_PRIORITY_CLASS'):
-            process.nice(psutil.NORMAL_PRIORITY_CLASS)
-        else:
-            process.nice(0)  # Normal priority
-        
-        # Restore all CPU cores
-        if hasattr(process, 'cpu_affinity'):
-            available_cpus = list(range(psutil.cpu_count()))
-            process.cpu_affinity(available_cpus)
-        
+    global APPLIED_POWER_MODE
+    if APPLIED_POWER_MODE == "normal":
+        return
+    APPLIED_POWER_MODE = "normal"
+    process = psutil.Process()
+    priority_ok = set_priority(process, "normal")
+    affinity_ok = set_affinity(process)
+    if priority_ok and affinity_ok:
         app.logger.info("⚡ Restored normal power mode")
-    except Exception as e:
-        app.logger.warning(f"Could not restore normal power mode: {e}")
 
-def unload_model():
-    """Unload model to free memory"""
-    global LLAMA, MODEL_LOADED
-    if LLAMA is not None:
-        app.logger.info("🗑️ Unloading AI model to free memory...")
-        del LLAMA
-        LLAMA = None
-        MODEL_LOADED = False
-        
-        # Restore normal power mode when model unloaded
-        set_normal_power_mode()
+def unload_model(name=None):
+    """Unload one resident model, or all of them, to free memory"""
+    global LLAMA, ACTIVE_MODEL, MODEL_LOADED
+    names = [name] if name else list(RESIDENT)
+    unloaded = False
+    for n in names:
+        llm = RESIDENT.pop(n, None)
+        if llm is None:
+            continue
+        READINESS.set("unloading", n)
+        app.logger.info(f"🗑️ Unloading {n} to free memory...")
+        PREFIX_CACHE.clear(llm)
+        if llm is LLAMA:
+            LLAMA, ACTIVE_MODEL = None, None
+        del llm
+        unloaded = True
+    MODEL_LOADED = bool(RESIDENT)
+    if unloaded:
+        if RESIDENT:
+            READINESS.set("ready", ACTIVE_MODEL or next(reversed(RESIDENT)))
+        else:
+            READINESS.set("absent")
+    
+    if unloaded:
+        # Restore normal power mode once nothing is loaded
+        if not RESIDENT:
+            set_normal_power_mode()
         
         gc.collect()  # Force garbage collection
-        app.logger.info("✅ Model unloaded, memory freed, power restored")
+        app.logger.info("✅ Model unloaded, memory freed" + ("" if RESIDENT else ", power restored"))
 
-def load_model(force_reload=False):
-    global LLAMA, MODEL_LOADED, LAST_USED
+def unload_if_idle():
+    """Unload only if the residency policy still agrees once the unload reaches the worker"""
+    if RESIDENT and RESIDENCY.should_unload(time.time() - LAST_USED):
+        unload_model()
+        return True
+    return not RESIDENT
+
+def load_model(force_reload=False, name=None):
+    """Make the named model (default: the default model) the active one, loading it if needed.
+    
+    Loaded models stay resident up to MAX_RESIDENT_MODELS, so switching back is a
+    pointer swap; the least recently used one is evicted to make room.
+    """
+    global LLAMA, ACTIVE_MODEL, MODEL_LOADED, LAST_USED
     
     # Update last used time
     LAST_USED = time.time()
     
-    if LLAMA is not None and not force_reload:
-        MODEL_LOADED = True
-        return True
-    
-    # Clear existing model if reloading
-    if force_reload and LLAMA is not None:
+    # Reloading (e.g. after a profile switch) drops every model loaded with the old settings
+    if force_reload:
+        name = name or ACTIVE_MODEL
         unload_model()
+    name = name or DEFAULT_MODEL
     
-    if not model_exists():
-        app.logger.warning(f"Model not found at {get_model_path()}")
+    if name in RESIDENT:
+        RESIDENT.move_to_end(name)
+        LLAMA, ACTIVE_MODEL, MODEL_LOADED = RESIDENT[name], name, True
+        if READINESS.state != "warming":
+            READINESS.set("ready", name)
+        return True
+    
+    path = resolve_model_path(name)
+    if path is None or not model_exists(path):
+        app.logger.warning(f"Model {name} not found at {path or 'any model directory'}")
         return False
     
+    # Evict before loading so two large models never overlap in memory
+    while len(RESIDENT) >= MAX_RESIDENT_MODELS:
+        unload_model(next(iter(RESIDENT)))
+    
     try:
         from llama_cpp import Llama
-        path = model_path_str()
-        app.logger.info(f"🚀 Loading Llama-3.2-3B on-demand...")
+        profile = get_profile()
+        app.logger.info(f"🚀 Loading {name} on-demand ({profile['name']} profile)...")
+        
+        drafter = make_drafter()
+        speculative = {"draft_model": drafter} if drafter is not None else {}
+        READINESS.set("loading", name)
         
-        # Ultra-efficient settings: 5% CPU, <500MB RAM when idle
-        LLAMA = Llama(
+        # Battery profile: 5% CPU, <500MB RAM when idle
+        t0 = time.perf_counter()
+        llm = Llama(
             model_path=str(path), 
-            n_ctx=256,       # Ultra-minimal context (saves more RAM)
-            n_threads=1,     # Single thread for 5% CPU limit
-            n_batch=32,      # Smallest possible batch size
+            n_ctx=profile["n_ctx"],         # Ultra-minimal context on battery (saves more RAM)
+            n_threads=profile["n_threads"], # Single thread on battery for 5% CPU limit
+            n_batch=profile["n_batch"],     # Smallest possible batch size on battery
             verbose=False,
             use_mmap=True,   # Memory mapping for efficiency
             use_mlock=False, # Don't lock memory pages
@@ -125,21 +866,37 @@ def load_model(force_reload=False):
             offload_kqv=True,    # Offload key-value cache
             flash_attn=False,    # Disable flash attention (saves memory)
             split_mode=1,        # Split model across CPU efficiently
+            **speculative,       # Prompt-lookup drafting when enabled
         )
-        MODEL_LOADED = True
+        RESIDENT[name] = llm
+        LLAMA, ACTIVE_MODEL, MODEL_LOADED = llm, name, True
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage="model_load")
+        READINESS.set("ready", name)
         app.logger.info("✅ Model loaded with minimal power footprint")
         
-        # Set to low power mode when model is loaded
-        set_low_power_mode()
+        # Apply the profile's power mode when model is loaded
+        set_profile_power_mode()
         
-        # Start idle monitor thread
-        threading.Thread(target=idle_monitor, daemon=True).start()
+        # Start idle monitor thread (one watches every resident model)
+        start_idle_monitor()
         
         return True
     except Exception as e:
         app.logger.exception("Model load failed: %s", e)
+        if RESIDENT:
+            READINESS.set("ready", ACTIVE_MODEL)
+        else:
+            READINESS.set("absent")
         return False
 
+IDLE_MONITOR = None
+
+def start_idle_monitor():
+    global IDLE_MONITOR
+    if IDLE_MONITOR is None or not IDLE_MONITOR.is_alive():
+        IDLE_MONITOR = threading.Thread(target=idle_monitor, daemon=True)
+        IDLE_MONITOR.start()
+
 def idle_monitor():
     """Monitor model usage, optimize resources, and perform background learning when idle"""
     global LAST_USED, MODEL_LOADED
@@ -177,11 +934,11 @@ def idle_monitor():
                         app.logger.info(f"⚡ CPU usage {cpu_percent:.1f}% > {MAX_IDLE_CPU_PERCENT}%, throttling...")
                         time.sleep(2)  # Add delay to reduce CPU usage
                 
-                # Unload model after full idle timeout
-                if idle_time > IDLE_TIMEOUT:
+                # Unload once idle past the timeout and no request is expected soon
+                if RESIDENCY.should_unload(idle_time):
                     app.logger.info(f"⏰ Model idle for {idle_time:.0f}s, unloading...")
-                    unload_model()
-                    break
+                    if SCHEDULER.run(lambda job: unload_if_idle()):
+                        break
                     
             except Exception as e:
                 app.logger.debug(f"Resource monitoring error: {e}")
@@ -194,7 +951,7 @@ def background_learning_task(current_memory_mb, current_cpu_percent):
             return  # Skip if resources are too high
         
         from personalization import (
-            analyze_user_patterns, smart_cleanup, get_training_pairs,
+            analyze_user_patterns, MAINTENANCE, get_style_profile,
             list_samples, compress_old_data, get_feedback_patterns
         )
         
@@ -211,7 +968,7 @@ def background_learning_task(current_memory_mb, current_cpu_percent):
         elif task_cycle == 1:
             # Task 2: Smart cleanup and optimization
             app.logger.info("🗜️ Background learning: Optimizing storage...")
-            smart_cleanup()
+            MAINTENANCE.request()  # Sliced cleanup + incremental vacuum on the maintenance thread
             compressed = compress_old_data()
             if compressed > 0:
                 app.logger.info(f"📦 Compressed {compressed} old patterns")
@@ -227,13 +984,9 @@ def background_learning_task(current_memory_mb, current_cpu_percent):
         elif task_cycle == 3:
             # Task 4: Process training pairs for pattern extraction
             app.logger.info("🎯 Background learning: Processing training data...")
-            training_pairs = get_training_pairs(20)  # Small batch
-            if training_pairs:
-                # Extract common response patterns
-                tone_patterns = {}
-                for pair in training_pairs:
-                    tone = pair.get('tone', 'professional')
-                    tone_patterns[tone] = tone_patterns.get(tone, 0) + 1
+            # Tone counts are maintained on every training-pair write
+            tone_patterns = get_style_profile()["stats"]["tones"]
+            if tone_patterns:
                 app.logger.info(f"📈 Tone distribution: {tone_patterns}")
         
         elif task_cycle == 4:
@@ -260,8 +1013,9 @@ def background_learning_task(current_memory_mb, current_cpu_percent):
                 preferred_tone = patterns.get('preferred_tone', 'professional')
                 formality = patterns.get('formality_level', 0.5)
                 
-                # Cache optimized prompt templates for faster generation
-                app.logger.info(f"🚀 Cached templates for {preferred_tone} tone, {formality:.1%} formality")
+                # Cache prompt template KV prefixes for faster generation
+                cached = SCHEDULER.run(lambda job: PREFIX_CACHE.warm(LLAMA, preferred_tone) if LLAMA is not None else 0)
+                app.logger.info(f"🚀 Cached {cached} templates for {preferred_tone} tone, {formality:.1%} formality")
         
         # Small delay to keep CPU usage minimal
         time.sleep(0.5)
@@ -269,56 +1023,60 @@ def background_learning_task(current_memory_mb, current_cpu_percent):
     except Exception as e:
         app.logger.debug(f"Background learning error: {e}")
 
-@app.route("/", methods=["GET"])
-def root():
-    return jsonify({
+# Status payloads are plain functions so the ASGI entry point (asgi_server.py) can serve them without Flask
+def root_payload():
+    return {
         "name": "Gmail AI Pro Server",
         "version": "1.4.0",
         "status": "running",
-        "endpoints": ["/health", "/generate", "/remember", "/samples", "/clear_personalization", "/export_style"]
-    })
+        "endpoints": ["/health", "/generate", "/generate_stream", "/generate_batch", "/result/<request_id>", "/cancel/<request_id>", "/prewarm", "/profile", "/models", "/metrics", "/remember", "/samples", "/clear_personalization", "/export_style"]
+    }
 
-@app.route("/health", methods=["GET"])
-def health():
+def health_payload():
     # Don't auto-load model for health check - just check if file exists
     model_available = model_exists()
-    return jsonify({
+    return {
         "ok": model_available, 
         "has_model": model_available, 
         "model_path": model_path_str(),
         "model_loaded": MODEL_LOADED,
+        "active_model": ACTIVE_MODEL,
+        "state": READINESS.state,
+        "readiness": READINESS.status(),
         "memory_optimized": True
-    })
+    }
+
+@app.route("/", methods=["GET"])
+def root():
+    return jsonify(root_payload())
+
+@app.route("/health", methods=["GET"])
+def health():
+    return jsonify(health_payload())
 
 @app.route("/reload_model", methods=["POST"])
 def reload_model():
     """Reload the model with updated settings"""
     try:
-        success = load_model(force_reload=True)
-        return jsonify({"ok": success, "message": "Model reloaded with 4096 context window"})
+        success = SCHEDULER.run(lambda job: load_model(force_reload=True), timeout=120, priority=PRIORITY_INTERACTIVE)
+        return jsonify({"ok": success, "message": f"Model reloaded with {get_profile()['n_ctx']} context window"})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
+# Template replies by email type (see classifier.EMAIL_TYPES)
+FALLBACK_REPLIES = {
+    "scheduling": "I can accommodate a schedule change. Please share your preferred times and I'll confirm availability.",
+    "gratitude": "You're very welcome! I'm glad I could help. Please don't hesitate to reach out if you need anything else.",
+    "urgent": "I understand this is time-sensitive. I'll prioritize this and get back to you as soon as possible.",
+    "inquiry": "Thank you for your question. I'll review this carefully and provide a detailed response shortly.",
+    "confirmation": "I can confirm the details for you. Let me review everything and get back to you with verification.",
+    "update_request": "Thank you for checking in. I'll provide you with a comprehensive update on the current status.",
+    "apology": "No problem at all! These things happen. Let me know how I can help resolve this.",
+    "general": "Thank you for reaching out. I've received your message and will respond with the information you need.",
+}
+
 def fallback_reply(email_text, tone, length):
-    text = (email_text or "").lower()
-    
-    # More intelligent fallback based on email content
-    if "meeting" in text or "resched" in text or "reschedule" in text or "calendar" in text:
-        base = "I can accommodate a schedule change. Please share your preferred times and I'll confirm availability."
-    elif "thank" in text or "appreciate" in text or "grateful" in text:
-        base = "You're very welcome! I'm glad I could help. Please don't hesitate to reach out if you need anything else."
-    elif "urgent" in text or "asap" in text or "immediate" in text or "priority" in text:
-        base = "I understand this is time-sensitive. I'll prioritize this and get back to you as soon as possible."
-    elif "question" in text or "clarif" in text or "explain" in text or "help" in text:
-        base = "Thank you for your question. I'll review this carefully and provide a detailed response shortly."
-    elif "confirm" in text or "verification" in text or "verify" in text:
-        base = "I can confirm the details for you. Let me review everything and get back to you with verification."
-    elif "update" in text or "status" in text or "progress" in text:
-        base = "Thank you for checking in. I'll provide you with a comprehensive update on the current status."
-    elif "sorry" in text or "apolog" in text or "mistake" in text:
-        base = "No problem at all! These things happen. Let me know how I can help resolve this."
-    else:
-        base = "Thank you for reaching out. I've received your message and will respond with the information you need."
+    base = FALLBACK_REPLIES[classify(email_text)["email_type"]]
     
     # Tone adjustments
     if tone == "casual":
@@ -336,191 +1094,1036 @@ def fallback_reply(email_text, tone, length):
     
     return base
 
-def build_prompt(email_text, tone, length):
-    # Allow more context but still safe
-    if len(email_text) > 400:
-        email_text = email_text[:400] + "..."
+GREETING_WORDS = {"hi", "hey", "hello"}
+
+def instant_reply(email_text, tone, length):
+    """(reply, source) answerable without the model, for the first phase of a two-phase request.
+    
+    The user's own reply to a near-identical past email wins; otherwise the template
+    reply, opened with the user's usual greeting when they have one.
+    """
+    try:
+        from personalization import find_similar_replies
+        similar = find_similar_replies(email_text, k=1, min_score=INSTANT_REUSE_SCORE)
+        if similar and similar[0]["tone"] == tone:
+            return similar[0]["reply"], "retrieval"
+    except Exception as e:
+        app.logger.debug(f"Instant reply retrieval failed: {e}")
+    
+    reply = fallback_reply(email_text, tone, length)
+    if tone != "formal":
+        try:
+            from personalization import analyze_user_patterns
+            starters = analyze_user_patterns().get("common_starters") or []
+            greeting = starters[0][0].split()[0].strip(",.!") if starters else ""
+            if greeting.lower() in GREETING_WORDS:
+                reply = f"{greeting.capitalize()},\n\n{reply}"
+        except Exception as e:
+            app.logger.debug(f"Instant reply personalization failed: {e}")
+    return reply, "template"
+
+# Llama-3.2-3B optimized prompts (more concise for efficiency), keyed by (email type, tone);
+# a None tone is the default for that email type
+PROMPT_TEMPLATES = {
+    ("scheduling", "casual"): "Write a friendly reply about scheduling. Suggest specific times or ask for their availability.",
+    ("scheduling", "formal"): "Write a professional scheduling response. Offer specific meeting times or request their availability.",
+    ("scheduling", None): "Reply professionally about scheduling. Provide time options or ask for their preferences.",
+    ("gratitude", "casual"): "Write a warm, friendly response to this thank you message.",
+    ("gratitude", None): "Write a gracious professional response to this thank you message.",
+    ("urgent", None): "This is urgent. Write a {tone} reply that acknowledges the urgency and offers quick action.",
+    ("inquiry", None): "This is a question. Write a {tone} reply that provides helpful information.",
+    # General email - simple and efficient
+    ("general", "casual"): "Write a friendly, conversational reply.",
+    ("general", "formal"): "Write a formal, professional reply.",
+    ("general", None): "Write a professional, helpful reply.",
+}
+PROMPT_EMAIL_TYPES = ["scheduling", "gratitude", "urgent", "inquiry", "general"]
+PROMPT_PREFIX_END = "\n\nEmail:"  # Everything up to here is fixed per template
+
+def template_instruction(email_type, tone):
+    instruction = PROMPT_TEMPLATES.get((email_type, tone)) or PROMPT_TEMPLATES[(email_type, None)]
+    return instruction.format(tone=tone)
+
+def template_prefix(email_type, tone):
+    """Fixed leading text shared by every prompt built from this template"""
+    return template_instruction(email_type, tone) + PROMPT_PREFIX_END
+
+def prompt_prefix(prompt):
+    """Return the template prefix of a prompt built by build_prompt (empty if none)"""
+    end = prompt.find(PROMPT_PREFIX_END)
+    return prompt[:end + len(PROMPT_PREFIX_END)] if end >= 0 else ""
+
+class PrefixStateCache:
+    """LRU of llama KV states for the fixed template prefixes, bounded by total state size"""
+    def __init__(self, max_mb):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._states = OrderedDict()  # (model instance id, prefix) -> (tokens, state, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def clear(self, llm=None):
+        """Drop the states of one model instance (default: all); they are only valid for the instance that produced them"""
+        if llm is None:
+            self._states.clear()
+            self.bytes = 0
+            return
+        for key in [k for k in self._states if k[0] == id(llm)]:
+            self.bytes -= self._states.pop(key)[2]
     
+    def prime(self, llm, prompt):
+        """Put the prompt's template prefix into llm's KV cache, restoring a saved state when possible.
+        
+        llama-cpp then only evaluates the tokens after the prefix. Must run on the inference worker.
+        """
+        prefix = prompt_prefix(prompt)
+        if llm is None or not prefix:
+            return False
+        key = (id(llm), prefix)
+        entry = self._states.get(key)
+        if entry is not None:
+            self._states.move_to_end(key)
+            self.hits += 1
+            tokens, state, _ = entry
+            # Already resident (e.g. same template twice in a row) - keep the longer match
+            if list(getattr(llm, "_input_ids", [])[:len(tokens)]) != tokens:
+                llm.load_state(state)
+            return True
+        
+        self.misses += 1
+        try:
+            tokens = list(llm.tokenize(prefix.encode("utf-8")))
+            llm.reset()
+            llm.eval(tokens)
+            state = llm.save_state()
+        except Exception as e:
+            app.logger.debug(f"Prefix state capture failed: {e}")
+            return False
+        size = self.state_bytes(state)
+        if size > self.max_bytes:
+            return False
+        self._states[key] = (tokens, state, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and self._states:
+            _, (_, _, evicted) = self._states.popitem(last=False)
+            self.bytes -= evicted
+        return False
+    
+    @staticmethod
+    def state_bytes(state):
+        """Memory held by a LlamaState: the KV blob plus its logits (n_tokens x n_vocab) and token ids"""
+        size = getattr(state, "llama_state_size", 0) or len(getattr(state, "llama_state", b""))
+        for array in (getattr(state, "scores", None), getattr(state, "input_ids", None)):
+            size += getattr(array, "nbytes", 0)
+        return size
+    
+    def warm(self, llm, tone):
+        """Precompute the prefixes of every email type for one tone"""
+        for email_type in PROMPT_EMAIL_TYPES:
+            prefix = template_prefix(email_type, tone)
+            if (id(llm), prefix) not in self._states:
+                self.prime(llm, prefix)
+        return len(self._states)
+    
+    def status(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._states),
+            "size_mb": round(self.bytes / 1024 / 1024, 1),
+            "max_size_mb": round(self.max_bytes / 1024 / 1024, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0,
+        }
+
+PREFIX_CACHE = PrefixStateCache(PREFIX_CACHE_MAX_MB)
+
+# Per-variant length instructions and token budgets for /generate_batch
+LENGTH_HINTS = {
+    "short": "Keep it to one sentence.",
+    "medium": "Keep it to two or three sentences.",
+    "long": "Write four or five detailed sentences.",
+}
+VARIANT_MAX_TOKENS = {"short": 30, "medium": 50, "long": 80}
+
+# Few-shot personalization: the user's replies to the most similar past emails
+EXAMPLE_COUNT = 2
+EXAMPLE_MAX_CHARS = 160  # Per example, before token budgeting
+
+# Token budgeting: every prompt is sized to the loaded model's context window before evaluation
+PROMPT_SAFETY_TOKENS = 8   # BOS plus slack for tokens merging across section joins
+EMAIL_BODY_SHARE = 0.5     # The email body itself gets at most this share of n_ctx
+
+# Quoted thread history and signatures are the first things dropped when space runs out
+QUOTE_START = re.compile(r"(^>|^On [^\n]{0,120}wrote:|-----\s*Original Message\s*-----|^From: .+\n(?:Sent|Date): )", re.M | re.I)
+SIGNATURE_START = re.compile(r"^(-- ?$|Sent from my |(?:Best|Kind|Warm)? ?regards,?$|Thanks,?$|Cheers,?$|Sincerely,?$)", re.M | re.I)
+
+def split_email(email_text):
+    """Split an email into (body, signature, quoted history)"""
+    quoted = signature = ""
+    match = QUOTE_START.search(email_text)
+    if match and match.start() > 0:
+        email_text, quoted = email_text[:match.start()], email_text[match.start():]
+    match = SIGNATURE_START.search(email_text)
+    if match and match.start() > 0:
+        email_text, signature = email_text[:match.start()], email_text[match.start():]
+    return email_text.strip(), signature.strip(), quoted.strip()
+
+def count_tokens(text):
+    """Token count with the loaded model's tokenizer (rough estimate when no model is loaded)"""
+    if LLAMA is not None:
+        try:
+            return len(LLAMA.tokenize(text.encode("utf-8"), add_bos=False))
+        except Exception:
+            pass
+    return len(text) // 4 + 1
+
+def truncate_to_tokens(text, max_tokens):
+    """Longest word-boundary prefix of text that fits in max_tokens ("" if nothing fits)"""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    words = text.split(" ")
+    lo, hi = 0, len(words) - 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(" ".join(words[:mid]) + "...") <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return " ".join(words[:lo]) + "..." if lo else ""
+
+def context_window():
+    if LLAMA is not None:
+        try:
+            return LLAMA.n_ctx()
+        except Exception:
+            pass
+    return get_profile()["n_ctx"]
+
+def similar_examples(email_text):
+    """The user's own replies to similar past emails, best first"""
+    try:
+        from personalization import find_similar_replies
+        examples = find_similar_replies(email_text, k=EXAMPLE_COUNT)
+    except Exception as e:
+        app.logger.debug(f"Example retrieval failed: {e}")
+        return []
+    replies = []
+    for example in examples:
+        reply = example["reply"]
+        if len(reply) > EXAMPLE_MAX_CHARS:
+            reply = reply[:EXAMPLE_MAX_CHARS].rsplit(" ", 1)[0] + "..."
+        replies.append(reply)
+    return replies
+
+def variant_tail(length):
+    hint = f"\n{LENGTH_HINTS[length]}" if length in LENGTH_HINTS else ""
+    return f"{hint}\n\nReply:"
+
+def build_prompt(email_text, tone, length, variant=False, batch_lengths=None):
     # Clean up email text
     email_text = email_text.strip()
     if not email_text:
         email_text = "Hello, I hope you're doing well."
+    body, signature, quoted = split_email(email_text)
     
-    # Get email context insights for smarter prompts
-    try:
-        from personalization import get_email_context_insights
-        insights = get_email_context_insights()
-        
-        # Detect email type for context-aware responses
-        text_lower = email_text.lower()
-        email_type = "general"
-        
-        if any(word in text_lower for word in ["meeting", "schedule", "calendar"]):
-            email_type = "scheduling"
-        elif any(word in text_lower for word in ["thank", "appreciate", "grateful"]):
-            email_type = "gratitude"
-        elif any(word in text_lower for word in ["urgent", "asap", "immediate"]):
-            email_type = "urgent"
-        elif any(word in text_lower for word in ["question", "help", "clarify"]):
-            email_type = "inquiry"
-        
-    except:
-        insights = {}
+    # Detect email type for context-aware responses; types without their own template use the general one
+    email_type = classify(body)["email_type"]
+    if email_type not in PROMPT_EMAIL_TYPES:
         email_type = "general"
     
-    # Llama-3.2-3B optimized prompts (more concise for efficiency)
-    if email_type == "scheduling":
-        if tone == "casual":
-            prompt = f"Email: {email_text}\n\nWrite a friendly reply about scheduling. Suggest specific times or ask for their availability.\n\nReply:"
-        elif tone == "formal":
-            prompt = f"Email: {email_text}\n\nWrite a professional scheduling response. Offer specific meeting times or request their availability.\n\nReply:"
-        else:
-            prompt = f"Email: {email_text}\n\nReply professionally about scheduling. Provide time options or ask for their preferences.\n\nReply:"
+    # Instruction first, so each template's fixed tokens form a cacheable KV prefix
+    head = f"{template_instruction(email_type, tone)}{PROMPT_PREFIX_END} "
+    # Batched variants share the prompt up to the hint, so only the length hint differs per variant
+    tail = variant_tail(length) if variant else "\n\nReply:"
     
-    elif email_type == "gratitude":
-        if tone == "casual":
-            prompt = f"Email: {email_text}\n\nWrite a warm, friendly response to this thank you message.\n\nReply:"
-        else:
-            prompt = f"Email: {email_text}\n\nWrite a gracious professional response to this thank you message.\n\nReply:"
+    # Whatever the context window doesn't need for the fixed text and the reply is the budget.
+    # Variants of one batch are budgeted for the largest of them, so they trim the same way
+    n_ctx = context_window()
+    if variant:
+        lengths = set(batch_lengths or ()) | {length}
+        reply_tokens = max(VARIANT_MAX_TOKENS.get(l, GENERATION_PARAMS["max_tokens"]) for l in lengths)
+        tail_tokens = max(count_tokens(variant_tail(l)) for l in lengths)
+    else:
+        reply_tokens, tail_tokens = GENERATION_PARAMS["max_tokens"], count_tokens(tail)
+    budget = n_ctx - reply_tokens - PROMPT_SAFETY_TOKENS - count_tokens(head) - tail_tokens
     
-    elif email_type == "urgent":
-        prompt = f"Email: {email_text}\n\nThis is urgent. Write a {tone} reply that acknowledges the urgency and offers quick action.\n\nReply:"
+    # Highest priority first: email body, similar replies, style summary, signature, quoted history
+    example_replies = similar_examples(body)
+    body = truncate_to_tokens(body, min(budget, int(n_ctx * EMAIL_BODY_SHARE))) or "..."
+    budget -= count_tokens(body)
     
-    elif email_type == "inquiry":
-        prompt = f"Email: {email_text}\n\nThis is a question. Write a {tone} reply that provides helpful information.\n\nReply:"
+    def take(section):
+        nonlocal budget
+        cost = count_tokens(section)
+        if cost > budget:
+            return ""
+        budget -= cost
+        return section
     
-    else:
-        # General email - simple and efficient
-        if tone == "casual":
-            prompt = f"Email: {email_text}\n\nWrite a friendly, conversational reply.\n\nReply:"
-        elif tone == "formal":
-            prompt = f"Email: {email_text}\n\nWrite a formal, professional reply.\n\nReply:"
-        else:
-            prompt = f"Email: {email_text}\n\nWrite a professional, helpful reply.\n\nReply:"
+    examples = ""
+    for reply in example_replies:
+        header = "" if examples else "\n\nMy replies to similar emails (match this style):"
+        added = take(f"{header}\n- {reply}")
+        if not added:
+            break
+        examples += added
+    summary = build_style_summary(160)
+    style = take(f"\n\nStyle notes: {summary}") if summary else ""
+    signature = take(f"\n{signature}") if signature else ""
+    quoted = take(f"\n{quoted}") if quoted else ""
     
-    return prompt
+    # Retrieved examples and style notes go after the email so the template prefix stays cacheable
+    return f"{head}{body}{signature}{quoted}{examples}{style}{tail}"
 
-# Removed find_similar_context to prevent token overflow
-# The learning system still works through style analysis
+STOP_SEQUENCES = ["\n\nEmail:", "\n\nReply:", "\n---", "###", "\n\n\n"]
 
-@app.route("/generate", methods=["POST"])
-def generate():
+# Minimal power parameters for maximum efficiency
+GENERATION_PARAMS = {
+    "max_tokens": 50,       # Very short responses for speed
+    "temperature": DEFAULT_TEMPERATURE, # Lower temperature for faster processing
+    "top_p": 0.8,           # Reduced for efficiency
+    "top_k": 15,            # Minimal sampling for speed
+    "repeat_penalty": 1.05, # Lower penalty for faster processing
+    "stop": STOP_SEQUENCES,
+}
+
+def extract_reply_text(res):
+    """Extract text from a llama-cpp response - handle different formats"""
+    if isinstance(res, dict):
+        if "choices" in res and res["choices"]:
+            return res["choices"][0].get("text", "").strip()
+        elif "content" in res:
+            return res["content"].strip()
+        elif "text" in res:
+            return res["text"].strip()
+        # Log the structure to debug
+        app.logger.info(f"Unknown response structure: {list(res.keys())}")
+    elif isinstance(res, str):
+        return res.strip()
+    return ""
+
+def clean_reply(reply):
+    """Clean up response more thoroughly"""
+    reply = (reply or "").strip()
+    if reply:
+        # Remove common artifacts and prompts
+        reply = reply.replace("Reply:", "").replace("Email:", "").replace("Email received:", "").strip()
+        reply = reply.replace("Write a", "").replace("reply", "").strip()
+        
+        # Remove leading/trailing quotes or colons
+        reply = reply.strip('"\':-')
+        
+        # Ensure it starts with capital letter
+        if reply and reply[0].islower():
+            reply = reply[0].upper() + reply[1:]
+    return reply
+
+def fallback_payload(reason, email_text, tone, length, ok=False, meta=None):
+    """Template reply payload; every fallback is counted by reason on /metrics"""
+    FALLBACKS.inc(reason=reason)
+    payload = {"ok": ok, "from_model": False, "reply": fallback_reply(email_text, tone, length)}
+    if meta is not None:
+        payload["meta"] = meta
+    return payload
+
+def finalize_reply(reply, email_text, tone, length, meta):
+    """Apply validation, simple retry and fallback rules to a cleaned reply"""
+    app.logger.info(f"Cleaned reply: '{reply}' (length: {len(reply)})")
+    
+    # More lenient validation - accept shorter responses
+    if reply and len(reply) >= 5 and not reply.lower().startswith(('write', 'email', 'reply')):
+        app.logger.info(f"✅ AI generated: {reply[:50]}...")
+        return {"ok": True, "from_model": True, "reply": reply, "meta": meta}
+    
+    app.logger.warning(f"❌ Poor AI response: '{reply}' (len={len(reply)}), using fallback")
+    # Try one more time with simpler prompt if response was too short
+    if len(reply) < 5:
+        simple_prompt = f"Reply to: {email_text[:100]}\n\n"
+        try:
+            simple_reply = extract_reply_text(LLAMA(simple_prompt, max_tokens=60, temperature=0.9, stop=["\n"]))
+            if simple_reply and len(simple_reply) >= 5:
+                app.logger.info(f"✅ Simple retry worked: {simple_reply[:30]}...")
+                return {"ok": True, "from_model": True, "reply": simple_reply, "meta": meta}
+        except:
+            pass
+    
+    return fallback_payload("poor_response", email_text, tone, length, ok=True, meta=meta)
+
+def complete_reply(reply_text, email_text, tone, length, meta):
+    """Clean up and validate raw model text, timing it as the post-processing stage"""
+    with STAGE_SECONDS.time(stage="post_processing"):
+        return finalize_reply(clean_reply(reply_text), email_text, tone, length, meta)
+
+def run_completion(prompt, params, on_piece=None, job=None):
+    """Run LLAMA on a prompt via its token iterator, splitting prompt-eval and generation time.
+    
+    Returns (text, first_token_seconds, elapsed_seconds). on_piece, if given, receives
+    each raw text piece as it is generated. A cancelled job stops generation at the
+    next token boundary and returns the partial text.
+    """
+    t0 = time.perf_counter()
+    first_token = None
+    pieces = []
+    speculation = SPECULATION.mark()
+    if job is not None:
+        params = dict(params, stopping_criteria=job.should_stop)
+    for chunk in LLAMA(prompt, stream=True, **params):
+        if job is not None and job.stopped:
+            break
+        # Keep raw whitespace between tokens; cleanup happens once at the end
+        piece = chunk["choices"][0].get("text", "") if chunk.get("choices") else ""
+        if not piece:
+            continue
+        if first_token is None:
+            first_token = time.perf_counter() - t0
+        pieces.append(piece)
+        if on_piece is not None:
+            on_piece(piece)
+    elapsed = time.perf_counter() - t0
+    SPECULATION.record(speculation, len(pieces))
+    STAGE_SECONDS.observe(first_token if first_token is not None else elapsed, stage="prompt_eval")
+    STAGE_SECONDS.observe(elapsed - (first_token or elapsed), stage="token_generation")
+    return "".join(pieces), first_token, elapsed
+
+def prepare_generation(email_text, tone, length, variant=False, model=None, learn=True, batch_lengths=None):
+    """Load (or switch to) the model and build the prompt; returns None when the fallback must be used"""
     global LAST_USED
-    data = request.get_json(force=True)
-    email_text = data.get("email_text") or data.get("text") or ""
-    tone = data.get("tone", "professional")
-    length = data.get("length", "medium")
+    # Update last used time
+    LAST_USED = time.time()
     
-    if not email_text:
-        return jsonify({"ok": False, "reply": "No input provided."}), 400
+    # Load model on-demand
+    app.logger.info("🔄 Loading AI model on-demand...")
+    if not load_model(name=model):
+        app.logger.error("Model failed to load, using fallback")
+        return None
+    
+    if LLAMA is None:
+        app.logger.error("LLAMA is None after load_model, using fallback")
+        return None
+    with STAGE_SECONDS.time(stage="prompt_build"):
+        prompt = build_prompt(email_text, tone, length, variant=variant, batch_lengths=batch_lengths)
+    
+    # Learn from incoming email patterns (passive learning, written behind the request)
+    if learn:
+        WRITER.analyze_email(email_text)
     
-    with LOCK:
-        # Update last used time
-        LAST_USED = time.time()
+    # Restore the template's precomputed KV state so only email tokens are evaluated
+    with STAGE_SECONDS.time(stage="prefix_restore"):
+        PREFIX_CACHE.prime(LLAMA, prompt)
+    
+    return prompt
+
+def generation_error_reply(e, email_text, tone, length):
+    """Map a generation exception to the fallback payload"""
+    reason = "exception"
+    if isinstance(e, ValueError):
+        if "exceed context window" in str(e):
+            app.logger.warning("Context window exceeded, using fallback")
+            reason = "context_overflow"
+        else:
+            app.logger.error(f"ValueError: {e}")
+    else:
+        app.logger.exception("Generation error")
+    return fallback_payload(reason, email_text, tone, length)
+
+def cancelled_payload(email_text, tone, length):
+    """Template reply for a request the client gave up on; never cached"""
+    app.logger.info("🛑 Generation cancelled by client")
+    return fallback_payload("cancelled", email_text, tone, length, meta={"cancelled": True})
+
+def run_generation(job, email_text, tone, length, model=None):
+    """Worker-side body of /generate; runs on the inference thread"""
+    prompt = prepare_generation(email_text, tone, length, model=model)
+    if prompt is None:
+        return fallback_payload("load_failure", email_text, tone, length)
+    
+    try:
+        app.logger.info(f"Generating with prompt length: {len(prompt)} chars")
         
-        # Load model on-demand
-        app.logger.info("🔄 Loading AI model on-demand...")
-        if not load_model():
-            app.logger.error("Model failed to load, using fallback")
-            return jsonify({"ok": False, "from_model": False, "reply": fallback_reply(email_text, tone, length)})
+        # Ensure low power mode during generation
+        set_profile_power_mode()
         
-        if LLAMA is None:
-            app.logger.error("LLAMA is None after load_model, using fallback")
-            return jsonify({"ok": False, "from_model": False, "reply": fallback_reply(email_text, tone, length)})
-        prompt = build_prompt(email_text, tone, length)
+        # Add small delay to prevent CPU spikes
+        time.sleep(0.1)
         
-        # Learn from incoming email patterns (passive learning)
-        try:
-            from personalization import analyze_and_learn_from_email
-            analyze_and_learn_from_email(email_text, tone, length)
-        except Exception as e:
-            app.logger.debug(f"Email analysis failed: {e}")
+        text, first_token, elapsed = run_completion(prompt, GENERATION_PARAMS, job=job)
+        if job.stopped:
+            return None  # The request side answers with the cancelled or timeout fallback
+        return complete_reply(text, email_text, tone, length, {"elapsed": elapsed, "first_token": first_token, "model": ACTIVE_MODEL})
         
+    except Exception as e:
+        return generation_error_reply(e, email_text, tone, length)
+
+def run_batch_generation(job, email_text, variants):
+    """Worker-side body of /generate_batch: sample one continuation per variant.
+    
+    Variants are grouped by model so each model is switched to once. Within a group the
+    prompts share the email and instruction tokens, and llama-cpp reuses the KV cache for
+    the longest common token prefix, so after the first variant only the per-variant
+    length hint is evaluated before sampling.
+    
+    A stopped job (deadline or client cancel) keeps the variants already finished and
+    falls back for the rest; only a client cancel with nothing finished returns None.
+    """
+    t0 = time.time()
+    results = [None] * len(variants)
+    loaded = False
+    for model in dict.fromkeys(v["model"] for v in variants):
+        if job.stopped:
+            break
+        group = [i for i, v in enumerate(variants) if v["model"] == model]
+        first = variants[group[0]]
+        lengths = [variants[i]["length"] for i in group]
+        prompt = prepare_generation(email_text, first["tone"], first["length"], variant=True, model=model, learn=not loaded, batch_lengths=lengths)
+        if prompt is None:
+            for i, fallback in zip(group, fallback_variants("load_failure", email_text, [variants[i] for i in group])):
+                results[i] = fallback
+            continue
+        loaded = True
+        
+        # Ensure low power mode during generation
+        set_profile_power_mode()
+        
+        for n, i in enumerate(group):
+            if job.stopped:
+                break
+            v = variants[i]
+            if n > 0:
+                prompt = build_prompt(email_text, v["tone"], v["length"], variant=True, batch_lengths=lengths)
+            params = dict(GENERATION_PARAMS, max_tokens=VARIANT_MAX_TOKENS.get(v["length"], GENERATION_PARAMS["max_tokens"]))
+            try:
+                text, _, _ = run_completion(prompt, params, job=job)
+                if job.stopped:
+                    break  # The interrupted variant's partial text is not a reply
+                payload = complete_reply(text, email_text, v["tone"], v["length"], {})
+            except Exception as e:
+                payload = generation_error_reply(e, email_text, v["tone"], v["length"])
+            results[i] = dict(v, reply=payload["reply"], from_model=payload["from_model"])
+    
+    from_model = any(r is not None and r["from_model"] for r in results)
+    missing = [i for i, r in enumerate(results) if r is None]
+    if missing and job.cancelled and not from_model:
+        return None  # The request side answers with cancelled fallbacks
+    reason = "cancelled" if job.cancelled else "timeout"
+    for i, fallback in zip(missing, fallback_variants(reason, email_text, [variants[i] for i in missing])):
+        results[i] = fallback
+    
+    if not loaded:
+        return {"ok": False, "from_model": False, "variants": results}
+    
+    elapsed = time.time() - t0
+    meta = {"elapsed": elapsed}
+    if missing:
+        meta.update(partial=True, timed_out=job.timed_out, cancelled=job.cancelled)
+        app.logger.warning(f"⏳ Batch stopped after {len(results) - len(missing)} of {len(results)} variants")
+    else:
+        app.logger.info(f"✅ Generated {len(results)} variants in {elapsed:.1f}s")
+    return {"ok": from_model, "from_model": from_model, "variants": results, "meta": meta}
+
+def fallback_variants(reason, email_text, variants):
+    """Template replies for every requested batch variant"""
+    return [
+        dict(v, reply=fallback_payload(reason, email_text, v["tone"], v["length"])["reply"], from_model=False)
+        for v in variants
+    ]
+
+def request_timeout(data):
+    """Per-request deadline in seconds, capped at REQUEST_DEADLINE"""
+    try:
+        return min(REQUEST_DEADLINE, max(1.0, float(data.get("timeout", REQUEST_DEADLINE))))
+    except (TypeError, ValueError):
+        return REQUEST_DEADLINE
+
+def queue_full_response(email_text, tone, length):
+    """Shed load: answer immediately with the template reply and a Retry-After hint"""
+    retry_after = SCHEDULER.retry_after()
+    app.logger.warning(f"🚦 Inference queue full ({SCHEDULER.depth()} waiting), using fallback")
+    resp = jsonify(fallback_payload("queue_full", email_text, tone, length, meta={"queue_full": True, "retry_after": retry_after}))
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(retry_after)
+    return resp
+
+def sse_event(event, payload):
+    """Format one Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def stream_generation(job, email_text, tone, length, model=None):
+    """Worker-side streaming body: push one `token` frame per generated piece, then a final `done` frame.
+    
+    The final payload is also the job's result, for clients polling /result/<request_id>.
+    """
+    prompt = prepare_generation(email_text, tone, length, model=model)
+    if prompt is None:
+        payload = fallback_payload("load_failure", email_text, tone, length)
+    else:
         try:
-            t0 = time.time()
-            app.logger.info(f"Generating with prompt length: {len(prompt)} chars")
+            app.logger.info(f"Streaming with prompt length: {len(prompt)} chars")
             
             # Ensure low power mode during generation
-            set_low_power_mode()
-            
-            # Add small delay to prevent CPU spikes
-            time.sleep(0.1)
+            set_profile_power_mode()
             
-            # Minimal power parameters for maximum efficiency
-            res = LLAMA(
-                prompt, 
-                max_tokens=50,   # Very short responses for speed
-                temperature=0.5, # Lower temperature for faster processing
-                top_p=0.8,       # Reduced for efficiency
-                top_k=15,        # Minimal sampling for speed
-                repeat_penalty=1.05, # Lower penalty for faster processing
-                stop=["\n\nEmail:", "\n\nReply:", "\n---", "###", "\n\n\n"]
+            text, first_token, elapsed = run_completion(
+                prompt, GENERATION_PARAMS,
+                on_piece=lambda piece: job.events.put(sse_event("token", {"text": piece})),
+                job=job
             )
-            elapsed = time.time() - t0
-            
-            app.logger.info(f"Raw model response type: {type(res)}")
-            
-            # Extract text from response - handle different formats
-            reply = ""
-            if isinstance(res, dict):
-                if "choices" in res and res["choices"]:
-                    reply = res["choices"][0].get("text", "").strip()
-                elif "content" in res:
-                    reply = res["content"].strip()
-                elif "text" in res:
-                    reply = res["text"].strip()
-                else:
-                    # Log the structure to debug
-                    app.logger.info(f"Unknown response structure: {list(res.keys())}")
-            elif isinstance(res, str):
-                reply = res.strip()
-            
-            # Clean up response more thoroughly
-            if reply:
-                # Remove common artifacts and prompts
-                reply = reply.replace("Reply:", "").replace("Email:", "").replace("Email received:", "").strip()
-                reply = reply.replace("Write a", "").replace("reply", "").strip()
-                
-                # Remove leading/trailing quotes or colons
-                reply = reply.strip('"\':-')
-                
-                # Ensure it starts with capital letter
-                if reply and reply[0].islower():
-                    reply = reply[0].upper() + reply[1:]
-                
-            app.logger.info(f"Cleaned reply: '{reply}' (length: {len(reply)})")
-            
-            # More lenient validation - accept shorter responses
-            if reply and len(reply) >= 5 and not reply.lower().startswith(('write', 'email', 'reply')):
-                app.logger.info(f"✅ AI generated: {reply[:50]}...")
-                return jsonify({"ok": True, "from_model": True, "reply": reply, "meta": {"elapsed": elapsed}})
+            if job.cancelled:
+                payload = cancelled_payload(email_text, tone, length)
+            elif job.timed_out:
+                payload = fallback_payload("timeout", email_text, tone, length, meta={"timed_out": True})
             else:
-                app.logger.warning(f"❌ Poor AI response: '{reply}' (len={len(reply)}), using fallback")
-                # Try one more time with simpler prompt if response was too short
-                if len(reply) < 5:
-                    simple_prompt = f"Reply to: {email_text[:100]}\n\n"
-                    try:
-                        res2 = LLAMA(simple_prompt, max_tokens=60, temperature=0.9, stop=["\n"])
-                        if isinstance(res2, dict) and "choices" in res2:
-                            simple_reply = res2["choices"][0].get("text", "").strip()
-                            if simple_reply and len(simple_reply) >= 5:
-                                app.logger.info(f"✅ Simple retry worked: {simple_reply[:30]}...")
-                                return jsonify({"ok": True, "from_model": True, "reply": simple_reply, "meta": {"elapsed": elapsed}})
-                    except:
-                        pass
-                
-                return jsonify({"ok": True, "from_model": False, "reply": fallback_reply(email_text, tone, length), "meta": {"elapsed": elapsed}})
-            
-        except ValueError as e:
-            if "exceed context window" in str(e):
-                app.logger.warning("Context window exceeded, using fallback")
-                return jsonify({"ok": False, "from_model": False, "reply": fallback_reply(email_text, tone, length)})
-            else:
-                app.logger.error(f"ValueError: {e}")
-                return jsonify({"ok": False, "from_model": False, "reply": fallback_reply(email_text, tone, length)})
+                meta = {"elapsed": elapsed, "first_token": first_token, "queue_wait": job.wait_time, "streamed": True, "model": ACTIVE_MODEL}
+                payload = complete_reply(text, email_text, tone, length, meta)
+                RESPONSE_CACHE.put(ResponseCache.key(email_text, tone, length, model), payload)
         except Exception as e:
-            app.logger.exception("Generation error")
-            return jsonify({"ok": False, "from_model": False, "reply": fallback_reply(email_text, tone, length)})
+            payload = generation_error_reply(e, email_text, tone, length)
+    job.events.put(sse_event("done", payload))
+    return payload
+
+def relay_stream(job, email_text, tone, length):
+    """Request-side generator relaying the worker's SSE frames to the client"""
+    started = False
+    try:
+        while True:
+            try:
+                # Until the worker picks the job up, the request deadline applies
+                timeout = max(0, job.deadline - time.time()) if not started else REQUEST_DEADLINE
+                frame = job.events.get(timeout=timeout)
+            except queue.Empty:
+                job.cancel(reason="timed_out")
+                app.logger.warning("⏳ Streaming deadline passed, using fallback")
+                yield sse_event("done", fallback_payload("timeout", email_text, tone, length, meta={"timed_out": True}))
+                return
+            if frame is None:
+                if job.expired and job.cancelled:
+                    yield sse_event("done", cancelled_payload(email_text, tone, length))
+                elif job.expired:
+                    yield sse_event("done", fallback_payload("timeout", email_text, tone, length, meta={"timed_out": True}))
+                elif job.error:
+                    yield sse_event("done", generation_error_reply(job.error, email_text, tone, length))
+                return
+            started = True
+            yield frame
+    except GeneratorExit:
+        # The client closed the stream; stop generating for it
+        job.cancel()
+        raise
+
+def select_model(data, length):
+    """Model for a request: its "model" field, else the model mapped to the reply length, else the default.
+    
+    Raises KeyError for an explicitly requested model that is not installed.
+    """
+    name = data.get("model")
+    if name:
+        if name != DEFAULT_MODEL and name not in discover_models():
+            raise KeyError(name)
+        return name
+    name = LENGTH_MODELS.get(length)
+    if name and name != DEFAULT_MODEL and name not in discover_models():
+        app.logger.warning(f"Model {name} configured for {length} replies is not installed, using {DEFAULT_MODEL}")
+        return DEFAULT_MODEL
+    return name or DEFAULT_MODEL
+
+def unknown_model_response(name):
+    return jsonify({"ok": False, "error": f"unknown model '{name}'", "models": [DEFAULT_MODEL] + [m for m in discover_models() if m != DEFAULT_MODEL]}), 400
+
+def request_id_for(data):
+    """Id the client can pass to /cancel/<request_id>: from the body or X-Request-Id, else a fresh one"""
+    return str(data.get("request_id") or request.headers.get("X-Request-Id") or uuid.uuid4().hex)[:64]
+
+def disconnect_probe():
+    """Poller for job.wait() reporting when the client has closed its connection.
+    
+    Only the built-in server exposes the socket; elsewhere this returns None and
+    clients cancel explicitly through /cancel/<request_id>.
+    """
+    sock = request.environ.get("werkzeug.socket")
+    if sock is None:
+        return None
+    
+    def disconnected():
+        try:
+            # The body has been read, so a readable socket with nothing to peek is EOF
+            readable, _, _ = select.select([sock], [], [], 0)
+            return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            return True
+    return disconnected
+
+@app.route("/generate_stream", methods=["POST"])
+def generate_stream():
+    """Streaming variant of /generate using Server-Sent Events"""
+    RESIDENCY.record_request()
+    REQUESTS.inc(endpoint="generate_stream")
+    data = request.get_json(force=True)
+    email_text = data.get("email_text") or data.get("text") or ""
+    tone = data.get("tone", "professional")
+    length = data.get("length", "medium")
+    
+    if not email_text:
+        return jsonify({"ok": False, "reply": "No input provided."}), 400
+    try:
+        model = select_model(data, length)
+    except KeyError as e:
+        return unknown_model_response(e.args[0])
+    
+    if not data.get("regenerate"):
+        cached = RESPONSE_CACHE.get(ResponseCache.key(email_text, tone, length, model))
+        if cached is not None:
+            frames = sse_event("token", {"text": cached["reply"]}) + sse_event("done", cached)
+            return Response(frames, mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    
+    prefetch_for_load(model)
+    request_id = request_id_for(data)
+    try:
+        job = SCHEDULER.submit(lambda job: stream_generation(job, email_text, tone, length, model), timeout=request_timeout(data), request_id=request_id)
+    except QueueFullError:
+        return queue_full_response(email_text, tone, length)
+    
+    return Response(
+        stream_with_context(relay_stream(job, email_text, tone, length)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Request-Id": request_id}
+    )
+
+@app.route("/generate", methods=["POST"])
+def generate():
+    if request.args.get("stream") in ("1", "true"):
+        return generate_stream()
+    
+    RESIDENCY.record_request()
+    REQUESTS.inc(endpoint="generate")
+    data = request.get_json(force=True)
+    email_text = data.get("email_text") or data.get("text") or ""
+    tone = data.get("tone", "professional")
+    length = data.get("length", "medium")
+    
+    if not email_text:
+        return jsonify({"ok": False, "reply": "No input provided."}), 400
+    try:
+        model = select_model(data, length)
+    except KeyError as e:
+        return unknown_model_response(e.args[0])
+    
+    # Repeat requests on the same thread skip the model; "regenerate" forces a fresh reply
+    cache_key = ResponseCache.key(email_text, tone, length, model)
+    if not data.get("regenerate"):
+        cached = RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            app.logger.info("⚡ Serving cached reply")
+            return jsonify(cached)
+    
+    prefetch_for_load(model)
+    request_id = request_id_for(data)
+    if data.get("two_phase") or request.args.get("two_phase") in ("1", "true"):
+        return generate_two_phase(data, email_text, tone, length, model, request_id)
+    try:
+        job = SCHEDULER.submit(lambda job: run_generation(job, email_text, tone, length, model), timeout=request_timeout(data), request_id=request_id)
+    except QueueFullError:
+        return queue_full_response(email_text, tone, length)
+    
+    if not job.wait(disconnect_probe()):
+        if job.cancelled:
+            payload = cancelled_payload(email_text, tone, length)
+        else:
+            app.logger.warning("⏳ Generation deadline passed, using fallback")
+            payload = fallback_payload("timeout", email_text, tone, length, meta={"timed_out": True})
+        payload["meta"]["request_id"] = request_id
+        return jsonify(payload)
+    
+    if job.cancelled:
+        payload = cancelled_payload(email_text, tone, length)
+    elif job.timed_out:
+        payload = fallback_payload("timeout", email_text, tone, length, meta={"timed_out": True})
+    else:
+        payload = job.result if job.error is None else generation_error_reply(job.error, email_text, tone, length)
+        RESPONSE_CACHE.put(cache_key, payload)
+    payload.setdefault("meta", {}).update(queue_wait=job.wait_time, request_id=request_id)
+    return jsonify(payload)
+
+def generate_two_phase(data, email_text, tone, length, model, request_id):
+    """Answer at once with an instant reply and leave the model reply to /result/<request_id>"""
+    reply, source = instant_reply(email_text, tone, length)
+    INSTANT_REPLIES.inc(source=source)
+    payload = {"ok": True, "from_model": False, "reply": reply, "request_id": request_id, "meta": {"instant_source": source, "request_id": request_id}}
+    try:
+        job = SCHEDULER.submit(lambda job: stream_generation(job, email_text, tone, length, model), timeout=request_timeout(data), request_id=request_id)
+    except QueueFullError:
+        app.logger.warning(f"🚦 Inference queue full ({SCHEDULER.depth()} waiting), instant reply only")
+        payload.update(pending=False)
+        payload["meta"].update(queue_full=True, retry_after=SCHEDULER.retry_after())
+        return jsonify(payload)
+    
+    PENDING.add(request_id, job, email_text, tone, length)
+    payload.update(pending=True, result=f"/result/{request_id}")
+    resp = jsonify(payload)
+    resp.headers["X-Request-Id"] = request_id
+    return resp
+
+def pending_payload(entry):
+    """Final model payload of a finished two-phase job, computed once so fallbacks are counted once"""
+    if entry["payload"] is None:
+        job, email_text, tone, length = entry["job"], entry["email_text"], entry["tone"], entry["length"]
+        if job.expired and job.cancelled:
+            payload = cancelled_payload(email_text, tone, length)
+        elif job.expired:
+            payload = fallback_payload("timeout", email_text, tone, length, meta={"timed_out": True})
+        elif job.error is not None:
+            payload = generation_error_reply(job.error, email_text, tone, length)
+        else:
+            payload = dict(job.result)
+        payload.setdefault("meta", {}).update(queue_wait=job.wait_time)
+        entry["payload"] = payload
+    return entry["payload"]
+
+def pending_done_stream(entry):
+    """Single `done` frame with a two-phase job's final payload, waiting for the job if it is still running"""
+    entry["job"].done.wait(max(0, entry["job"].deadline - time.time()) + REQUEST_DEADLINE)
+    if entry["job"].done.is_set():
+        yield sse_event("done", pending_payload(entry))
+    else:
+        yield sse_event("done", {"ok": True, "done": False, "pending": True})
+
+@app.route("/result/<request_id>", methods=["GET"])
+def result(request_id):
+    """Model reply of a two-phase /generate request.
+    
+    Poll it (optionally long-polling with ?wait=<seconds>), or use ?stream=1 for
+    the same Server-Sent Events as /generate_stream.
+    """
+    entry = PENDING.get(request_id)
+    if entry is None:
+        return jsonify({"ok": False, "error": f"unknown or expired request '{request_id}'"}), 404
+    job = entry["job"]
+    
+    if request.args.get("stream") in ("1", "true") or "text/event-stream" in request.headers.get("Accept", ""):
+        if not job.done.is_set() and PENDING.claim_stream(entry):
+            frames = relay_stream(job, entry["email_text"], entry["tone"], entry["length"])
+        else:
+            # Token frames already went to an earlier stream client; send the final reply once it exists
+            frames = pending_done_stream(entry)
+        return Response(
+            stream_with_context(frames),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Request-Id": request_id}
+        )
+    
+    try:
+        wait = min(RESULT_MAX_WAIT, max(0.0, float(request.args.get("wait", 0))))
+    except ValueError:
+        wait = 0
+    if not job.done.wait(wait):
+        return jsonify({"ok": True, "done": False, "request_id": request_id, "started": job.started_at is not None, "queue_depth": SCHEDULER.depth()})
+    
+    payload = dict(pending_payload(entry), done=True, request_id=request_id)
+    return jsonify(payload)
+
+@app.route("/generate_batch", methods=["POST"])
+def generate_batch():
+    """Generate several reply variants (default: requested, short, long) in one queued job"""
+    RESIDENCY.record_request()
+    REQUESTS.inc(endpoint="generate_batch")
+    data = request.get_json(force=True)
+    email_text = data.get("email_text") or data.get("text") or ""
+    tone = data.get("tone", "professional")
+    length = data.get("length", "medium")
+    
+    if not email_text:
+        return jsonify({"ok": False, "replies": [], "reply": "No input provided."}), 400
+    
+    variants = data.get("variants") or [{"length": length}, {"length": "short"}, {"length": "long"}]
+    variants = [
+        {"tone": v.get("tone", tone), "length": v.get("length", length), "model": v.get("model") or data.get("model")}
+        for v in variants[:5] if isinstance(v, dict)
+    ] or [{"tone": tone, "length": length, "model": data.get("model")}]
+    try:
+        for v in variants:
+            v["model"] = select_model(v, v["length"])
+    except KeyError as e:
+        return unknown_model_response(e.args[0])
+    
+    # Serve straight from the response cache when every variant is already known
+    cache_keys = [ResponseCache.key(email_text, v["tone"], v["length"], v["model"]) for v in variants]
+    if not data.get("regenerate"):
+        cached = [RESPONSE_CACHE.get(k) for k in cache_keys]
+        if all(cached):
+            replies = [c["reply"] for c in cached]
+            return jsonify({
+                "ok": True,
+                "from_model": True,
+                "variants": [dict(v, reply=r, from_model=True) for v, r in zip(variants, replies)],
+                "replies": replies,
+                "reply": replies[0],
+                "meta": {"cached": True}
+            })
+    
+    for model in dict.fromkeys(v["model"] for v in variants):
+        prefetch_for_load(model)
+    request_id = request_id_for(data)
+    try:
+        job = SCHEDULER.submit(lambda job: run_batch_generation(job, email_text, variants), timeout=request_timeout(data), request_id=request_id)
+    except QueueFullError:
+        resp = queue_full_response(email_text, tone, length)
+        body = resp.get_json()
+        body["replies"] = [v["reply"] for v in fallback_variants("queue_full", email_text, variants[1:])]
+        body["replies"].insert(0, body["reply"])
+        resp.set_data(json.dumps(body))
+        return resp
+    
+    if not job.wait(disconnect_probe()):
+        # The worker stops at the next token and hands back the variants it finished
+        job.done.wait(STOP_GRACE)
+    if job.error is not None:
+        app.logger.warning("⏳ Batch generation failed, using fallback")
+        payload = {"ok": False, "from_model": False, "variants": fallback_variants("exception", email_text, variants), "meta": {"timed_out": False}}
+    elif job.result is None and job.cancelled:
+        app.logger.info("🛑 Batch generation cancelled by client")
+        payload = {"ok": False, "from_model": False, "variants": fallback_variants("cancelled", email_text, variants), "meta": {"cancelled": True}}
+    elif job.result is None:
+        app.logger.warning("⏳ Batch generation did not finish, using fallback")
+        payload = {"ok": False, "from_model": False, "variants": fallback_variants("timeout", email_text, variants), "meta": {"timed_out": True}}
+    else:
+        payload = job.result
+        for key, v in zip(cache_keys, payload["variants"]):
+            RESPONSE_CACHE.put(key, {"ok": True, "from_model": v["from_model"], "reply": v["reply"], "meta": {}})
+    
+    payload["replies"] = [v["reply"] for v in payload["variants"]]
+    payload["reply"] = payload["replies"][0]
+    payload.setdefault("meta", {}).update(queue_wait=job.wait_time, request_id=request_id)
+    return jsonify(payload)
+
+@app.route("/cancel/<request_id>", methods=["POST"])
+def cancel(request_id):
+    """Abandon a /generate, /generate_stream or /generate_batch request the client no longer wants"""
+    cancelled = SCHEDULER.cancel(request_id)
+    if cancelled:
+        app.logger.info(f"🛑 Cancelling request {request_id}")
+    return jsonify({"ok": True, "cancelled": cancelled})
+
+@app.route("/prewarm", methods=["POST"])
+def prewarm():
+    """Cheap hint that a compose box opened: start loading the model in the background"""
+    global PREWARM_JOB
+    RESIDENCY.hint()
+    
+    if MODEL_LOADED:
+        return jsonify({"ok": True, "model_loaded": True, "loading": False})
+    if RESIDENCY.memory_pressure():
+        return jsonify({"ok": False, "model_loaded": False, "loading": False, "reason": "memory_pressure"})
+    if not model_exists():
+        return jsonify({"ok": False, "model_loaded": False, "loading": False, "reason": "model_missing"})
+    
+    # Finished, expired and cancelled jobs all set done, so a dropped prewarm never blocks the next one
+    if PREWARM_JOB is None or PREWARM_JOB.done.is_set():
+        app.logger.info("🔥 Prewarming model for an open compose box...")
+        prefetch_for_load()
+        PREWARM_JOB = SCHEDULER.submit(lambda job: load_model(), timeout=120, priority=PRIORITY_BACKGROUND, bounded=False)
+    return jsonify({"ok": True, "model_loaded": False, "loading": True})
+
+def warmup_job():
+    """Load the default model and run a throwaway prompt so its mmap'd weights are paged in.
+    
+    The prompt gives way as soon as a real request is queued: that request pages in the
+    same weights, so it only ever waits for the load itself.
+    """
+    if not load_model():
+        return False
+    READINESS.set("warming", ACTIVE_MODEL)
+    t0 = time.perf_counter()
+    try:
+        prompt = build_prompt(WARMUP_EMAIL, "professional", "short")
+        PREFIX_CACHE.prime(LLAMA, prompt)
+        for _ in LLAMA(prompt, max_tokens=WARMUP_TOKENS, temperature=0.0, stream=True):
+            READINESS.token()
+            if SCHEDULER.depth() > 0:
+                break
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage="warmup")
+        app.logger.info(f"🔥 Model warm after {time.perf_counter() - t0:.1f}s")
+    except Exception as e:
+        app.logger.warning(f"Warm-up prompt failed: {e}")
+    finally:
+        READINESS.set("ready", ACTIVE_MODEL)
+    return True
+
+def start_warmup():
+    """Queue the warm-up on the inference worker; requests arriving meanwhile run right after it"""
+    if RESIDENCY.memory_pressure():
+        print("⚠️ Skipping warm-up: system memory is under pressure")
+        return None
+    if not model_exists():
+        print("⚠️ Skipping warm-up: model file not found")
+        return None
+    print("🔥 Warming up the model in the background...")
+    prefetch_for_load()
+    return SCHEDULER.submit(lambda job: warmup_job(), timeout=120, priority=PRIORITY_BACKGROUND, bounded=False)
+
+@app.route("/profile", methods=["GET", "POST"])
+def profile_endpoint():
+    """Show or switch the inference profile and speculative decoding; switching reloads a loaded model on the worker"""
+    global ACTIVE_PROFILE, SPECULATIVE_MODE
+    if request.method == "GET":
+        return jsonify({"ok": True, "active": ACTIVE_PROFILE, "settings": get_profile(), "profiles": INFERENCE_PROFILES, "speculative": SPECULATION.status()})
+    
+    data = request.get_json(force=True)
+    name = data.get("profile", ACTIVE_PROFILE)
+    if name not in INFERENCE_PROFILES:
+        return jsonify({"ok": False, "error": f"unknown profile '{name}'", "profiles": list(INFERENCE_PROFILES)}), 400
+    speculative = data.get("speculative", SPECULATIVE_MODE)
+    if speculative not in SPECULATIVE_MODES:
+        return jsonify({"ok": False, "error": f"unknown speculative mode '{speculative}'", "modes": list(SPECULATIVE_MODES)}), 400
+    
+    try:
+        ACTIVE_PROFILE, SPECULATIVE_MODE = name, speculative
+        if data.get("persist", True):
+            save_profile_name(name)
+            save_config_value("speculative_decoding", speculative)
+        reloaded = False
+        if MODEL_LOADED:
+            app.logger.info(f"🔁 Switching to {name} profile (speculative: {speculative}), reloading model...")
+            reloaded = SCHEDULER.run(lambda job: load_model(force_reload=True), timeout=120, priority=PRIORITY_INTERACTIVE)
+        return jsonify({
+            "ok": True, "active": ACTIVE_PROFILE, "settings": get_profile(), "speculative": SPECULATION.status(), "reloaded": reloaded,
+            "power_errors": dict(POWER_MODE_ERRORS)  # e.g. an unprivileged process cannot leave the battery profile's idle priority
+        })
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+def models_payload():
+    installed = discover_models()
+    return {
+        "ok": True,
+        "default": DEFAULT_MODEL,
+        "active": ACTIVE_MODEL,
+        "resident": list(RESIDENT),
+        "max_resident": MAX_RESIDENT_MODELS,
+        "length_models": {length: LENGTH_MODELS.get(length) or DEFAULT_MODEL for length in REPLY_LENGTHS},
+        "models": list(installed.values()),
+    }
+
+@app.route("/models", methods=["GET", "POST"])
+def models_endpoint():
+    """List installed GGUF models (read from their headers) or map reply lengths to models"""
+    global LENGTH_MODELS
+    if request.method == "GET":
+        return jsonify(models_payload())
+    
+    data = request.get_json(force=True)
+    mapping = data.get("length_models") or {}
+    installed = discover_models()
+    for length, name in mapping.items():
+        if length not in REPLY_LENGTHS:
+            return jsonify({"ok": False, "error": f"unknown length '{length}'", "lengths": list(REPLY_LENGTHS)}), 400
+        if name and name != DEFAULT_MODEL and name not in installed:
+            return unknown_model_response(name)
+    
+    LENGTH_MODELS = dict(LENGTH_MODELS, **{length: name or None for length, name in mapping.items()})
+    if data.get("persist", True):
+        save_config_value("length_models", {k: v for k, v in LENGTH_MODELS.items() if v})
+    return jsonify(models_payload())
 
 @app.route("/learn_interaction", methods=["POST"])
 def learn_interaction():
@@ -538,9 +2141,7 @@ def learn_interaction():
         return jsonify({"ok": False, "error": "missing data"}), 400
     
     try:
-        from personalization import add_interaction_feedback, add_training_pair, add_sample
-        
-        # Store interaction for learning
+        # Store interaction for learning (queued; committed in batches off the request thread)
         learning_data = {
             "interaction_type": interaction_type,
             "suggestion": suggestion,
@@ -553,17 +2154,17 @@ def learn_interaction():
         # Different learning based on interaction type
         if interaction_type == "selected":
             # User actually used this suggestion - strongest positive signal
-            add_sample(suggestion)
-            add_training_pair(original_email, suggestion, context)
-            add_interaction_feedback(learning_data, weight=1.0)
+            WRITER.add_sample(suggestion)
+            WRITER.add_training_pair(original_email, suggestion, context)
+            WRITER.add_interaction_feedback(learning_data, weight=1.0)
             
         elif interaction_type == "thumbs_up":
             # User liked it but didn't use - positive signal
-            add_interaction_feedback(learning_data, weight=0.7)
+            WRITER.add_interaction_feedback(learning_data, weight=0.7)
             
         elif interaction_type == "thumbs_down":
             # User disliked it - negative signal for learning
-            add_interaction_feedback(learning_data, weight=-0.5)
+            WRITER.add_interaction_feedback(learning_data, weight=-0.5)
         
         return jsonify({
             "ok": True, 
@@ -588,30 +2189,34 @@ def remember():
         return jsonify({"ok": False, "error": "no text"}), 400
     try:
         # Store the chosen reply for learning
-        add_sample(text)
+        WRITER.add_sample(text)
         
         # Store training pair if we have original email
         if original_email:
-            add_training_pair(original_email, text, context)
+            WRITER.add_training_pair(original_email, text, context)
         
         return jsonify({"ok": True, "learned": True})
     except Exception as e:
         app.logger.exception("Remember failed")
         return jsonify({"ok": False, "error": str(e)}), 500
 
-@app.route("/samples", methods=["GET"])
-def samples():
-    limit = int(request.args.get("limit", 50))
+def samples_payload(limit):
+    """(payload, status) for /samples; touches the DB, so async callers run it in a thread pool"""
     try:
-        s = list_samples(limit=limit)
-        return jsonify({"ok": True, "samples": s})
+        return {"ok": True, "samples": list_samples(limit=limit)}, 200
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+        return {"ok": False, "error": str(e)}, 500
+
+@app.route("/samples", methods=["GET"])
+def samples():
+    payload, status = samples_payload(int(request.args.get("limit", 50)))
+    return jsonify(payload), status
 
 @app.route("/clear_personalization", methods=["POST"])
 def clear_pers():
     try:
         clear_samples()
+        RESPONSE_CACHE.clear()
         return jsonify({"ok": True})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
@@ -620,12 +2225,13 @@ def clear_pers():
 def learning_stats():
     """Get learning statistics and storage info"""
     try:
-        from personalization import analyze_user_patterns, get_training_pairs, list_samples, get_storage_status, get_email_context_insights
+        from personalization import analyze_user_patterns, get_style_profile, get_storage_status, get_email_context_insights
         
+        # Patterns come from the materialized style profile; counts from indexed COUNT(*)s
         patterns = analyze_user_patterns()
-        training_count = len(get_training_pairs(1000))
-        sample_count = len(list_samples(1000))
         storage_status = get_storage_status()
+        training_count = storage_status["training_pairs"]
+        sample_count = storage_status["samples"]
         email_insights = get_email_context_insights()
         
         # Count email patterns analyzed
@@ -636,6 +2242,7 @@ def learning_stats():
             "writing_samples": sample_count,
             "email_patterns_analyzed": email_pattern_count,
             "patterns": patterns,
+            "style_version": get_style_profile()["version"],
             "email_insights": email_insights,
             "learning_active": training_count > 0 or email_pattern_count > 0,
             "personalization_level": min(100, (training_count + sample_count + email_pattern_count)),
@@ -716,7 +2323,7 @@ def cleanup_storage():
 def export_style():
     path = os.path.join(os.path.dirname(__file__), "style_export.json")
     try:
-        from personalization import analyze_user_patterns, get_training_pairs
+        from personalization import analyze_user_patterns, get_training_pairs, get_style_profile
         
         s = list_samples(limit=500)
         training_pairs = get_training_pairs(100)
@@ -728,6 +2335,7 @@ def export_style():
             "samples": s,
             "training_pairs": training_pairs,
             "patterns": patterns,
+            "style_version": get_style_profile()["version"],
             "export_date": time.time()
         }
         
@@ -742,25 +2350,39 @@ def export_style():
 def manual_unload():
     """Manually unload model to free memory"""
     try:
-        unload_model()
+        SCHEDULER.run(lambda job: unload_model(), priority=PRIORITY_INTERACTIVE)
         return jsonify({"ok": True, "message": "Model unloaded successfully"})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-@app.route("/memory_status", methods=["GET"])
-def memory_status():
-    """Get current memory and CPU status with optimization limits"""
-    import psutil
-    process = psutil.Process()
-    memory_info = process.memory_info()
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus text exposition of stage timings, fallbacks, queue and cache counters"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+def queue_status_payload():
+    return {"ok": True, "queue": SCHEDULER.status(), "pending_replies": PENDING.status()}
+
+@app.route("/queue_status", methods=["GET"])
+def queue_status():
+    """Inference queue depth and wait-time metrics"""
+    return jsonify(queue_status_payload())
+
+# Own Process handle so cpu_percent() measures the span since the previous status poll instead of sleeping
+STATUS_PROCESS = psutil.Process()
+STATUS_PROCESS.cpu_percent(None)
+
+def memory_status_payload():
+    """Current memory and CPU status with optimization limits; never blocks"""
+    memory_info = STATUS_PROCESS.memory_info()
     memory_mb = round(memory_info.rss / 1024 / 1024, 1)
-    cpu_percent = round(process.cpu_percent(interval=0.1), 1)
+    cpu_percent = round(STATUS_PROCESS.cpu_percent(None), 1)
     
     # Check if within optimization limits
     memory_optimized = memory_mb <= MAX_IDLE_MEMORY_MB
     cpu_optimized = cpu_percent <= MAX_IDLE_CPU_PERCENT
     
-    return jsonify({
+    return {
         "model_loaded": MODEL_LOADED,
         "memory_mb": memory_mb,
         "cpu_percent": cpu_percent,
@@ -771,8 +2393,23 @@ def memory_status():
         "last_used": LAST_USED,
         "idle_time": round(time.time() - LAST_USED, 1) if LAST_USED > 0 else 0,
         "will_unload_in": max(0, IDLE_TIMEOUT - (time.time() - LAST_USED)) if LAST_USED > 0 and MODEL_LOADED else 0,
-        "optimization_status": "✅ Optimized" if memory_optimized and cpu_optimized else "⚠️ High Usage"
-    })
+        "residency": RESIDENCY.status(time.time() - LAST_USED if LAST_USED > 0 else 0),
+        "models": {"active": ACTIVE_MODEL, "resident": list(RESIDENT), "max_resident": MAX_RESIDENT_MODELS},
+        "page_cache": page_cache_payload(),
+        "speculative": SPECULATION.status(),
+        "optimization_status": "✅ Optimized" if memory_optimized and cpu_optimized else "⚠️ High Usage",
+        "queue": SCHEDULER.status(),
+        "prefix_cache": PREFIX_CACHE.status(),
+        "learning_queue": WRITER.status(),
+        "example_index": EXAMPLES.status(),
+        "storage_maintenance": MAINTENANCE.status(),
+        "response_cache": RESPONSE_CACHE.status()
+    }
+
+@app.route("/memory_status", methods=["GET"])
+def memory_status():
+    """Get current memory and CPU status with optimization limits"""
+    return jsonify(memory_status_payload())
 
 def start_background_learning_service():
     """Start continuous background learning service (even when model unloaded)"""
@@ -806,8 +2443,8 @@ def start_background_learning_service():
                         elif task == 1:
                             # Optimize database
                             app.logger.info("🗜️ Background service: Database optimization...")
-                            from personalization import smart_cleanup
-                            smart_cleanup()
+                            from personalization import MAINTENANCE
+                            MAINTENANCE.request()
                             
                         elif task == 2:
                             # Process feedback for learning
@@ -833,10 +2470,13 @@ def start_background_learning_service():
     bg_thread.start()
     app.logger.info("🤖 Background learning service started")
 
-if __name__ == "__main__":
+def run_flask():
+    app.run(host="127.0.0.1", port=8081, threaded=True, debug=False)
+
+def start_server(run=run_flask):
     print("🚀 Starting svarx.ai Server with Ultra-Low Resource Usage...")
     print("📊 Memory Management: ON-DEMAND loading, 1-minute auto-unload, <500MB idle")
-    print("🔋 Power Management: Max 5% CPU when idle, single-core processing")
+    print(f"🔋 Power Management: {ACTIVE_PROFILE} profile (battery = max 5% CPU, single-core processing)")
     print("💾 Model loads only when needed, ultra-efficient training mode")
     print("🧠 Background Learning: Continuous learning even when idle")
     print("🔧 Server available at: http://127.0.0.1:8081")
@@ -848,8 +2488,19 @@ if __name__ == "__main__":
     # Start background learning service
     start_background_learning_service()
     
-    # Don't load model at startup - load on-demand only
-    print("✅ Server ready - model will load on first request with minimal power")
+    # Load at startup only when warm-up is on (--warmup / GMAIL_AI_WARMUP); otherwise on-demand only
+    if WARMUP_ON_START:
+        start_warmup()
+    else:
+        print("✅ Server ready - model will load on first request with minimal power")
     print("🤖 Background learning active - AI improves continuously")
     
-    app.run(host="127.0.0.1", port=8081, threaded=True, debug=False)
+    run()
+
+if __name__ == "__main__":
+    # --asgi (or GMAIL_AI_ASGI=1) serves status routes asynchronously; needs starlette, a2wsgi and uvicorn
+    if "--asgi" in sys.argv or os.environ.get("GMAIL_AI_ASGI") == "1":
+        from asgi_server import serve
+        start_server(lambda: serve(sys.modules[__name__]))
+    else:
+        start_server()
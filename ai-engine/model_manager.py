@@ -2,6 +2,12 @@
 from pathlib import Path
 import platform
 import os
+import mmap
+import time
+import ctypes
+import struct
+import threading
+import psutil
 
 SYSTEM = platform.system()
 
@@ -54,3 +60,302 @@ def model_path_str(path: Path = None) -> str:
     if path is None:
         path = get_model_path()
     return str(path)
+
+# Model registry: every GGUF in the program and local model directories, described from its header
+GGUF_MAGIC = b"GGUF"
+
+# llama.cpp file types (general.file_type) -> quantization label
+GGUF_FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1",
+    10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M",
+    16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S",
+    22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M",
+    28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16",
+}
+
+# GGUF value types -> struct format (8 = string, 9 = array)
+_GGUF_SCALARS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+
+class _GGUFReader:
+    def __init__(self, f, version):
+        self.f = f
+        self.version = version  # v1 used 32-bit lengths and counts
+    
+    def unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        data = self.f.read(size)
+        if len(data) != size:
+            raise ValueError("truncated GGUF header")
+        return struct.unpack(fmt, data)[0]
+    
+    def count(self):
+        return self.unpack("<I" if self.version == 1 else "<Q")
+    
+    def string(self):
+        return self.f.read(self.count()).decode("utf-8", "replace")
+    
+    def value(self, vtype):
+        if vtype == 8:
+            return self.string()
+        if vtype == 9:
+            # Array values are never needed, and the large ones (tokenizer vocabulary and
+            # merges, ~400k strings for Llama 3) are skipped without decoding
+            item_type, n = self.unpack("<I"), self.count()
+            if item_type in _GGUF_SCALARS:
+                self.f.seek(n * struct.calcsize(_GGUF_SCALARS[item_type]), os.SEEK_CUR)
+            elif item_type == 8:
+                for _ in range(n):
+                    self.f.seek(self.count(), os.SEEK_CUR)
+            else:
+                for _ in range(n):
+                    self.value(item_type)
+            return None
+        if vtype not in _GGUF_SCALARS:
+            raise ValueError(f"unknown GGUF value type {vtype}")
+        return self.unpack(_GGUF_SCALARS[vtype])
+
+def _params_label(count):
+    if count >= 1e9:
+        return f"{count / 1e9:.1f}B"
+    return f"{count / 1e6:.0f}M"
+
+def read_gguf_metadata(path):
+    """Architecture, parameter count, quantization and trained context length from a GGUF header.
+    
+    Only the header and tensor table are read; the weights are never touched.
+    """
+    path = Path(path)
+    with open(path, "rb") as f:
+        if f.read(4) != GGUF_MAGIC:
+            raise ValueError(f"{path.name} is not a GGUF file")
+        reader = _GGUFReader(f, struct.unpack("<I", f.read(4))[0])
+        n_tensors, n_kv = reader.count(), reader.count()
+        kv = {}
+        for _ in range(n_kv):
+            key = reader.string()
+            kv[key] = reader.value(reader.unpack("<I"))
+        
+        # Sum element counts over the tensor table for the exact parameter count
+        params = 0
+        for _ in range(n_tensors):
+            reader.string()
+            n_dims = reader.unpack("<I")
+            elements = 1
+            for _ in range(n_dims):
+                elements *= reader.count()
+            reader.unpack("<I")  # tensor type
+            reader.unpack("<Q")  # data offset
+            params += elements
+        
+        # Tensor data starts after the tensor table, padded to the file's alignment
+        alignment = kv.get("general.alignment") or 32
+        data_offset = f.tell() + (-f.tell() % alignment)
+    
+    arch = kv.get("general.architecture") or "unknown"
+    file_type = kv.get("general.file_type")
+    return {
+        "name": path.stem,
+        "path": str(path),
+        "size_mb": round(path.stat().st_size / 1024 / 1024, 1),
+        "architecture": arch,
+        "model_name": kv.get("general.name") or path.stem,
+        "params": params,
+        "params_label": kv.get("general.size_label") or _params_label(params),
+        "quantization": GGUF_FILE_TYPES.get(file_type, f"type {file_type}") if file_type is not None else "unknown",
+        "context_length": kv.get(f"{arch}.context_length"),
+        "data_offset": data_offset,
+    }
+
+def model_dirs():
+    """Directories searched for GGUF files, in order of preference"""
+    return [program_model_dir(), Path(__file__).parent / "models"]
+
+_metadata_cache = {}  # path -> ((mtime, size), metadata)
+_registry_lock = threading.Lock()
+
+def _cached_metadata(path, stat):
+    version = (stat.st_mtime, stat.st_size)
+    cached = _metadata_cache.get(path)
+    if cached is None or cached[0] != version:
+        cached = (version, read_gguf_metadata(path))
+        _metadata_cache[path] = cached
+    return cached[1]
+
+def model_metadata(path):
+    """read_gguf_metadata(), parsed once per file version"""
+    path = Path(path)
+    with _registry_lock:
+        return _cached_metadata(path, path.stat())
+
+def discover_models():
+    """{name: metadata} for every readable GGUF in model_dirs(); the program directory wins on name clashes.
+    
+    Headers are parsed once per file version, so calling this per request is cheap.
+    """
+    models = {}
+    with _registry_lock:
+        for directory in model_dirs():
+            if not directory.is_dir():
+                continue
+            for path in sorted(directory.glob("*.gguf")):
+                try:
+                    stat = path.stat()
+                    if stat.st_size <= 1000 or path.stem in models:
+                        continue
+                    models[path.stem] = _cached_metadata(path, stat)
+                except (OSError, ValueError, struct.error) as e:
+                    print(f"⚠️ Skipping model {path.name}: {e}")
+    return models
+
+DEFAULT_MODEL = Path(MODEL_FILENAME).stem
+
+def resolve_model_path(name=None):
+    """Path of a registered model by name (file stem); None or the default name gives get_model_path()"""
+    if not name or name == DEFAULT_MODEL:
+        return get_model_path()
+    info = discover_models().get(name)
+    return Path(info["path"]) if info else None
+
+# Page cache: llama.cpp mmaps the weights, so a load after an unload is only fast if the
+# file is still (or again) in the OS page cache
+PREFETCH_CHUNK = 4 * 1024 * 1024  # Bytes per read-ahead step
+PREFETCH_MIN_FREE = 1.2           # Prefetch only when available RAM covers this multiple of the file
+PREFETCH_SKIP_RESIDENT = 0.95     # Nothing to do once this share of the file is cached
+
+_libc = None
+
+def _mincore_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+        _libc = libc
+    return _libc
+
+def page_cache_residency(path):
+    """(cached bytes, file size) of a file, from mincore(2); None where unsupported (Windows)"""
+    if SYSTEM == "Windows":
+        return None
+    try:
+        libc = _mincore_libc()
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return 0, 0
+            # Mapping without touching the pages does not change what is cached
+            addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, f.fileno(), 0)
+            if addr in (None, ctypes.c_void_p(-1).value):
+                return None
+            try:
+                pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+                vec = (ctypes.c_ubyte * pages)()
+                if libc.mincore(addr, size, vec) != 0:
+                    return None
+                resident = pages - bytes(vec).count(0)
+            finally:
+                libc.munmap(addr, size)
+        return min(size, resident * mmap.PAGESIZE), size
+    except (OSError, AttributeError):
+        return None
+
+def page_cache_status(path):
+    residency = page_cache_residency(path)
+    if residency is None:
+        return None
+    cached, size = residency
+    return {
+        "cached_mb": round(cached / 1024 / 1024, 1),
+        "size_mb": round(size / 1024 / 1024, 1),
+        "cached_percent": round(100 * cached / size, 1) if size else 0,
+    }
+
+def _lower_thread_priority():
+    """Idle CPU and I/O priority for the calling thread; only Linux has per-thread priorities"""
+    if SYSTEM != "Linux":
+        return
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except OSError:
+        pass
+    try:
+        psutil.Process(tid).ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (psutil.Error, OSError, AttributeError):
+        pass
+
+class Prefetcher:
+    """Pulls a model's tensor data into the page cache on a low-priority thread before it is loaded.
+    
+    The tensor range is read sequentially in PREFETCH_CHUNK steps, after a
+    posix_fadvise(WILLNEED) hint where the OS has one.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = {}  # path -> thread
+        self.started = 0
+        self.skipped = 0
+        self.last = None
+    
+    def prefetch(self, path):
+        """Start prefetching path unless it is already cached or running, or RAM is short; True if started"""
+        path = Path(path)
+        with self._lock:
+            thread = self._active.get(path)
+            if thread is not None and thread.is_alive():
+                return False
+            try:
+                size = path.stat().st_size
+                residency = page_cache_residency(path)
+                if residency and residency[0] >= size * PREFETCH_SKIP_RESIDENT:
+                    self.skipped += 1
+                    return False
+                # Reading 2GB into the cache under memory pressure would only evict something else
+                if psutil.virtual_memory().available < size * PREFETCH_MIN_FREE:
+                    self.skipped += 1
+                    return False
+            except OSError:
+                return False
+            thread = threading.Thread(target=self._run, args=(path, size), name="model-prefetch", daemon=True)
+            self._active[path] = thread
+            self.started += 1
+        thread.start()
+        return True
+    
+    def _run(self, path, size):
+        _lower_thread_priority()
+        t0 = time.time()
+        status = {"model": path.stem, "bytes": 0, "seconds": None, "error": None}
+        self.last = status
+        try:
+            try:
+                offset = model_metadata(path)["data_offset"]
+            except (OSError, ValueError, KeyError, struct.error):
+                offset = 0
+            with open(path, "rb", buffering=0) as f:
+                if hasattr(os, "posix_fadvise"):
+                    # A hint only: the kernel caps WILLNEED read-ahead, so the read below still runs
+                    os.posix_fadvise(f.fileno(), offset, size - offset, os.POSIX_FADV_SEQUENTIAL)
+                    os.posix_fadvise(f.fileno(), offset, size - offset, os.POSIX_FADV_WILLNEED)
+                f.seek(offset)
+                buf = bytearray(PREFETCH_CHUNK)
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    status["bytes"] += n
+        except OSError as e:
+            status["error"] = str(e)
+        finally:
+            status["seconds"] = round(time.time() - t0, 2)
+            with self._lock:
+                self._active.pop(path, None)
+    
+    def status(self):
+        with self._lock:
+            active = [p.stem for p, t in self._active.items() if t.is_alive()]
+        return {"active": active, "started": self.started, "skipped": self.skipped, "last": self.last}
+
+PREFETCHER = Prefetcher()
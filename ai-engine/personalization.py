@@ -1,11 +1,14 @@
 # personalization.py
-import sqlite3, re, json, time, threading
+import sqlite3, re, json, time, threading, os, queue, atexit
 from pathlib import Path
 from collections import Counter
+from contextlib import contextmanager
 import hashlib
+from retrieval import ExampleIndex
+from classifier import classify
 
 BASE = Path(__file__).resolve().parent
-DB_PATH = BASE / "personalization.db"
+DB_PATH = Path(os.environ.get("GMAIL_AI_DB_PATH") or BASE / "personalization.db")
 
 # Extensive Learning Limits with 10GB Storage
 MAX_SAMPLES = 50000         # Massive learning capacity
@@ -14,13 +17,47 @@ MAX_INTERACTIONS = 100000   # Comprehensive user feedback
 MAX_EMAIL_PATTERNS = 10000  # Deep email pattern analysis
 MAX_DB_SIZE_MB = 5120       # 5GB for optimal learning capacity
 
-lock = threading.Lock()
+# SQLite tuning: WAL lets readers run alongside the single writer
+DB_POOL_SIZE = 4                  # Long-lived connections shared by all request threads
+DB_CACHE_SIZE_KB = 8192           # Page cache per connection (8MB)
+DB_MMAP_SIZE = 64 * 1024 * 1024   # Memory-map the first 64MB of the database
+DB_BUSY_TIMEOUT = 30              # Seconds to wait for another writer
+
+# Maintenance: cleanup runs on its own thread in short write transactions
+SIZE_CHECK_INTERVAL = 30          # Seconds a cached page-count size reading stays valid
+MAINTENANCE_SLICE_SECONDS = 0.05  # Time budget for one incremental_vacuum slice
+MAINTENANCE_PAUSE = 0.05          # Gap between slices so request writers get the lock
+VACUUM_PAGES_PER_STEP = 64        # Pages released per incremental_vacuum step
+
+# Similar-email index over training pairs (memmap files next to the database)
+EXAMPLE_INDEX_PATH = DB_PATH.with_name(DB_PATH.stem + "-examples")
+EXAMPLE_MIN_SCORE = 0.2       # Cosine similarity below which a past reply isn't shown to the model
+EXAMPLE_REINDEX_DRIFT = 0.1   # Rebuild when the index and the table differ by more than this fraction
+
+# Write-behind: learning writes from request handlers are committed together on a background thread
+WRITE_BEHIND_INTERVAL = 0.25  # Seconds to gather writes before committing a batch
+WRITE_BEHIND_BATCH = 32       # Commit early once this many writes are waiting
+
+lock = threading.Lock()  # Serializes writers; readers never take it
+
+# Bumped on every write that changes what was learned; response caches key on it
+_version = 0
+
+# Style profile: aggregates over the most recent pairs/samples, kept up to date on every write
+STYLE_PAIR_WINDOW = 50     # Recent training pairs that set tone, length and starters
+STYLE_SAMPLE_WINDOW = 100  # Recent writing samples that set formality
+
+_style = None            # In-memory copy of the style_profile row
+_pending_style = None    # Written in the current transaction, published on commit
+_after_commit = []       # Side effects (e.g. index updates) to run once the current write commits
+_summary_cache = None    # (style version, max_len, summary)
 
 CREATE_SQL = """
 CREATE TABLE IF NOT EXISTS samples (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     created_at INTEGER,
-    text TEXT
+    text TEXT,
+    text_hash TEXT
 );
 
 CREATE TABLE IF NOT EXISTS training_pairs (
@@ -30,7 +67,9 @@ CREATE TABLE IF NOT EXISTS training_pairs (
     chosen_reply TEXT,
     tone TEXT,
     length TEXT,
-    user_rating INTEGER DEFAULT 0
+    user_rating INTEGER DEFAULT 0,
+    email_hash TEXT,
+    reply_hash TEXT
 );
 
 CREATE TABLE IF NOT EXISTS model_versions (
@@ -52,17 +91,110 @@ CREATE TABLE IF NOT EXISTS interaction_feedback (
     weight REAL,
     context TEXT
 );
+
+CREATE TABLE IF NOT EXISTS phrase_counts (
+    phrase TEXT PRIMARY KEY,
+    kind INTEGER,
+    n INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS style_profile (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER,
+    updated_at INTEGER,
+    stats TEXT
+);
+"""
+
+INDEX_SQL = """
+CREATE UNIQUE INDEX IF NOT EXISTS idx_samples_text_hash ON samples(text_hash);
+CREATE INDEX IF NOT EXISTS idx_samples_created_at ON samples(created_at);
+CREATE INDEX IF NOT EXISTS idx_pairs_email_hash ON training_pairs(email_hash);
+CREATE INDEX IF NOT EXISTS idx_pairs_reply_hash ON training_pairs(reply_hash);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_pairs_pair_hash ON training_pairs(email_hash, reply_hash);
+CREATE INDEX IF NOT EXISTS idx_pairs_created_at ON training_pairs(created_at);
+CREATE INDEX IF NOT EXISTS idx_pairs_rating ON training_pairs(user_rating, created_at);
+CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON interaction_feedback(created_at);
+CREATE INDEX IF NOT EXISTS idx_feedback_weight ON interaction_feedback(weight, created_at);
+CREATE INDEX IF NOT EXISTS idx_phrase_counts_top ON phrase_counts(kind, n);
 """
 
 def _connect():
-    conn = sqlite3.connect(str(DB_PATH), check_same_thread=False)
+    conn = sqlite3.connect(str(DB_PATH), check_same_thread=False, timeout=DB_BUSY_TIMEOUT)
+    # Only takes effect on a brand-new file (before WAL writes the header); older files are converted at init
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
-with lock:
-    conn = _connect()
-    conn.executescript(CREATE_SQL)
-    conn.commit()
-    conn.close()
+class ConnectionPool:
+    """Small pool of long-lived, WAL-configured connections"""
+    def __init__(self, size):
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            conn = _connect() if create else self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+POOL = ConnectionPool(DB_POOL_SIZE)
+
+@contextmanager
+def _reading():
+    """Connection for read-only queries; runs concurrently with other readers and the writer"""
+    with POOL.connection() as conn:
+        try:
+            yield conn
+        finally:
+            # End the implicit read transaction so WAL checkpoints can progress
+            if conn.in_transaction:
+                conn.rollback()
+
+@contextmanager
+def _writing():
+    """Connection for writes; one writer at a time, committed on success"""
+    global _style, _pending_style
+    with lock, POOL.connection() as conn:
+        try:
+            yield conn
+            conn.commit()
+            if _pending_style:
+                _style = _pending_style
+            for action in _after_commit:
+                try:
+                    action()
+                except Exception as e:
+                    print(f"⚠️  Post-commit update failed: {e}")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            _pending_style = None
+            _after_commit.clear()
+
+def _bump_version():
+    global _version
+    _version += 1
+
+def get_personalization_version() -> int:
+    """Current learning version (changes whenever samples, pairs or feedback change)"""
+    return _version
 
 def sanitize_text(s: str) -> str:
     s = s.strip()
@@ -74,145 +206,361 @@ def get_text_hash(text: str) -> str:
     """Generate hash for duplicate detection"""
     return hashlib.md5(text.encode()).hexdigest()[:16]
 
-def get_db_size_mb() -> float:
-    """Get current database size in MB"""
-    try:
-        return DB_PATH.stat().st_size / (1024 * 1024)
-    except:
-        return 0.0
+def _phrase_grams(text):
+    """Unigram (kind 1) and bigram (kind 2) counts for a single text"""
+    tokens = re.findall(r"\b\w+\b", sanitize_text(text).lower())
+    grams = Counter((t, 1) for t in tokens)
+    grams.update((f"{a} {b}", 2) for a, b in zip(tokens, tokens[1:]))
+    return grams
 
-def smart_cleanup():
-    """Intelligent cleanup to maintain storage limits - Enhanced Version"""
-    with lock:
-        conn = _connect()
-        cur = conn.cursor()
-        
-        print("🧹 Starting intelligent storage cleanup...")
-        
-        # 1. Remove exact duplicates first
-        cur.execute("""
-            DELETE FROM samples WHERE id NOT IN (
-                SELECT MIN(id) FROM samples GROUP BY text
-            )
-        """)
-        duplicates_removed = cur.rowcount
-        
-        cur.execute("""
-            DELETE FROM training_pairs WHERE id NOT IN (
-                SELECT MIN(id) FROM training_pairs 
-                GROUP BY original_email, chosen_reply
-            )
-        """)
-        
-        # 2. Remove old negative feedback (keep positive feedback longer)
-        old_threshold = int(time.time()) - 30*24*3600  # 30 days
-        cur.execute("""
-            DELETE FROM interaction_feedback 
-            WHERE feedback = 'negative' AND created_at < ?
-        """, (old_threshold,))
-        
-        # 3. Compress old data by keeping only the best examples
-        # Keep samples with diverse vocabulary (avoid repetitive content)
-        cur.execute("SELECT COUNT(*) FROM samples")
-        sample_count = cur.fetchone()[0]
-        
-        if sample_count > MAX_SAMPLES:
-            # Keep 80% most recent + 20% highest quality older samples
-            recent_limit = int(MAX_SAMPLES * 0.8)
-            quality_limit = int(MAX_SAMPLES * 0.2)
-            
-            # Keep most recent samples
-            cur.execute("""
-                CREATE TEMP TABLE keep_samples AS
-                SELECT id FROM samples ORDER BY created_at DESC LIMIT ?
-            """, (recent_limit,))
-            
-            # Add quality older samples (longer, more diverse text)
-            cur.execute("""
-                INSERT INTO keep_samples 
-                SELECT id FROM samples 
-                WHERE id NOT IN (SELECT id FROM keep_samples)
-                AND LENGTH(text) > 50
-                ORDER BY LENGTH(text) DESC, created_at DESC 
-                LIMIT ?
-            """, (quality_limit,))
-            
-            # Remove samples not in keep list
-            cur.execute("DELETE FROM samples WHERE id NOT IN (SELECT id FROM keep_samples)")
-            cur.execute("DROP TABLE keep_samples")
-        
-        # 4. Smart training pair management
-        cur.execute("SELECT COUNT(*) FROM training_pairs")
-        pair_count = cur.fetchone()[0]
-        
-        if pair_count > MAX_TRAINING_PAIRS:
-            # Prioritize: Recent + High ratings + Diverse tones
-            cur.execute("""
-                DELETE FROM training_pairs WHERE id NOT IN (
-                    SELECT id FROM (
-                        -- Recent pairs (70%)
-                        SELECT id FROM training_pairs 
-                        ORDER BY created_at DESC 
-                        LIMIT ?
-                        
-                        UNION
-                        
-                        -- High-rated diverse pairs (30%)
-                        SELECT id FROM training_pairs 
-                        WHERE user_rating >= 4
-                        ORDER BY user_rating DESC, created_at DESC
-                        LIMIT ?
-                    )
-                )
-            """, (int(MAX_TRAINING_PAIRS * 0.7), int(MAX_TRAINING_PAIRS * 0.3)))
-        
-        # 5. Keep only valuable interactions (weighted by importance)
-        cur.execute("SELECT COUNT(*) FROM interaction_feedback")
-        interaction_count = cur.fetchone()[0]
-        
-        if interaction_count > MAX_INTERACTIONS:
-            cur.execute("""
-                DELETE FROM interaction_feedback WHERE id NOT IN (
-                    SELECT id FROM interaction_feedback 
-                    WHERE weight > 0.5 OR feedback = 'selected'
-                    ORDER BY weight DESC, created_at DESC 
-                    LIMIT ?
-                )
-            """, (MAX_INTERACTIONS,))
-        
-        # 6. Clean up email patterns (keep only recent diverse patterns)
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='email_patterns'")
-        if cur.fetchone():
-            cur.execute("SELECT COUNT(*) FROM email_patterns")
-            pattern_count = cur.fetchone()[0]
-            
-            if pattern_count > MAX_EMAIL_PATTERNS:
-                cur.execute("""
-                    DELETE FROM email_patterns WHERE id NOT IN (
-                        SELECT id FROM email_patterns 
-                        ORDER BY created_at DESC 
-                        LIMIT ?
-                    )
-                """, (MAX_EMAIL_PATTERNS,))
-        
-        # 7. Vacuum database to reclaim space
-        cur.execute("VACUUM")
-        
+def _count_phrases(cur, texts, sign=1):
+    """Add (sign=1) or remove (sign=-1) texts from the running n-gram counts"""
+    grams = Counter()
+    for text in texts:
+        grams.update(_phrase_grams(text))
+    if not grams:
+        return
+    cur.executemany("""
+        INSERT INTO phrase_counts (phrase, kind, n) VALUES (?,?,?)
+        ON CONFLICT(phrase) DO UPDATE SET n = n + excluded.n
+    """, [(phrase, kind, sign * n) for (phrase, kind), n in grams.items()])
+    if sign < 0:
+        cur.execute("DELETE FROM phrase_counts WHERE n <= 0")
+
+def _delete_samples(cur, where, params=()):
+    """Delete samples matching `where`, keeping phrase counts in step; returns rows removed"""
+    cur.execute(f"SELECT text FROM samples WHERE {where}", params)
+    _count_phrases(cur, [r[0] for r in cur.fetchall()], sign=-1)
+    cur.execute(f"DELETE FROM samples WHERE {where}", params)
+    return cur.rowcount
+
+def _empty_style_stats():
+    return {
+        "pairs": 0, "reply_words": 0, "tones": {}, "starters": {},
+        "samples": 0, "formal": 0, "casual": 0,
+        "feedback": {"positive": 0, "negative": 0}
+    }
+
+def _apply_pair(stats, tone, reply, sign=1):
+    words = reply.split()
+    stats["pairs"] += sign
+    stats["reply_words"] += sign * len(words)
+    stats["tones"][tone] = stats["tones"].get(tone, 0) + sign
+    if len(words) >= 3:
+        starter = " ".join(words[:3])
+        stats["starters"][starter] = stats["starters"].get(starter, 0) + sign
+    # Drop zero entries so the dicts stay bounded by the window size
+    stats["tones"] = {k: v for k, v in stats["tones"].items() if v > 0}
+    stats["starters"] = {k: v for k, v in stats["starters"].items() if v > 0}
+
+def _apply_sample(stats, text, sign=1):
+    # Samples the classifier reads as formal / casual; "medium" ones count for neither
+    formality = classify(text)["formality"]
+    stats["samples"] += sign
+    if formality == "high":
+        stats["formal"] += sign
+    elif formality == "low":
+        stats["casual"] += sign
+
+def _save_style(cur, stats):
+    """Persist new style stats; the in-memory copy is swapped in once the write commits"""
+    global _pending_style
+    current = _pending_style or _style
+    version = (current["version"] if current else 0) + 1
+    updated_at = int(time.time())
+    cur.execute("""
+        INSERT INTO style_profile (id, version, updated_at, stats) VALUES (1,?,?,?)
+        ON CONFLICT(id) DO UPDATE SET version = excluded.version, updated_at = excluded.updated_at, stats = excluded.stats
+    """, (version, updated_at, json.dumps(stats)))
+    _pending_style = {"version": version, "updated_at": updated_at, "stats": stats}
+    return _pending_style
+
+def _rebuild_style(cur):
+    """Recompute the style profile from the recent windows (after bulk deletes)"""
+    stats = _empty_style_stats()
+    cur.execute("SELECT tone, chosen_reply FROM training_pairs ORDER BY created_at DESC, id DESC LIMIT ?", (STYLE_PAIR_WINDOW,))
+    for tone, reply in cur.fetchall():
+        _apply_pair(stats, tone, reply)
+    cur.execute("SELECT text FROM samples ORDER BY created_at DESC, id DESC LIMIT ?", (STYLE_SAMPLE_WINDOW,))
+    for (text,) in cur.fetchall():
+        _apply_sample(stats, text)
+    cur.execute("SELECT SUM(weight > 0), SUM(weight < 0) FROM interaction_feedback")
+    positive, negative = cur.fetchone()
+    stats["feedback"] = {"positive": positive or 0, "negative": negative or 0}
+    return _save_style(cur, stats)
+
+def _load_style(cur):
+    cur.execute("SELECT version, updated_at, stats FROM style_profile WHERE id = 1")
+    row = cur.fetchone()
+    if not row:
+        return _rebuild_style(cur)
+    return {"version": row[0], "updated_at": row[1], "stats": json.loads(row[2])}
+
+def _updated_style():
+    """Copy of the current stats to modify inside a write"""
+    return json.loads(json.dumps((_pending_style or _style)["stats"]))
+
+def _column_names(cur, table):
+    return {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+
+def _migrate_hash_columns(cur):
+    """v1: hash columns for duplicate checks (indexes follow in INDEX_SQL)"""
+    if "text_hash" not in _column_names(cur, "samples"):
+        cur.execute("ALTER TABLE samples ADD COLUMN text_hash TEXT")
+    for column in ("email_hash", "reply_hash"):
+        if column not in _column_names(cur, "training_pairs"):
+            cur.execute(f"ALTER TABLE training_pairs ADD COLUMN {column} TEXT")
+    
+    # Backfill hashes for existing rows
+    cur.execute("UPDATE samples SET text_hash = text_hash(text) WHERE text_hash IS NULL")
+    cur.execute("""
+        UPDATE training_pairs
+        SET email_hash = text_hash(original_email), reply_hash = text_hash(chosen_reply)
+        WHERE email_hash IS NULL OR reply_hash IS NULL
+    """)
+    
+    # Unique indexes need existing duplicates gone (keep the oldest copy)
+    cur.execute("DELETE FROM samples WHERE id NOT IN (SELECT MIN(id) FROM samples GROUP BY text_hash)")
+    cur.execute("""
+        DELETE FROM training_pairs WHERE id NOT IN (
+            SELECT MIN(id) FROM training_pairs GROUP BY email_hash, reply_hash
+        )
+    """)
+
+def _migrate_phrase_counts(cur):
+    """v2: seed the incremental n-gram table from existing samples"""
+    cur.execute("DELETE FROM phrase_counts")
+    cur.execute("SELECT text FROM samples")
+    _count_phrases(cur, [r[0] for r in cur.fetchall()])
+
+def _migrate_style_profile(cur):
+    """v3: materialize the style profile from existing data"""
+    _rebuild_style(cur)
+
+def _migrate_style_formality(cur):
+    """v4: recount formal/casual samples with the shared classifier (was per-keyword hits)"""
+    _rebuild_style(cur)
+
+# Schema migrations, applied in order to bring older personalization.db files up to date.
+# PRAGMA user_version records how many have run.
+MIGRATIONS = [_migrate_hash_columns, _migrate_phrase_counts, _migrate_style_profile, _migrate_style_formality]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def _migrate(conn):
+    """Run any migrations this database has not seen yet"""
+    cur = conn.cursor()
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    
+    print(f"🔧 Upgrading personalization database (schema v{version} → v{SCHEMA_VERSION})...")
+    conn.create_function("text_hash", 1, get_text_hash, deterministic=True)
+    for migration in MIGRATIONS[version:]:
+        migration(cur)
+    cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+_db_size = {"mb": 0.0, "free_mb": 0.0, "checked_at": None}
+
+def get_db_size_mb(max_age=SIZE_CHECK_INTERVAL) -> float:
+    """Database size in MB from page counts, cached for max_age seconds"""
+    if _db_size["checked_at"] is None or time.monotonic() - _db_size["checked_at"] > max_age:
+        try:
+            with _reading() as conn:
+                page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+                pages = conn.execute("PRAGMA page_count").fetchone()[0]
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            _db_size.update(mb=pages * page_size / (1024 * 1024), free_mb=free * page_size / (1024 * 1024),
+                            checked_at=time.monotonic())
+        except Exception:
+            pass
+    return _db_size["mb"]
+
+EXAMPLES = ExampleIndex(EXAMPLE_INDEX_PATH)
+
+with _writing() as conn:
+    conn.executescript(CREATE_SQL)
+    _migrate(conn)
+    conn.executescript(INDEX_SQL)
+    _pending_style = _load_style(conn.cursor())
+    pair_count = conn.execute("SELECT COUNT(*) FROM training_pairs").fetchone()[0]
+    
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        print("🔧 Enabling incremental vacuum (one-time full VACUUM)...")
         conn.commit()
-        
-        # Check final size
-        final_size = get_db_size_mb()
-        print(f"✅ Cleanup complete! Database size: {final_size:.1f}MB")
-        print(f"   Removed {duplicates_removed} duplicate samples")
-        
-        conn.close()
-        
-        return final_size
+        conn.execute("VACUUM")
+
+def _remove_duplicates(cur):
+    """Remove exact duplicates (samples and training pairs)"""
+    removed = _delete_samples(cur, """
+        id NOT IN (SELECT MIN(id) FROM samples GROUP BY text_hash)
+    """)
+    
+    cur.execute("""
+        DELETE FROM training_pairs WHERE id NOT IN (
+            SELECT MIN(id) FROM training_pairs 
+            GROUP BY email_hash, reply_hash
+        )
+    """)
+    return removed + cur.rowcount
+
+def _expire_negative_feedback(cur):
+    """Remove old negative feedback (keep positive feedback longer)"""
+    old_threshold = int(time.time()) - 30*24*3600  # 30 days
+    cur.execute("""
+        DELETE FROM interaction_feedback 
+        WHERE feedback = 'negative' AND created_at < ?
+    """, (old_threshold,))
+    return cur.rowcount
+
+def _trim_samples(cur):
+    """Keep samples with diverse vocabulary (avoid repetitive content)"""
+    cur.execute("SELECT COUNT(*) FROM samples")
+    sample_count = cur.fetchone()[0]
+    if sample_count <= MAX_SAMPLES:
+        return 0
+    
+    # Keep 80% most recent + 20% highest quality older samples
+    recent_limit = int(MAX_SAMPLES * 0.8)
+    quality_limit = int(MAX_SAMPLES * 0.2)
+    
+    # Keep most recent samples (pooled connections outlive a failed run's temp table)
+    cur.execute("DROP TABLE IF EXISTS temp.keep_samples")
+    cur.execute("""
+        CREATE TEMP TABLE keep_samples AS
+        SELECT id FROM samples ORDER BY created_at DESC LIMIT ?
+    """, (recent_limit,))
+    
+    # Add quality older samples (longer, more diverse text)
+    cur.execute("""
+        INSERT INTO keep_samples 
+        SELECT id FROM samples 
+        WHERE id NOT IN (SELECT id FROM keep_samples)
+        AND LENGTH(text) > 50
+        ORDER BY LENGTH(text) DESC, created_at DESC 
+        LIMIT ?
+    """, (quality_limit,))
+    
+    # Remove samples not in keep list
+    removed = _delete_samples(cur, "id NOT IN (SELECT id FROM keep_samples)")
+    cur.execute("DROP TABLE keep_samples")
+    return removed
+
+def _trim_training_pairs(cur):
+    """Smart training pair management: recent + high ratings"""
+    cur.execute("SELECT COUNT(*) FROM training_pairs")
+    pair_count = cur.fetchone()[0]
+    if pair_count <= MAX_TRAINING_PAIRS:
+        return 0
+    
+    cur.execute("""
+        DELETE FROM training_pairs WHERE id NOT IN (
+            SELECT id FROM (
+                -- Recent pairs (70%)
+                SELECT id FROM training_pairs 
+                ORDER BY created_at DESC 
+                LIMIT ?
+                
+                UNION
+                
+                -- High-rated diverse pairs (30%)
+                SELECT id FROM training_pairs 
+                WHERE user_rating >= 4
+                ORDER BY user_rating DESC, created_at DESC
+                LIMIT ?
+            )
+        )
+    """, (int(MAX_TRAINING_PAIRS * 0.7), int(MAX_TRAINING_PAIRS * 0.3)))
+    return cur.rowcount
+
+def _trim_interactions(cur):
+    """Keep only valuable interactions (weighted by importance)"""
+    cur.execute("SELECT COUNT(*) FROM interaction_feedback")
+    interaction_count = cur.fetchone()[0]
+    if interaction_count <= MAX_INTERACTIONS:
+        return 0
+    
+    cur.execute("""
+        DELETE FROM interaction_feedback WHERE id NOT IN (
+            SELECT id FROM interaction_feedback 
+            WHERE weight > 0.5 OR feedback = 'selected'
+            ORDER BY weight DESC, created_at DESC 
+            LIMIT ?
+        )
+    """, (MAX_INTERACTIONS,))
+    return cur.rowcount
+
+def _trim_email_patterns(cur):
+    """Clean up email patterns (keep only recent diverse patterns)"""
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='email_patterns'")
+    if not cur.fetchone():
+        return 0
+    
+    cur.execute("SELECT COUNT(*) FROM email_patterns")
+    pattern_count = cur.fetchone()[0]
+    if pattern_count <= MAX_EMAIL_PATTERNS:
+        return 0
+    
+    cur.execute("""
+        DELETE FROM email_patterns WHERE id NOT IN (
+            SELECT id FROM email_patterns 
+            ORDER BY created_at DESC 
+            LIMIT ?
+        )
+    """, (MAX_EMAIL_PATTERNS,))
+    return cur.rowcount
+
+CLEANUP_STEPS = [
+    _remove_duplicates, _expire_negative_feedback, _trim_samples,
+    _trim_training_pairs, _trim_interactions, _trim_email_patterns
+]
+
+def incremental_vacuum(budget=MAINTENANCE_SLICE_SECONDS):
+    """Release free pages in small steps until the time budget is spent; returns pages still free"""
+    deadline = time.monotonic() + budget
+    with _writing() as conn:
+        while True:
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free or time.monotonic() >= deadline:
+                break
+            conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})").fetchall()
+    return free
+
+def _run_steps(steps, pause):
+    """Run each cleanup step (each returns the rows it deleted) in its own short write transaction,
+    then reclaim space in slices"""
+    removed = {}
+    for step in steps:
+        with _writing() as conn:
+            removed[step.__name__] = step(conn.cursor())
+        time.sleep(pause)
+    
+    # Deleted rows may have been in the recent style windows or behind cached replies:
+    # recompute the style profile and move the personalization version (response cache keys)
+    if sum(removed.values()) > 0:
+        with _writing() as conn:
+            _rebuild_style(conn.cursor())
+        _bump_version()
+    
+    while incremental_vacuum():
+        time.sleep(pause)
+    return removed
+
+def smart_cleanup(pause=0):
+    """Intelligent cleanup to maintain storage limits - Enhanced Version"""
+    print("🧹 Starting intelligent storage cleanup...")
+    
+    removed = _run_steps(CLEANUP_STEPS, pause)
+    
+    # Check final size
+    final_size = get_db_size_mb(max_age=0)
+    print(f"✅ Cleanup complete! Database size: {final_size:.1f}MB")
+    print(f"   Removed {removed['_remove_duplicates']} duplicate samples and replies")
+    
+    return final_size
 
 def compress_old_data():
     """Compress older data into summary patterns"""
-    with lock:
-        conn = _connect()
+    with _writing() as conn:
         cur = conn.cursor()
         
         # Get old training pairs (older than 30 days)
@@ -229,135 +577,189 @@ def compress_old_data():
         # Store compressed patterns (if we had a patterns table)
         # For now, just remove old data
         cur.execute("DELETE FROM training_pairs WHERE created_at < ?", (old_threshold,))
-        
-        conn.commit()
-        conn.close()
-        
-        return len(old_patterns)
+        deleted = cur.rowcount
+        if deleted:
+            _rebuild_style(cur)
+    if deleted:
+        _bump_version()
+    return len(old_patterns)
 
 def check_storage_and_cleanup():
-    """Check storage usage and perform cleanup if needed"""
+    """Check storage usage (cached page counts) and hand cleanup to the maintenance worker if needed"""
     current_size = get_db_size_mb()
     
     if current_size > MAX_DB_SIZE_MB:
-        print(f"⚠️  Storage limit reached: {current_size:.1f}MB / {MAX_DB_SIZE_MB}MB")
-        print("🔄 Starting automatic cleanup to free space...")
-        
-        final_size = smart_cleanup()
-        
-        if final_size > MAX_DB_SIZE_MB * 0.9:  # Still over 90% capacity
-            print("🗂️  Performing deep cleanup...")
-            deep_cleanup()
-        
+        if not MAINTENANCE.pending():
+            print(f"⚠️  Storage limit reached: {current_size:.1f}MB / {MAX_DB_SIZE_MB}MB")
+            print("🔄 Scheduling background cleanup to free space...")
+        MAINTENANCE.request()
         return True
     
     return False
 
-def deep_cleanup():
+def _emergency_samples(cur):
+    return _delete_samples(cur, """
+        id NOT IN (
+            SELECT id FROM samples 
+            WHERE LENGTH(text) > 30
+            ORDER BY created_at DESC 
+            LIMIT ?
+        )
+    """, (MAX_SAMPLES // 2,))
+
+def _emergency_training_pairs(cur):
+    cur.execute("""
+        DELETE FROM training_pairs WHERE id NOT IN (
+            SELECT id FROM training_pairs 
+            WHERE user_rating > 0 OR created_at > ?
+            ORDER BY user_rating DESC, created_at DESC 
+            LIMIT ?
+        )
+    """, (int(time.time()) - 7*24*3600, MAX_TRAINING_PAIRS // 2))  # Last 7 days or rated
+    return cur.rowcount
+
+def _emergency_interactions(cur):
+    cur.execute("""
+        DELETE FROM interaction_feedback WHERE id NOT IN (
+            SELECT id FROM interaction_feedback 
+            WHERE weight > 0.7 OR feedback = 'selected'
+            ORDER BY weight DESC 
+            LIMIT ?
+        )
+    """, (MAX_INTERACTIONS // 2,))
+    return cur.rowcount
+
+def _drop_email_patterns(cur):
+    # Remove old email patterns completely
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='email_patterns'")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT COUNT(*) FROM email_patterns")
+    dropped = cur.fetchone()[0]
+    cur.execute("DROP TABLE email_patterns")
+    return dropped
+
+# Keep only 50% of current limits for emergency space
+DEEP_CLEANUP_STEPS = [_emergency_samples, _emergency_training_pairs, _emergency_interactions, _drop_email_patterns]
+
+def deep_cleanup(pause=0):
     """Aggressive cleanup when storage is critically full"""
-    with lock:
-        conn = _connect()
-        cur = conn.cursor()
-        
-        print("🔥 Performing deep storage cleanup...")
-        
-        # Keep only 50% of current limits for emergency space
-        emergency_samples = MAX_SAMPLES // 2
-        emergency_pairs = MAX_TRAINING_PAIRS // 2
-        emergency_interactions = MAX_INTERACTIONS // 2
-        
-        # Keep only the most valuable data
-        cur.execute("""
-            DELETE FROM samples WHERE id NOT IN (
-                SELECT id FROM samples 
-                WHERE LENGTH(text) > 30
-                ORDER BY created_at DESC 
-                LIMIT ?
-            )
-        """, (emergency_samples,))
-        
-        cur.execute("""
-            DELETE FROM training_pairs WHERE id NOT IN (
-                SELECT id FROM training_pairs 
-                WHERE user_rating > 0 OR created_at > ?
-                ORDER BY user_rating DESC, created_at DESC 
-                LIMIT ?
-            )
-        """, (int(time.time()) - 7*24*3600, emergency_pairs))  # Last 7 days or rated
-        
-        cur.execute("""
-            DELETE FROM interaction_feedback WHERE id NOT IN (
-                SELECT id FROM interaction_feedback 
-                WHERE weight > 0.7 OR feedback = 'selected'
-                ORDER BY weight DESC 
-                LIMIT ?
-            )
-        """, (emergency_interactions,))
-        
-        # Remove old email patterns completely
-        cur.execute("DROP TABLE IF EXISTS email_patterns")
-        
-        cur.execute("VACUUM")
-        conn.commit()
-        
-        final_size = get_db_size_mb()
-        print(f"🎯 Deep cleanup complete! Size reduced to {final_size:.1f}MB")
-        
-        conn.close()
+    print("🔥 Performing deep storage cleanup...")
+    
+    _run_steps(DEEP_CLEANUP_STEPS, pause)
+    
+    final_size = get_db_size_mb(max_age=0)
+    print(f"🎯 Deep cleanup complete! Size reduced to {final_size:.1f}MB")
+    return final_size
 
-def add_sample(text: str):
+class MaintenanceWorker:
+    """Runs storage cleanup on a dedicated thread, in short slices that yield to request writers"""
+    def __init__(self, pause):
+        self.pause = pause
+        self._wake = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.running = False
+        self.stats = {"passes": 0, "deep_passes": 0, "last_run": None, "last_duration": None}
+    
+    def request(self):
+        """Ask for a cleanup pass; repeated requests coalesce into one"""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-maintenance", daemon=True)
+                self._thread.start()
+        self._wake.set()
+    
+    def pending(self):
+        return self.running or self._wake.is_set()
+    
+    def status(self):
+        return {"running": self.running, "requested": self._wake.is_set(), "free_mb": round(_db_size["free_mb"], 2), **self.stats}
+    
+    def run_pass(self):
+        self.running = True
+        t0 = time.time()
+        try:
+            final_size = smart_cleanup(pause=self.pause)
+            if final_size > MAX_DB_SIZE_MB * 0.9:  # Still over 90% capacity
+                print("🗂️  Performing deep cleanup...")
+                deep_cleanup(pause=self.pause)
+                self.stats["deep_passes"] += 1
+            refresh_example_index()
+        finally:
+            self.running = False
+            self.stats["passes"] += 1
+            self.stats["last_run"] = t0
+            self.stats["last_duration"] = round(time.time() - t0, 3)
+    
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self.run_pass()
+            except Exception as e:
+                print(f"❌ Storage maintenance failed: {e}")
+
+MAINTENANCE = MaintenanceWorker(MAINTENANCE_PAUSE)
+
+def _insert_sample(cur, text):
+    """Insert a writing sample inside an open write transaction"""
     text = sanitize_text(text)
     if not text or len(text) < 10:  # Skip very short texts
         return False
     
+    # Add new sample; the unique text_hash index skips duplicates
+    cur.execute("INSERT OR IGNORE INTO samples (created_at, text, text_hash) VALUES (?,?,?)", (int(time.time()), text, get_text_hash(text)))
+    if cur.rowcount == 0:
+        return False  # Skip duplicates
+    _count_phrases(cur, [text])
+    
+    # Slide the formality window: add the new sample, drop the one that fell out
+    stats = _updated_style()
+    _apply_sample(stats, text)
+    cur.execute("SELECT text FROM samples ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?", (STYLE_SAMPLE_WINDOW,))
+    row = cur.fetchone()
+    if row:
+        _apply_sample(stats, row[0], sign=-1)
+    _save_style(cur, stats)
+    return True
+
+def add_sample(text: str):
     # Check storage before adding
     check_storage_and_cleanup()
     
-    text_hash = get_text_hash(text)
-    ts = int(time.time())
-    
-    with lock:
-        conn = _connect()
-        cur = conn.cursor()
-        
-        # Check for duplicates
-        cur.execute("SELECT id FROM samples WHERE text = ?", (text,))
-        if cur.fetchone():
-            conn.close()
-            return False  # Skip duplicates
-        
-        # Add new sample
-        cur.execute("INSERT INTO samples (created_at, text) VALUES (?,?)", (ts, text))
-        
-        conn.commit()
-        conn.close()
-    return True
+    with _writing() as conn:
+        added = _insert_sample(conn.cursor(), text)
+    if added:
+        _bump_version()
+    return added
 
 def list_samples(limit=50):
-    with lock:
-        conn = _connect()
+    with _reading() as conn:
         cur = conn.cursor()
         cur.execute("SELECT id, created_at, text FROM samples ORDER BY created_at DESC LIMIT ?", (limit,))
         rows = cur.fetchall()
-        conn.close()
     return [{"id": r[0], "created_at": r[1], "text": r[2]} for r in rows]
 
 def clear_samples():
-    with lock:
-        conn = _connect()
+    # Let queued learning writes land first so the clear really empties the tables
+    WRITER.flush()
+    with _writing() as conn:
         cur = conn.cursor()
         cur.execute("DELETE FROM samples")
+        cur.execute("DELETE FROM phrase_counts")
         cur.execute("DELETE FROM training_pairs")
-        conn.commit()
-        conn.close()
+        _rebuild_style(cur)
+    EXAMPLES.clear()
+    _bump_version()
 
 def get_storage_status():
     """Get detailed storage status"""
-    current_size = get_db_size_mb()
+    current_size = get_db_size_mb(max_age=0)
     usage_percent = (current_size / MAX_DB_SIZE_MB) * 100
     
-    with lock:
-        conn = _connect()
+    with _reading() as conn:
         cur = conn.cursor()
         
         # Count records in each table
@@ -369,11 +771,10 @@ def get_storage_status():
         
         cur.execute("SELECT COUNT(*) FROM interaction_feedback")
         feedback_count = cur.fetchone()[0]
-        
-        conn.close()
     
     return {
         "size_mb": current_size,
+        "free_mb": _db_size["free_mb"],
         "max_size_mb": MAX_DB_SIZE_MB,
         "usage_percent": usage_percent,
         "samples": sample_count,
@@ -382,8 +783,8 @@ def get_storage_status():
         "status": "critical" if usage_percent > 95 else "warning" if usage_percent > 80 else "healthy"
     }
 
-def add_training_pair(original_email: str, chosen_reply: str, context: dict):
-    """Add a training pair with smart deduplication"""
+def _insert_training_pair(cur, original_email, chosen_reply, context):
+    """Insert a training pair with smart deduplication inside an open write transaction"""
     original_email = sanitize_text(original_email)
     chosen_reply = sanitize_text(chosen_reply)
     
@@ -394,88 +795,134 @@ def add_training_pair(original_email: str, chosen_reply: str, context: dict):
     if len(original_email) < 20 or len(chosen_reply) < 10:
         return False
     
-    # Check storage before adding
-    check_storage_and_cleanup()
-    
     ts = int(time.time())
     tone = context.get('tone', 'professional')
     length = context.get('length', 'medium')
+    email_hash = get_text_hash(original_email)
+    reply_hash = get_text_hash(chosen_reply)
     
-    with lock:
-        conn = _connect()
-        cur = conn.cursor()
-        
-        # Check for similar pairs (avoid near-duplicates)
-        cur.execute("""
-            SELECT id FROM training_pairs 
-            WHERE original_email = ? OR chosen_reply = ?
-        """, (original_email, chosen_reply))
-        
-        if cur.fetchone():
-            conn.close()
-            return False  # Skip duplicates
-        
-        # Add new pair
-        cur.execute(
-            "INSERT INTO training_pairs (created_at, original_email, chosen_reply, tone, length) VALUES (?,?,?,?,?)",
-            (ts, original_email, chosen_reply, tone, length)
-        )
-        
-        conn.commit()
-        conn.close()
+    # Check for similar pairs (avoid near-duplicates) via the indexed hash columns
+    cur.execute("""
+        SELECT id FROM training_pairs 
+        WHERE email_hash = ? OR reply_hash = ?
+        LIMIT 1
+    """, (email_hash, reply_hash))
+    
+    if cur.fetchone():
+        return False  # Skip duplicates
+    
+    # Add new pair
+    cur.execute(
+        "INSERT INTO training_pairs (created_at, original_email, chosen_reply, tone, length, email_hash, reply_hash) VALUES (?,?,?,?,?,?,?)",
+        (ts, original_email, chosen_reply, tone, length, email_hash, reply_hash)
+    )
+    row_id = cur.lastrowid
+    _after_commit.append(lambda: EXAMPLES.add(row_id, original_email))
+    
+    stats = _updated_style()
+    _apply_pair(stats, tone, chosen_reply)
+    cur.execute("SELECT tone, chosen_reply FROM training_pairs ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?", (STYLE_PAIR_WINDOW,))
+    row = cur.fetchone()
+    if row:
+        _apply_pair(stats, row[0], row[1], sign=-1)
+    _save_style(cur, stats)
     return True
 
+def add_training_pair(original_email: str, chosen_reply: str, context: dict):
+    """Add a training pair with smart deduplication"""
+    # Check storage before adding
+    check_storage_and_cleanup()
+    
+    with _writing() as conn:
+        added = _insert_training_pair(conn.cursor(), original_email, chosen_reply, context)
+    if added:
+        _bump_version()
+    return added
+
 def get_training_pairs(limit=50):
     """Get recent training pairs for analysis"""
-    with lock:
-        conn = _connect()
+    with _reading() as conn:
         cur = conn.cursor()
         cur.execute("SELECT original_email, chosen_reply, tone, length FROM training_pairs ORDER BY created_at DESC LIMIT ?", (limit,))
         rows = cur.fetchall()
-        conn.close()
     return [{"original": r[0], "reply": r[1], "tone": r[2], "length": r[3]} for r in rows]
 
-def add_interaction_feedback(learning_data: dict, weight: float = 1.0):
-    """Store user interaction feedback with smart filtering"""
-    ts = int(time.time())
-    
+def _insert_interaction_feedback(cur, learning_data, weight):
+    """Store user interaction feedback inside an open write transaction"""
     # Only store valuable feedback
     if weight < 0 and abs(weight) < 0.3:  # Skip weak negative feedback
         return False
     
+    # Compress context to save space
+    context = learning_data.get("context", {})
+    compressed_context = json.dumps({
+        "tone": context.get("tone", "professional"),
+        "length": context.get("length", "medium")
+    })
+    
+    cur.execute(
+        "INSERT INTO interaction_feedback (created_at, interaction_type, original_email, suggestion, feedback, weight, context) VALUES (?,?,?,?,?,?,?)",
+        (int(time.time()), learning_data["interaction_type"], learning_data["original_email"][:200],  # Limit email length
+         learning_data["suggestion"][:200], learning_data["feedback"], weight,  # Limit suggestion length
+         compressed_context)
+    )
+    
+    stats = _updated_style()
+    if weight > 0:
+        stats["feedback"]["positive"] += 1
+    elif weight < 0:
+        stats["feedback"]["negative"] += 1
+    _save_style(cur, stats)
+    return True
+
+def add_interaction_feedback(learning_data: dict, weight: float = 1.0):
+    """Store user interaction feedback with smart filtering"""
     # Check storage before adding
     check_storage_and_cleanup()
     
-    with lock:
-        conn = _connect()
-        cur = conn.cursor()
-        
-        # Compress context to save space
-        context = learning_data.get("context", {})
-        compressed_context = json.dumps({
-            "tone": context.get("tone", "professional"),
-            "length": context.get("length", "medium")
-        })
-        
-        cur.execute(
-            "INSERT INTO interaction_feedback (created_at, interaction_type, original_email, suggestion, feedback, weight, context) VALUES (?,?,?,?,?,?,?)",
-            (ts, learning_data["interaction_type"], learning_data["original_email"][:200],  # Limit email length
-             learning_data["suggestion"][:200], learning_data["feedback"], weight,  # Limit suggestion length
-             compressed_context)
-        )
-        
-        conn.commit()
-        conn.close()
+    with _writing() as conn:
+        added = _insert_interaction_feedback(conn.cursor(), learning_data, weight)
+    if added:
+        _bump_version()
+    return added
+
+def refresh_example_index(force=False):
+    """Rebuild the similar-email index when it has drifted from training_pairs (deletes, lost files)"""
+    if not EXAMPLES.enabled:
+        return False
+    with _reading() as conn:
+        pair_count = conn.execute("SELECT COUNT(*) FROM training_pairs").fetchone()[0]
+    if not force and abs(EXAMPLES.count - pair_count) <= pair_count * EXAMPLE_REINDEX_DRIFT:
+        return False
+    
+    with _reading() as conn:
+        rows = conn.execute("SELECT id, original_email FROM training_pairs").fetchall()
+    indexed = EXAMPLES.rebuild(rows)
+    print(f"🔎 Rebuilt similar-email index ({indexed} emails)")
     return True
 
+def find_similar_replies(email_text: str, k: int = 2, min_score: float = EXAMPLE_MIN_SCORE):
+    """The user's chosen replies to the k most similar past emails, best first"""
+    hits = [(row_id, score) for row_id, score in EXAMPLES.search(sanitize_text(email_text), k * 3) if score >= min_score]
+    if not hits:
+        return []
+    
+    # Over-fetch: rows removed by cleanup stay in the index until the next rebuild
+    scores = dict(hits)
+    with _reading() as conn:
+        rows = conn.execute(
+            f"SELECT id, original_email, chosen_reply, tone FROM training_pairs WHERE id IN ({','.join('?' * len(scores))})",
+            list(scores)
+        ).fetchall()
+    found = {r[0]: {"original": r[1], "reply": r[2], "tone": r[3], "score": round(scores[r[0]], 3)} for r in rows}
+    return [found.pop(row_id) for row_id, _ in hits if row_id in found][:k]
+
 def get_feedback_patterns():
     """Analyze user feedback patterns for learning"""
-    with lock:
-        conn = _connect()
+    with _reading() as conn:
         cur = conn.cursor()
         cur.execute("SELECT interaction_type, feedback, weight, suggestion, context FROM interaction_feedback ORDER BY created_at DESC LIMIT 100")
         rows = cur.fetchall()
-        conn.close()
     
     patterns = {
         "positive_patterns": [],
@@ -507,35 +954,27 @@ def get_feedback_patterns():
     return patterns
 
 def extract_top_phrases(top_k=12):
-    with lock:
-        conn = _connect()
+    # Counts are maintained incrementally; the (kind, n) index makes this a short range scan
+    with _reading() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT text FROM samples")
-        rows = cur.fetchall()
-        conn.close()
-    tokens = []
-    for r in rows:
-        txt = sanitize_text(r[0])
-        tokens.extend(re.findall(r"\b\w+\b", txt.lower()))
-    if not tokens: return []
-    uni = Counter(tokens)
-    bigrams = Counter()
-    for i in range(len(tokens)-1):
-        bigrams[" ".join(tokens[i:i+2])] += 1
-    top_uni = [w for w,_ in uni.most_common(10)]
-    top_bi = [w for w,_ in bigrams.most_common(10)]
+        cur.execute("SELECT phrase FROM phrase_counts WHERE kind = 1 ORDER BY n DESC LIMIT 10")
+        top_uni = [r[0] for r in cur.fetchall()]
+        cur.execute("SELECT phrase FROM phrase_counts WHERE kind = 2 ORDER BY n DESC LIMIT 10")
+        top_bi = [r[0] for r in cur.fetchall()]
     phrases = []
     for p in top_bi + top_uni:
         if len(phrases) >= top_k: break
         phrases.append(p)
     return phrases
 
+def get_style_profile():
+    """Materialized style profile: {version, updated_at, stats}"""
+    return _style
+
 def analyze_user_patterns():
-    """Lightweight analysis of user communication patterns"""
-    training_pairs = get_training_pairs(50)
-    samples = list_samples(limit=100)
-    
-    if not training_pairs and not samples:
+    """Lightweight analysis of user communication patterns (read from the style profile)"""
+    stats = _style["stats"]
+    if not stats["pairs"] and not stats["samples"]:
         return {}
     
     patterns = {
@@ -546,41 +985,29 @@ def analyze_user_patterns():
         "formality_level": 0.5
     }
     
-    # Analyze training pairs for response patterns
-    if training_pairs:
-        tone_counts = Counter(pair["tone"] for pair in training_pairs)
+    # Response patterns from recent training pairs
+    if stats["pairs"]:
+        tone_counts = Counter(stats["tones"])
         patterns["preferred_tone"] = tone_counts.most_common(1)[0][0] if tone_counts else "professional"
-        
-        # Analyze response lengths
-        reply_lengths = [len(pair["reply"].split()) for pair in training_pairs]
-        patterns["avg_length"] = int(sum(reply_lengths) / len(reply_lengths)) if reply_lengths else 20
-        
-        # Find common response starters
-        starters = [pair["reply"].split()[:3] for pair in training_pairs if len(pair["reply"].split()) >= 3]
-        starter_phrases = [" ".join(starter) for starter in starters]
-        patterns["common_starters"] = Counter(starter_phrases).most_common(3)
-    
-    # Analyze formality from samples
-    if samples:
-        formal_indicators = ["regards", "sincerely", "please", "kindly", "thank you", "best"]
-        casual_indicators = ["thanks", "hey", "sure", "ok", "cool", "awesome"]
-        
-        formal_count = sum(1 for s in samples for indicator in formal_indicators 
-                          if indicator in s["text"].lower())
-        casual_count = sum(1 for s in samples for indicator in casual_indicators 
-                          if indicator in s["text"].lower())
-        
-        total_indicators = formal_count + casual_count
-        patterns["formality_level"] = formal_count / max(1, total_indicators)
+        patterns["avg_length"] = int(stats["reply_words"] / stats["pairs"])
+        patterns["common_starters"] = Counter(stats["starters"]).most_common(3)
+    
+    # Formality from recent samples
+    if stats["samples"]:
+        total_indicators = stats["formal"] + stats["casual"]
+        patterns["formality_level"] = stats["formal"] / max(1, total_indicators)
     
     return patterns
 
 def build_style_summary(max_len=300):
     """Enhanced style summary with pattern analysis"""
-    patterns = analyze_user_patterns()
-    samples = list_samples(limit=50)
+    global _summary_cache
+    version = _style["version"]
+    if _summary_cache and _summary_cache[:2] == (version, max_len):
+        return _summary_cache[2]
     
-    if not patterns and not samples:
+    patterns = analyze_user_patterns()
+    if not patterns:
         return ""
     
     # Build intelligent summary
@@ -602,100 +1029,66 @@ def build_style_summary(max_len=300):
         top_starter = patterns["common_starters"][0][0]
         summary += f" Often starts with: '{top_starter}'."
     
-    return summary[:max_len]
-def analyze_and_learn_from_email(email_text: str, tone: str, length: str):
-    """Learn patterns from incoming emails (passive learning)"""
+    summary = summary[:max_len]
+    _summary_cache = (version, max_len, summary)
+    return summary
+
+def _insert_email_analysis(cur, email_text):
+    """Classify an incoming email and store its pattern inside an open write transaction"""
     if not email_text or len(email_text) < 20:
         return False
     
     email_text = sanitize_text(email_text)
     ts = int(time.time())
     
-    # Extract email patterns
-    patterns = {
-        "sender_style": "unknown",
-        "email_type": "general",
-        "urgency": "normal",
-        "formality": "medium"
-    }
+    patterns = classify(email_text)
     
-    text_lower = email_text.lower()
-    
-    # Detect email type
-    if any(word in text_lower for word in ["meeting", "schedule", "calendar", "appointment"]):
-        patterns["email_type"] = "scheduling"
-    elif any(word in text_lower for word in ["thank", "appreciate", "grateful"]):
-        patterns["email_type"] = "gratitude"
-    elif any(word in text_lower for word in ["urgent", "asap", "immediate", "priority"]):
-        patterns["email_type"] = "urgent"
-        patterns["urgency"] = "high"
-    elif any(word in text_lower for word in ["question", "help", "clarify", "explain"]):
-        patterns["email_type"] = "inquiry"
-    elif any(word in text_lower for word in ["update", "status", "progress", "report"]):
-        patterns["email_type"] = "update_request"
-    
-    # Detect formality level
-    formal_indicators = ["dear", "sincerely", "regards", "please", "kindly", "would you"]
-    casual_indicators = ["hey", "hi", "thanks", "sure", "ok", "cool"]
-    
-    formal_count = sum(1 for word in formal_indicators if word in text_lower)
-    casual_count = sum(1 for word in casual_indicators if word in text_lower)
-    
-    if formal_count > casual_count:
-        patterns["formality"] = "high"
-    elif casual_count > formal_count:
-        patterns["formality"] = "low"
-    
-    # Store email pattern for learning
-    with lock:
-        conn = _connect()
-        cur = conn.cursor()
-        
-        # Create email_patterns table if not exists
+    # Store email pattern for learning (create email_patterns table if not exists)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS email_patterns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at INTEGER,
+            email_snippet TEXT,
+            email_type TEXT,
+            formality TEXT,
+            urgency TEXT,
+            word_count INTEGER
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_email_patterns_created_at ON email_patterns(created_at)")
+    
+    # Store pattern
+    cur.execute("""
+        INSERT INTO email_patterns (created_at, email_snippet, email_type, formality, urgency, word_count)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (ts, email_text[:200], patterns["email_type"], patterns["formality"], 
+          patterns["urgency"], len(email_text.split())))
+    
+    # Keep only recent 100 email patterns
+    cur.execute("SELECT COUNT(*) FROM email_patterns")
+    count = cur.fetchone()[0]
+    if count > 100:
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS email_patterns (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                created_at INTEGER,
-                email_snippet TEXT,
-                email_type TEXT,
-                formality TEXT,
-                urgency TEXT,
-                word_count INTEGER
+            DELETE FROM email_patterns WHERE id IN (
+                SELECT id FROM email_patterns ORDER BY created_at ASC LIMIT ?
             )
-        """)
-        
-        # Store pattern
-        cur.execute("""
-            INSERT INTO email_patterns (created_at, email_snippet, email_type, formality, urgency, word_count)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (ts, email_text[:200], patterns["email_type"], patterns["formality"], 
-              patterns["urgency"], len(email_text.split())))
-        
-        # Keep only recent 100 email patterns
-        cur.execute("SELECT COUNT(*) FROM email_patterns")
-        count = cur.fetchone()[0]
-        if count > 100:
-            cur.execute("""
-                DELETE FROM email_patterns WHERE id IN (
-                    SELECT id FROM email_patterns ORDER BY created_at ASC LIMIT ?
-                )
-            """, (count - 100,))
-        
-        conn.commit()
-        conn.close()
+        """, (count - 100,))
     
     return True
 
+def analyze_and_learn_from_email(email_text: str, tone: str, length: str):
+    """Learn patterns from incoming emails (passive learning)"""
+    with _writing() as conn:
+        return _insert_email_analysis(conn.cursor(), email_text)
+
 def get_email_context_insights():
     """Get insights from analyzed email patterns"""
-    with lock:
-        conn = _connect()
+    with _reading() as conn:
         cur = conn.cursor()
         
         # Check if table exists
         cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='email_patterns'")
         if not cur.fetchone():
-            conn.close()
             return {}
         
         cur.execute("""
@@ -707,7 +1100,6 @@ def get_email_context_insights():
         """, (int(time.time()) - 30*24*3600,))  # Last 30 days
         
         rows = cur.fetchall()
-        conn.close()
     
     insights = {
         "common_email_types": {},
@@ -726,4 +1118,127 @@ def get_email_context_insights():
                 insights["urgency_patterns"][urgency] = 0
             insights["urgency_patterns"][urgency] += count
     
-    return insights
\ No newline at end of file
+    return insights
+
+class WriteBehindQueue:
+    """Buffers learning writes and commits them in batched transactions on a background thread"""
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.stats = {"queued": 0, "written": 0, "skipped": 0, "failed": 0, "batches": 0}
+    
+    def _ensure_worker(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="learning-writer", daemon=True)
+                self._thread.start()
+    
+    def submit(self, fn, *args, bump=True):
+        """Queue fn(cur, *args); bump=False for writes that don't change learned style"""
+        self._ensure_worker()
+        self.stats["queued"] += 1
+        self._queue.put((fn, args, bump))
+    
+    def add_sample(self, text):
+        self.submit(_insert_sample, text)
+    
+    def add_training_pair(self, original_email, chosen_reply, context):
+        self.submit(_insert_training_pair, original_email, chosen_reply, context)
+    
+    def add_interaction_feedback(self, learning_data, weight=1.0):
+        self.submit(_insert_interaction_feedback, learning_data, weight)
+    
+    def analyze_email(self, email_text):
+        self.submit(_insert_email_analysis, email_text, bump=False)
+    
+    def flush(self, timeout=None):
+        """Block until everything queued so far is committed"""
+        if self._thread is None or threading.current_thread() is self._thread:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+    
+    def close(self, timeout=5):
+        """Flush and stop the worker (registered to run at exit)"""
+        if self._thread is None:
+            return
+        self.flush(timeout)
+        self._queue.put(None)
+        self._thread.join(timeout)
+    
+    def depth(self):
+        return self._queue.qsize()
+    
+    def status(self):
+        return {
+            "depth": self.depth(),
+            "interval_ms": int(self.interval * 1000),
+            "batch_size": self.batch_size,
+            **self.stats
+        }
+    
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch, waiters, stop = [], [], False
+            deadline = time.monotonic() + self.interval
+            
+            # Gather until the interval elapses, the batch fills, or someone asks for a flush
+            while True:
+                if item is None:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            
+            if batch:
+                self._write(batch)
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                return
+    
+    def _write(self, batch):
+        try:
+            check_storage_and_cleanup()
+            with _writing() as conn:
+                cur = conn.cursor()
+                results = [fn(cur, *args) for fn, args, _ in batch]
+        except Exception as e:
+            # One bad write shouldn't lose the rest of the batch
+            print(f"⚠️  Batched learning write failed ({e}), retrying individually")
+            results = []
+            for fn, args, _ in batch:
+                try:
+                    with _writing() as conn:
+                        results.append(fn(conn.cursor(), *args))
+                except Exception as item_error:
+                    print(f"❌ Learning write dropped: {item_error}")
+                    self.stats["failed"] += 1
+                    results.append(None)
+        
+        self.stats["batches"] += 1
+        self.stats["written"] += sum(1 for r in results if r)
+        self.stats["skipped"] += sum(1 for r in results if r is False)
+        if any(r and bump for r, (_, _, bump) in zip(results, batch)):
+            _bump_version()
+
+WRITER = WriteBehindQueue(WRITE_BEHIND_INTERVAL, WRITE_BEHIND_BATCH)
+atexit.register(WRITER.close)
+
+# Index files missing or stale (first run with retrieval, copied database): rebuild off the import path
+if EXAMPLES.enabled and abs(EXAMPLES.count - pair_count) > pair_count * EXAMPLE_REINDEX_DRIFT:
+    threading.Thread(target=refresh_example_index, name="example-reindex", daemon=True).start()
@@ -0,0 +1,176 @@
+# retrieval.py
+"""
+Local similar-email index for few-shot prompting.
+
+Emails are embedded with a hashed TF-IDF vectorizer (unigrams and bigrams
+hashed into a fixed number of buckets) and kept in a NumPy memmap next to the
+personalization database. The index grows one row per training pair, survives
+restarts, and answers a top-k cosine query with a single matrix-vector product.
+"""
+import json, math, os, re, threading, zlib
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:  # Retrieval is optional; prompts simply go without examples
+    np = None
+
+EMBED_DIM = 1024         # Hash buckets per vector (4KB per indexed email)
+INITIAL_CAPACITY = 256   # Rows allocated up front; doubles when full
+
+_TOKEN_RE = re.compile(r"\b\w+\b")
+
+def hashed_features(text):
+    """Signed bucket counts for the text's unigrams and bigrams"""
+    # Bare numbers (dates, amounts, ids) say little about what kind of email it is
+    tokens = [t for t in _TOKEN_RE.findall(text.lower()) if not t.isdigit()]
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    features = Counter()
+    for gram in grams:
+        h = zlib.crc32(gram.encode("utf-8"))
+        features[h % EMBED_DIM] += 1 if h & 0x80000000 else -1
+    return {bucket: count for bucket, count in features.items() if count}
+
+class ExampleIndex:
+    """Append-only memmap of L2-normalised TF-IDF vectors keyed by training pair id.
+
+    IDF weights are taken at insert time; rebuild() re-weights every row with
+    current document frequencies and drops rows whose pairs were deleted.
+    """
+    def __init__(self, base_path):
+        self.vectors_path = f"{base_path}.vec"
+        self.ids_path = f"{base_path}.ids"
+        self.meta_path = f"{base_path}.json"
+        self.enabled = np is not None
+        self.count = 0
+        self.capacity = 0
+        self.docs = 0
+        self.df = [0] * EMBED_DIM
+        self._vectors = None
+        self._ids = None
+        self._lock = threading.Lock()
+        if self.enabled:
+            self._load()
+
+    def _open(self, capacity, mode):
+        vectors = np.memmap(self.vectors_path, dtype=np.float32, mode=mode, shape=(capacity, EMBED_DIM))
+        ids = np.memmap(self.ids_path, dtype=np.int64, mode=mode, shape=(capacity,))
+        return vectors, ids
+
+    def _load(self):
+        try:
+            with open(self.meta_path, encoding="utf8") as f:
+                meta = json.load(f)
+            if meta["dim"] != EMBED_DIM:
+                raise ValueError("embedding size changed")
+            self._vectors, self._ids = self._open(meta["capacity"], "r+")
+            self.count, self.capacity = meta["count"], meta["capacity"]
+            self.docs, self.df = meta["docs"], meta["df"]
+        except Exception:
+            self._reset(INITIAL_CAPACITY)
+
+    def _reset(self, capacity):
+        self._vectors, self._ids = self._open(capacity, "w+")
+        self.count, self.capacity, self.docs = 0, capacity, 0
+        self.df = [0] * EMBED_DIM
+        self._save_meta()
+
+    def _save_meta(self):
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "w", encoding="utf8") as f:
+            json.dump({"dim": EMBED_DIM, "count": self.count, "capacity": self.capacity,
+                       "docs": self.docs, "df": self.df}, f)
+        os.replace(tmp, self.meta_path)
+
+    def _grow(self):
+        """Double the memmaps (copying existing rows)"""
+        old_vectors, old_ids = np.array(self._vectors[:self.count]), np.array(self._ids[:self.count])
+        self._vectors, self._ids = None, None
+        self._vectors, self._ids = self._open(self.capacity * 2, "w+")
+        self._vectors[:self.count] = old_vectors
+        self._ids[:self.count] = old_ids
+        self.capacity *= 2
+
+    def _vector(self, features, df, docs):
+        vec = np.zeros(EMBED_DIM, dtype=np.float32)
+        for bucket, count in features.items():
+            tf = 1 + math.log(abs(count))
+            idf = math.log((1 + docs) / (1 + df[bucket])) + 1
+            vec[bucket] = math.copysign(tf * idf, count)
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else None
+
+    def add(self, row_id, text):
+        """Index one email; returns False when it has no usable tokens"""
+        if not self.enabled:
+            return False
+        features = hashed_features(text)
+        if not features:
+            return False
+        with self._lock:
+            for bucket in features:
+                self.df[bucket] += 1
+            self.docs += 1
+            vec = self._vector(features, self.df, self.docs)
+            if self.count >= self.capacity:
+                self._grow()
+            self._vectors[self.count] = vec
+            self._ids[self.count] = row_id
+            self.count += 1
+            self._save_meta()
+        return True
+
+    def search(self, text, k=2):
+        """[(row_id, cosine score)] of the k most similar indexed emails, best first"""
+        if not self.enabled or not self.count:
+            return []
+        features = hashed_features(text)
+        if not features:
+            return []
+        # Held while scoring: growing or rebuilding rewrites the files under the memmaps
+        with self._lock:
+            query = self._vector(features, self.df, self.docs)
+            if query is None:
+                return []
+            scores = self._vectors[:self.count] @ query
+            k = min(k, self.count)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(int(self._ids[i]), float(scores[i])) for i in top]
+
+    def rebuild(self, rows):
+        """Re-index from (row_id, text) pairs with fresh IDF weights"""
+        if not self.enabled:
+            return 0
+        indexed = [(row_id, hashed_features(text)) for row_id, text in rows]
+        indexed = [(row_id, features) for row_id, features in indexed if features]
+        df = [0] * EMBED_DIM
+        for _, features in indexed:
+            for bucket in features:
+                df[bucket] += 1
+        docs = len(indexed)
+
+        with self._lock:
+            self._vectors, self._ids = None, None
+            self._reset(max(INITIAL_CAPACITY, 1 << max(0, docs - 1).bit_length()))
+            for i, (row_id, features) in enumerate(indexed):
+                self._vectors[i] = self._vector(features, df, docs)
+                self._ids[i] = row_id
+            self.count, self.docs, self.df = docs, docs, df
+            self._vectors.flush()
+            self._save_meta()
+        return docs
+
+    def clear(self):
+        if self.enabled:
+            with self._lock:
+                self._vectors, self._ids = None, None
+                self._reset(INITIAL_CAPACITY)
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "entries": self.count,
+            "capacity": self.capacity,
+            "size_mb": round(self.capacity * (EMBED_DIM * 4 + 8) / 1024 / 1024, 1),
+        }
@@ -5,15 +5,22 @@ const TIMEOUT_MS = 30000; // 30 seconds for AI model loading
 // Helper: POST JSON with timeout
 async function postJSON(url, body) {
   const controller = new AbortController();
-  const id = setTimeout(() => controller.abort(), TIMEOUT_MS);
+  // Generation requests carry an id so the server can stop work we no longer wait for
+  const requestId = body && body.email_text ? crypto.randomUUID() : null;
+  const id = setTimeout(() => {
+    controller.abort();
+    if (requestId) fetch(`${SERVER}/cancel/${requestId}`, { method: "POST" }).catch(() => {});
+  }, TIMEOUT_MS);
   try {
     const res = await fetch(url, {
       method: "POST",
       headers: { "Content-Type": "application/json" },
-      body: JSON.stringify(body),
+      body: JSON.stringify(requestId ? { ...body, request_id: requestId } : body),
       signal: controller.signal,
     });
     clearTimeout(id);
+    // 503 means the server queue is full; its body still carries a template reply
+    if (res.status === 503) return await res.json();
     if (!res.ok) throw new Error(`HTTP ${res.status}`);
     return await res.json();
   } catch (e) {
@@ -25,22 +32,24 @@ async function postJSON(url, body) {
 // generate suggestions: ask local server and return 3 variants
 chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
   if (message.action === "generate_suggestions") {
-    const { email_text, tone = "professional", length = "medium" } = message;
+    const { email_text, tone = "professional", length = "medium", regenerate = false } = message;
     
     console.log('🚀 Generating suggestions for:', email_text.substring(0, 50) + '...');
     
-    postJSON(`${SERVER}/generate`, { email_text, tone, length })
+    // One batched request returns real [base, short, long] variants
+    postJSON(`${SERVER}/generate_batch`, { email_text, tone, length, regenerate })
       .then((j) => {
         console.log('✅ Server response:', j);
         
-        const base = j && j.reply ? j.reply.trim() : null;
+        const replies = j && Array.isArray(j.replies) ? j.replies.map((r) => (r || "").trim()).filter(Boolean) : [];
+        const base = replies[0] || (j && j.reply ? j.reply.trim() : null);
         if (base) {
           const short = base.split(".").slice(0, 1).join(".") + ".";
           const long = base + " Please let me know if you'd like more details.";
           
           console.log('🤖 AI suggestions generated successfully');
           sendResponse({
-            suggestions: [base, short, long],
+            suggestions: replies.length >= 3 ? replies : [base, short, long],
             from_model: !!j.from_model,
             meta: j.meta || {},
           });
@@ -124,6 +133,15 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
     return true;
   }
 
+  // Preload the model when a compose box opens
+  if (message.action === "prewarm") {
+    fetch(`${SERVER}/prewarm`, { method: "POST" })
+      .then((r) => r.json())
+      .then((j) => sendResponse({ ok: true, status: j }))
+      .catch((e) => sendResponse({ ok: false, error: String(e) }));
+    return true;
+  }
+
   // Memory status check
   if (message.action === "memory_status") {
     fetch(`${SERVER}/memory_status`)
@@ -182,8 +200,8 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
 
   // single reply generation (fallback)
   if (message.action === "generate_reply") {
-    const { email_text, tone = "professional", length = "medium" } = message;
-    postJSON(`${SERVER}/generate`, { email_text, tone, length })
+    const { email_text, tone = "professional", length = "medium", regenerate = false } = message;
+    postJSON(`${SERVER}/generate`, { email_text, tone, length, regenerate })
       .then((j) =>
         sendResponse({ ok: true, reply: j.reply, from_model: !!j.from_model })
       )
@@ -212,6 +212,20 @@
     }
   }
   
+  // Ask the server to preload the model (cheap, fire-and-forget)
+  function requestPrewarm() {
+    if (typeof chrome !== 'undefined' && chrome.runtime && chrome.runtime.sendMessage) {
+      try {
+        chrome.runtime.sendMessage({ action: 'prewarm' }, function() {
+          // Server may be offline; nothing to do
+          void chrome.runtime.lastError;
+        });
+      } catch (e) {
+        // Extension context invalidated
+      }
+    }
+  }
+  
   // Fallback suggestions
   function getFallbackSuggestions() {
     return [
@@ -503,6 +517,9 @@
     var button = createButton();
     var panel = createPanel();
     
+    // A compose box just appeared - let the server start loading the model early
+    requestPrewarm();
+    
     try {
       textbox.appendChild(button);
       textbox.appendChild(panel);
@@ -110,6 +110,10 @@ def download_ai_engine():
         "local-server.py",
         "personalization.py", 
         "model_manager.py",
+        "metrics.py",
+        "retrieval.py",
+        "classifier.py",
+        "asgi_server.py",
         "requirements.txt"
     ]
     